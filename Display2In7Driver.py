@@ -1,106 +1,432 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
+import collections
 import datetime
 import logging
 import os
-import os.path as op
+import queue
 import sys
 import pytz
+import threading
 import time
 import traceback
 
-from PIL import Image, ImageDraw, ImageFont
-
-from gpiozero import Button
-from waveshare_epd import epd2in7
+from PIL import Image, ImageDraw
+
+from FontRegistry import FontRegistry
+from GlyphAtlas import GlyphAtlas
+from NodeMetrics import NULL_METRICS
+from PageLayout import Custom, Line, PageTemplate, Text
+from SpiTransfer import SpiTransfer, partial_window_args
+
+STOCK_ROWS_PER_PAGE = 6  # 28 px rows on the 176 px high canvas
+# Sparkline of a stock row (third element of the row), at the right edge.
+SPARK_WIDTH = 40
+SPARK_HEIGHT = 20
+ROW_HEIGHT = 28
+CANVAS_SIZE = (264, 176)  # landscape
+SCROLL_BAR_BOX = (261, 0, 264, 176)
+
+
+def draw_sparkline(drawer, x, y, spark):
+    "spark: TickHistory.sparkline() columns. Min/max band per column, dotted reference line."
+    cols, ref_y = spark
+    if ref_y is not None:
+        for dx in range(0, len(cols), 3):
+            drawer.point((x + dx, y + ref_y), fill=0)
+    for dx, col in enumerate(cols):
+        if col is not None:
+            drawer.line([(x + dx, y + col[0]), (x + dx, y + col[1])], fill=0)
+
+
+def draw_scroll_bar(drawer, value, size):
+    "value: (page, pages). Where this page is in the list."
+    page, pages = value
+    top = page * size[1] // pages
+    bottom = (page + 1) * size[1] // pages - 1
+    drawer.rectangle([0, top, size[0] - 1, bottom], fill=0)
+
+
+def row_box(x0, x1, row, dy=4, h=ROW_HEIGHT):
+    return (x0, row * ROW_HEIGHT + dy, x1, row * ROW_HEIGHT + dy + h)
+
+
+# Pages, see PageLayout. Slot values are made by the render_* methods.
+FT24_PAGE = PageTemplate(
+    "ft24",
+    [
+        Text(row_box(10, 260, row), slot="row{0}".format(row), min_size=16)
+        for row in range(6)
+    ],
+)
+STOCK_PAGE = PageTemplate(
+    "stock",
+    [
+        Text(
+            row_box(10, 84, row),
+            slot="ticker{0}".format(row),
+            face="mono_bold",
+            min_size=16,
+        )
+        for row in range(STOCK_ROWS_PER_PAGE)
+    ]
+    + [
+        Text(row_box(85, 260, row), slot="price{0}".format(row), min_size=16)
+        for row in range(STOCK_ROWS_PER_PAGE)
+    ]
+    + [Custom("scroll", SCROLL_BAR_BOX, draw_scroll_bar)],
+)
+# Smaller text, to make room for the sparklines.
+SPARK_X = CANVAS_SIZE[0] - 4 - SPARK_WIDTH
+STOCK_SPARK_PAGE = PageTemplate(
+    "stock_spark",
+    [
+        Text(
+            row_box(4, 66, row, dy=6),
+            slot="ticker{0}".format(row),
+            face="mono_bold",
+            size=20,
+            min_size=14,
+        )
+        for row in range(STOCK_ROWS_PER_PAGE)
+    ]
+    + [
+        Text(
+            row_box(68, SPARK_X - 2, row, dy=6),
+            slot="price{0}".format(row),
+            size=20,
+            min_size=14,
+        )
+        for row in range(STOCK_ROWS_PER_PAGE)
+    ]
+    + [
+        Custom(
+            "spark{0}".format(row),
+            row_box(SPARK_X, SPARK_X + SPARK_WIDTH, row, h=SPARK_HEIGHT),
+            lambda drawer, spark, size: draw_sparkline(drawer, 0, 0, spark),
+        )
+        for row in range(STOCK_ROWS_PER_PAGE)
+    ]
+    + [Custom("scroll", SCROLL_BAR_BOX, draw_scroll_bar)],
+)
+WELCOME_PAGE = PageTemplate(
+    "welcome",
+    [
+        Text((10, 10, 260, 50), text="Fetching stocks", size=35),
+        Text((10, 65, 260, 93), slot="line0", face="mono_bold", min_size=16),
+        Text((10, 95, 260, 123), slot="line1", face="mono_bold", min_size=16),
+    ],
+)
+EXAMPLE_PAGE = PageTemplate(
+    "example",
+    [
+        Text((10, 0, 254, 29), text="Text mode, AB!"),
+        Line([(10, 29), (254, 29)]),
+        Text((10, 30, 254, 59), text="hello world, CD!", face="mono"),
+        Line([(10, 59), (254, 59)]),
+        Text((10, 60, 254, 90), text="Time for dinner!"),
+        Text((10, 90, 254, 120), text="Rainy: Yes"),
+        Text((10, 120, 254, 150), text="TODO: laundry", face="mono"),
+        Text((10, 150, 254, 176), text="Leetcode: 154"),
+    ],
+)
+POSTURE_PAGE = PageTemplate(
+    "posture",
+    [
+        Text((70, 0, 264, 80), text="UP!", face="mono_bold", size=80),
+        Text((10, 80, 264, 176), text="RIGHT", face="mono_bold", size=80),
+    ],
+)
+BUTTON_PAGE = PageTemplate(
+    "button", [Text((10, 10, 260, 40), slot="label", min_size=16)]
+)
+
+# kind: "press", "double" (second press inside the double-press window) or
+# "long" (still held after hold_time). t_press: time.monotonic() of the press.
+ButtonEvent = collections.namedtuple("ButtonEvent", ["key", "kind", "t_press"])
 
 
 class EpdHatButtonHandler(object):
-    def __init__(self):
-        "Deal with the button events."
+    def __init__(
+        self,
+        on_event=None,
+        bounce_time=0.05,
+        hold_time=1.0,
+        double_press_window=0.4,
+        button_factory=None,
+    ):
+        """Deal with the button events. Every press becomes a timestamped
+        ButtonEvent in a thread-safe queue, nothing is overwritten.
+        on_event(event): called from the gpiozero thread for every event, if
+        given. Otherwise consumers take events with get_event().
+        bounce_time: presses of the same key closer than this are contact bounce.
+        hold_time: a press held this long also gives a "long" event.
+        double_press_window: a press this soon after the previous one of the
+        same key is reported as "double".
+        button_factory(pin, hold_time=...): makes the buttons. None: gpiozero
+        Button on the real pins. EpdSimulator.FakeButtonSource for tests."""
         """Table:
         Key1 - GPIO5 - (29)
         Key2 - GPIO6 - (31)
         Key3 - GPIO13 - (33)
         Key4 - GPUI19 - (35)
         Ref: https://gpiozero.readthedocs.io/en/stable/recipes.html#button"""
-        self.btn1 = Button(5)
-        self.btn2 = Button(6)
-        self.btn3 = Button(13)
-        self.btn4 = Button(19)
+        if button_factory is None:
+            from gpiozero import Button as button_factory  # only on the Pi
+
+        self.btn1 = button_factory(5, hold_time=hold_time)
+        self.btn2 = button_factory(6, hold_time=hold_time)
+        self.btn3 = button_factory(13, hold_time=hold_time)
+        self.btn4 = button_factory(19, hold_time=hold_time)
         self.status_table = [0, 0, 0, 0]
-        # 0: not pressed, 1: pressed. Only 1 field can be 1.
+        # 0: not pressed, 1: pressed. Only 1 field can be 1. Kept for the old
+        # polling demos, the event queue is the lossless way.
+        self.on_event = on_event
+        self.bounce_time = bounce_time
+        self.double_press_window = double_press_window
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.last_press = [None, None, None, None]  # monotonic time per key
+        self.latencies = collections.deque(maxlen=256)  # press-to-handle, seconds
+        self.bounces = 0
 
         # Link events
-        self.btn1.when_pressed = self.set_btn1_status
-        self.btn2.when_pressed = self.set_btn2_status
-        self.btn3.when_pressed = self.set_btn3_status
-        self.btn4.when_pressed = self.set_btn4_status
-
-    def set_btn1_status(self):
-        self.status_table = [1, 0, 0, 0]
-
-    def set_btn2_status(self):
-        self.status_table = [0, 1, 0, 0]
-
-    def set_btn3_status(self):
-        self.status_table = [0, 0, 1, 0]
-
-    def set_btn4_status(self):
-        self.status_table = [0, 0, 0, 1]
+        for key, btn in enumerate([self.btn1, self.btn2, self.btn3, self.btn4], 1):
+            btn.when_pressed = lambda key=key: self.key_pressed(key)
+            btn.when_held = lambda key=key: self.key_held(key)
+
+    def key_pressed(self, key):
+        t_press = time.monotonic()
+        with self.lock:
+            last = self.last_press[key - 1]
+            if last is not None and t_press - last < self.bounce_time:
+                self.bounces += 1
+                return
+            self.last_press[key - 1] = t_press
+        if last is not None and t_press - last < self.double_press_window:
+            self.emit(ButtonEvent(key, "double", t_press))
+        else:
+            self.emit(ButtonEvent(key, "press", t_press))
+
+    def key_held(self, key):
+        with self.lock:
+            t_press = self.last_press[key - 1]
+        self.emit(ButtonEvent(key, "long", t_press))
+
+    def emit(self, event):
+        self.status_table = [int(event.key == k) for k in range(1, 5)]
+        if self.on_event is not None:
+            self.on_event(event)
+        else:
+            self.events.put(event)
+
+    def get_event(self, timeout=None):
+        "Next event from the queue, or None after timeout."
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def mark_handled(self, event):
+        "Call this after the event is handled, to record its press-to-handle latency."
+        with self.lock:
+            self.latencies.append(time.monotonic() - event.t_press)
+
+    def get_latency_stats(self):
+        with self.lock:
+            lat = sorted(self.latencies)
+        if len(lat) == 0:
+            return {"count": 0, "bounces": self.bounces}
+        return {
+            "count": len(lat),
+            "bounces": self.bounces,
+            "avg": sum(lat) / len(lat),
+            "p50": lat[len(lat) // 2],
+            "max": lat[-1],
+        }
 
     def clear_status(self):
-        "Call this after the event is handled."
+        "Call this after the event is handled. Only for the status_table polling."
         self.status_table = [0, 0, 0, 0]
 
 
+class FrameCache(object):
+    def __init__(self, max_bytes=256 * 1024):
+        "LRU of packed panel buffers, keyed by (page type, content...). Bounded by total bytes."
+        self.frames = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # pages are also packed ahead on other threads
+
+    def get(self, key):
+        with self.lock:
+            buf = self.frames.get(key)
+            if buf is None:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return buf
+
+    def __contains__(self, key):
+        "Lookup that does not count as a hit or miss."
+        with self.lock:
+            return key in self.frames
+
+    def put(self, key, buf):
+        if len(buf) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.frames:
+                self.used_bytes -= len(self.frames.pop(key))
+            self.frames[key] = buf
+            self.used_bytes += len(buf)
+            while self.used_bytes > self.max_bytes:
+                _, old_buf = self.frames.popitem(last=False)
+                self.used_bytes -= len(old_buf)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else None,
+                "entries": len(self.frames),
+                "bytes": self.used_bytes,
+            }
+
+
+def pack_1bit(image, width, height):
+    """Pack an image into the panel's 1-bit layout, byte-identical to the
+    vendor getbuffer(). width/height are the panel's (176, 264). A landscape
+    image is rotated like the vendor does. PIL rotates and packs the bits in C,
+    no per-pixel Python loop."""
+    mono = image.convert("1")
+    if mono.size == (height, width):
+        mono = mono.transpose(Image.ROTATE_90)
+    elif mono.size != (width, height):
+        return bytes([0xFF]) * (width // 8 * height)  # vendor: blank frame
+    return mono.tobytes()  # MSB first, 1 = white, same as the vendor buffer
+
+
+def pack_4gray(image, width, height):
+    """Pack an image into the panel's 2-bit (4 gray) layout, byte-identical to
+    the vendor getbuffer_4Gray(). Note the vendor transposes landscape images
+    here instead of rotating them."""
+    import numpy as np  # not on the 1-bit path, keeps numpy out of startup
+
+    gray = np.asarray(image.convert("L"))
+    if gray.shape == (width, height):
+        gray = gray.T
+    elif gray.shape != (height, width):
+        return bytes([0xFF]) * (width // 4 * height)
+    # Vendor remap: GRAY2 (0xC0) -> 0x80, GRAY3 (0x80) -> 0x40. Then the top 2 bits.
+    gray = np.where(gray == 0xC0, 0x80, np.where(gray == 0x80, 0x40, gray))
+    codes = (gray.astype(np.uint8) >> 6).reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+    return packed.astype(np.uint8).tobytes()
+
+
+def find_dirty_windows(old_buf, new_buf, row_bytes, merge_gap=8):
+    """Compare two packed frames (panel orientation, 1 bit per pixel) and return
+    the changed windows as (x0, y0, x1, y1), end exclusive. x is in pixels and
+    always a multiple of 8 (whole bytes). Changed rows closer than merge_gap are
+    merged into one window."""
+    windows = []
+    band = None  # [first byte col, first row, last byte col, last row]
+    for row in range(len(new_buf) // row_bytes):
+        lo = row * row_bytes
+        old_row = old_buf[lo : lo + row_bytes]
+        new_row = new_buf[lo : lo + row_bytes]
+        if old_row == new_row:
+            continue
+        cols = [c for c in range(row_bytes) if old_row[c] != new_row[c]]
+        if band is not None and row - band[3] <= merge_gap:
+            band[0] = min(band[0], cols[0])
+            band[2] = max(band[2], cols[-1])
+            band[3] = row
+        else:
+            if band is not None:
+                windows.append(band)
+            band = [cols[0], row, cols[-1], row]
+    if band is not None:
+        windows.append(band)
+    return [(c0 * 8, r0, (c1 + 1) * 8, r1 + 1) for c0, r0, c1, r1 in windows]
+
+
 class Display2In7Driver(object):
-    def __init__(self, node_id):
+    def __init__(
+        self,
+        node_id,
+        full_refresh_every=10,
+        partial_area_limit=0.5,
+        frame_cache_bytes=256 * 1024,
+        epd=None,
+        metrics=None,
+        clock_tz=None,
+        transfer=None,
+    ):
+        """epd: panel object with the waveshare epd2in7 API. None: the real
+        panel. EpdSimulator.SimulatedEPD runs the driver off the Pi.
+        full_refresh_every: force a full refresh after this many partial
+        updates, to clear the ghosting.
+        partial_area_limit: above this fraction of the panel area, a full
+        refresh is used instead of partial windows.
+        frame_cache_bytes: byte budget of the packed frame cache.
+        metrics: NodeMetrics for the render/pack/transfer timings.
+        clock_tz: time zone name of the clock page. None: the node's local time.
+        transfer: SpiTransfer the frames are uploaded with, in bulk SPI writes.
+        None: one over epdconfig on the real panel, the epd's own byte-wise
+        methods otherwise. False: always the epd's methods."""
         self.prj_dir = os.path.dirname(os.path.realpath(__file__))
         self.font_dir = os.path.join(self.prj_dir, "fonts")
         self.lib_dir = os.path.join(self.prj_dir, "lib")  # not used
 
         self.node_id = node_id
         self.canvas_id = 1  # incremental.
-        self.init_epd27()
+        self.full_refresh_every = full_refresh_every
+        self.partial_area_limit = partial_area_limit
+        self.partial_count = 0  # partial updates since the last full refresh
+        self.refresh_stats = {
+            "full": 0,
+            "partial": 0,
+            "full_seconds": 0.0,
+            "partial_seconds": 0.0,
+            "skipped": 0,  # frame already on the glass
+            "last_mode": None,
+            "last_seconds": 0.0,
+        }
+        self.frame_cache = FrameCache(frame_cache_bytes)
+        self.glass_page = None  # (plan, values, frame) last shown by show_plan
+        self.clock_atlas = None  # built on the first clock frame
+        self.clock_tz = None if clock_tz is None else pytz.timezone(clock_tz)
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.metrics.add_collector(self.collect_metrics)
+        self.init_epd27(epd, transfer)
         self.set_font()
         self.init_default_canvas()
 
-    def init_epd27(self):  # 27 here means 2.7 inches.
-        self.epd = epd2in7.EPD()
+    def init_epd27(self, epd=None, transfer=None):  # 27 here means 2.7 inches.
+        if epd is None:
+            from waveshare_epd import epd2in7, epdconfig  # only on the Pi
+
+            epd = epd2in7.EPD()
+            if transfer is None:
+                transfer = SpiTransfer(epdconfig, metrics=self.metrics)
+        self.epd = epd
+        self.transfer = transfer or None
         self.epd.init()
         self.width = self.epd.width  # 264
         self.height = self.epd.height  # 176
-        self.epd.Clear(0xFF)
+        self.row_bytes = self.width // 8
+        self.clean_screen()
 
     def set_font(self):
-        self.font18 = ImageFont.truetype(
-            op.join(self.font_dir, "LiberationSans-Regular.ttf"), 18
-        )
-        self.font24 = ImageFont.truetype(
-            op.join(self.font_dir, "LiberationSans-Regular.ttf"), 24
-        )  # 6 rows, 20 cols
-        self.font35 = ImageFont.truetype(
-            op.join(self.font_dir, "LiberationSans-Regular.ttf"), 35
-        )
-        self.font_mono_18 = ImageFont.truetype(
-            op.join(self.font_dir, "SourceCodePro-Regular.otf"), 18
-        )
-        self.font_mono_24 = ImageFont.truetype(
-            op.join(self.font_dir, "SourceCodePro-Regular.otf"), 24
-        )
-        self.font_mono_35 = ImageFont.truetype(
-            op.join(self.font_dir, "SourceCodePro-Regular.otf"), 35
-        )
-        self.font_mono_bold_18 = ImageFont.truetype(
-            op.join(self.font_dir, "SourceCodePro-Bold.otf"), 18
-        )
-        self.font_mono_bold_24 = ImageFont.truetype(
-            op.join(self.font_dir, "SourceCodePro-Bold.otf"), 24
-        )
-        self.font_mono_bold_35 = ImageFont.truetype(
-            op.join(self.font_dir, "SourceCodePro-Bold.otf"), 35
-        )
+        "Fonts are loaded on first use, see FontRegistry."
+        self.fonts = FontRegistry.shared(self.font_dir)
 
     def init_default_canvas(self):
         self.dft_image = Image.new("1", (self.height, self.width), 1)
@@ -108,7 +434,152 @@ class Display2In7Driver(object):
         self.dft_drawer = ImageDraw.Draw(self.dft_image)
 
     def clean_screen(self):
-        self.epd.Clear(0xFF)
+        if self.transfer is not None:
+            self.transfer.clear(self.row_bytes * self.height, 0xFF)
+        else:
+            self.epd.Clear(0xFF)
+        self.last_frame = bytes([0xFF]) * (self.row_bytes * self.height)
+        self.partial_count = 0
+
+    def pack_frame(self, canvas):
+        "Canvas to packed 1-bit panel buffer. Replaces epd.getbuffer()."
+        return pack_1bit(canvas, self.width, self.height)
+
+    def pack_frame_4gray(self, canvas):
+        "Canvas to packed 4-gray panel buffer. Replaces epd.getbuffer_4Gray()."
+        return pack_4gray(canvas, self.width, self.height)
+
+    def build_page(self, key, render):
+        "Render, pack and cache a page without showing it. Return the packed frame."
+        with self.metrics.timer("render"):
+            canvas = render()
+        with self.metrics.timer("pack"):
+            buf = self.pack_frame(canvas)
+        self.frame_cache.put(key, buf)
+        return buf
+
+    def show_plan(self, key, plan, values, full=False):
+        """Show a page of a PageLayout draw plan. The packed frame comes from the
+        frame cache, on a miss it is rendered, packed and cached.
+        key: (page type, content...). When the glass shows the previous page of
+        the same plan, the changed windows come from the plan's dirty boxes, no
+        frame diff."""
+        buf = self.frame_cache.get(key)
+        if buf is None:
+            buf = self.build_page(key, lambda: plan.render(values))
+        windows = None
+        if self.glass_page is not None:
+            old_plan, old_values, old_frame = self.glass_page
+            if old_plan is plan and old_frame is self.last_frame:
+                windows = plan.dirty_windows(
+                    old_values, values, (self.width, self.height)
+                )
+        self.show_buffer(buf, full, windows)
+        self.glass_page = (plan, values, self.last_frame)
+
+    def show_buffer(self, buf, full=False, windows=None):
+        """Push a packed frame. Only the changed windows are sent with a partial
+        update, unless a full refresh is due or asked for.
+        windows: the changed windows when the caller knows them (show_plan).
+        None: found by comparing with the last frame."""
+        if buf == self.last_frame and not full:
+            logging.debug("Frame already on the glass, skip the refresh.")
+            self.refresh_stats["skipped"] += 1
+            self.metrics.inc("epd_refreshes_total", mode="skipped")
+            return
+        if windows is None:
+            windows = find_dirty_windows(self.last_frame, buf, self.row_bytes)
+        dirty_area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in windows)
+        if (
+            full
+            or self.partial_count >= self.full_refresh_every
+            or dirty_area > self.partial_area_limit * self.width * self.height
+        ):
+            mode = "full"
+            t0 = time.perf_counter()
+            if self.transfer is not None:
+                self.transfer.display(buf)
+            else:
+                self.epd.display(buf)
+            self.partial_count = 0
+        else:
+            mode = "partial"
+            t0 = time.perf_counter()
+            for window in windows:
+                self.push_partial_window(buf, *window)
+            self.partial_count += 1
+        elapsed = time.perf_counter() - t0
+        self.last_frame = buf
+        self.refresh_stats[mode] += 1
+        self.refresh_stats[mode + "_seconds"] += elapsed
+        self.refresh_stats["last_mode"] = mode
+        self.refresh_stats["last_seconds"] = elapsed
+        self.metrics.observe("transfer_" + mode, elapsed)
+        self.metrics.inc("epd_refreshes_total", mode=mode)
+        logging.debug(
+            "{0} refresh, {1} window(s), {2:.2f} s".format(mode, len(windows), elapsed)
+        )
+
+    def push_partial_window(self, buf, x0, y0, x1, y1):
+        """Partial update of one window (panel orientation, x multiple of 8).
+        Uses the controller's partial transmission (0x15) and partial refresh
+        (0x16) commands, the vendor module only exposes full-frame updates."""
+        if self.transfer is not None:
+            self.transfer.partial_window(buf, x0, y0, x1, y1, self.row_bytes)
+            return
+        w = x1 - x0
+        window_args = partial_window_args(x0, y0, x1, y1)
+        self.epd.send_command(0x15)  # PARTIAL_DATA_START_TRANSMISSION_2
+        for arg in window_args:
+            self.epd.send_data(arg)
+        c0 = x0 // 8
+        for row in range(y0, y1):
+            lo = row * self.row_bytes + c0
+            for byte in buf[lo : lo + w // 8]:
+                self.epd.send_data(byte)
+        self.epd.send_command(0x16)  # PARTIAL_DISPLAY_REFRESH
+        for arg in window_args:
+            self.epd.send_data(arg)
+        self.epd.ReadBusy()
+
+    def get_refresh_stats(self):
+        "Refresh counts and times, with the average time saved by a partial update."
+        st = dict(self.refresh_stats)
+        for mode in ("full", "partial"):
+            st["avg_" + mode + "_seconds"] = (
+                st[mode + "_seconds"] / st[mode] if st[mode] > 0 else None
+            )
+        if st["avg_full_seconds"] is not None and st["avg_partial_seconds"] is not None:
+            st["saving_per_update_seconds"] = (
+                st["avg_full_seconds"] - st["avg_partial_seconds"]
+            )
+        else:
+            st["saving_per_update_seconds"] = None
+        return st
+
+    def get_transfer_stats(self):
+        "SpiTransfer bytes and times per frame, None on the epd's byte-wise path."
+        return None if self.transfer is None else self.transfer.get_stats()
+
+    def get_cache_stats(self):
+        "Frame cache hits/misses, plus the refreshes skipped because the frame was already shown."
+        st = self.frame_cache.stats()
+        st["glass_skips"] = self.refresh_stats["skipped"]
+        return st
+
+    def collect_metrics(self):
+        "Cache figures for NodeMetrics, read at export time."
+        cache = self.frame_cache.stats()
+        fonts = self.fonts.stats
+        font_lookups = fonts["font_hits"] + fonts["loads"]
+        font_hit_rate = fonts["font_hits"] / font_lookups if font_lookups > 0 else None
+        return [
+            ("cache_hit_ratio", {"cache": "frame"}, cache["hit_rate"]),
+            ("cache_entries", {"cache": "frame"}, cache["entries"]),
+            ("cache_bytes", {"cache": "frame"}, cache["bytes"]),
+            ("cache_hit_ratio", {"cache": "font"}, font_hit_rate),
+            ("partial_since_full", {}, self.partial_count),
+        ]
 
     def display_ft24_page(self, text_list):
         if len(text_list) < 1:
@@ -116,108 +587,145 @@ class Display2In7Driver(object):
             return
         elif len(text_list) > 6:
             logging.warning("List too long, will truncate.")
-        canvas = Image.new("1", (self.height, self.width), 1)
-        # 255: clear the frame
         self.canvas_id += 1
-        drawer = ImageDraw.Draw(canvas)
-        for row, txt in enumerate(text_list):
-            drawer.text((10, row * 28 + 4), txt, font=self.font24, fill=0)
-
-        self.epd.display(self.epd.getbuffer(canvas))
+        self.show_plan(
+            ("ft24", tuple(text_list)),
+            FT24_PAGE.plan(self.fonts),
+            self.ft24_values(text_list),
+        )
         # self.epd.sleep()
 
-    def display_stock_welcome_screen(self, stock_list):
+    def ft24_values(self, text_list):
+        return {"row{0}".format(row): txt for row, txt in enumerate(text_list[:6])}
+
+    def render_ft24_page(self, text_list):
+        return FT24_PAGE.plan(self.fonts).render(self.ft24_values(text_list))
+
+    def display_stock_welcome_screen(self, stock_list, full=False):
         "Make sure there is no white screen while fetching stocks."
         logging.info("Show STOCK module welcome screen.")
-        stock_welcome_img = Image.new("1", (self.height, self.width), 1)
-        sw_drawer = ImageDraw.Draw(stock_welcome_img)
-        sw_drawer.text((10, 10), "Fetching stocks", font=self.font35, fill=0)
-        sw_drawer.text(
-            (10, 65), " ".join(stock_list[:3]), font=self.font_mono_bold_24, fill=0
-        )
-        sw_drawer.text(
-            (10, 95), " ".join(stock_list[3:]), font=self.font_mono_bold_24, fill=0
+        self.show_plan(
+            ("welcome", tuple(stock_list)),
+            WELCOME_PAGE.plan(self.fonts),
+            self.welcome_values(stock_list),
+            full,
         )
-        self.epd.display(self.epd.getbuffer(stock_welcome_img))
 
-    def display_stock_ft24_page(self, text_list):
-        "Display stock. ticker uses mono font. Others use normal font. Input: list of tuple of text"
+    def welcome_values(self, stock_list):
+        second_line = " ".join(stock_list[3:6])
+        if len(stock_list) > 6:
+            second_line += " +{0}".format(len(stock_list) - 6)
+        return {"line0": " ".join(stock_list[:3]), "line1": second_line}
+
+    def render_stock_welcome_screen(self, stock_list):
+        return WELCOME_PAGE.plan(self.fonts).render(self.welcome_values(stock_list))
+
+    def stock_pages(self, text_list):
+        "Split the rows into pages of STOCK_ROWS_PER_PAGE."
+        n = STOCK_ROWS_PER_PAGE
+        return [tuple(text_list[i : i + n]) for i in range(0, len(text_list), n)]
+
+    def stock_page_key(self, rows, page, pages):
+        return ("stock", rows, page, pages)
+
+    def display_stock_ft24_page(self, text_list, page=0, full=False):
+        """Display stock. ticker uses mono font. Others use normal font. Input: list of tuple of text
+        Long lists are split in pages, page is taken modulo the page count.
+        full: full refresh instead of the changed windows."""
         if len(text_list) < 1:
             logging.warning("Empty text list.")
             return
-        elif len(text_list) > 6:
-            logging.warning("List too long, will truncate.")
-        canvas = Image.new("1", (self.height, self.width), 1)
-        # 255: clear the frame
+        pages = self.stock_pages(text_list)
+        page %= len(pages)
         self.canvas_id += 1
-        drawer = ImageDraw.Draw(canvas)
-        for row, txt in enumerate(text_list):
-            drawer.text((10, row * 28 + 4), txt[0], font=self.font_mono_bold_24, fill=0)
-            drawer.text((85, row * 28 + 4), txt[1], font=self.font24, fill=0)
-
-        self.epd.display(self.epd.getbuffer(canvas))
+        plan, values = self.stock_page_plan(pages[page], page, len(pages))
+        self.show_plan(
+            self.stock_page_key(pages[page], page, len(pages)), plan, values, full
+        )
         # self.epd.sleep()
 
+    def prerender_stock_pages(self, text_list):
+        """Render and pack every page of the list into the frame cache ahead of
+        time, so that flipping a page is only the panel transfer. A page is
+        only built again when one of its own rows changed (its cache key).
+        Meant for a background thread. Return the number of pages built."""
+        pages = self.stock_pages(text_list)
+        built = 0
+        for page, rows in enumerate(pages):
+            key = self.stock_page_key(rows, page, len(pages))
+            if key not in self.frame_cache:
+                self.build_page(
+                    key,
+                    lambda: self.render_stock_ft24_page(rows, page, len(pages)),
+                )
+                built += 1
+        return built
+
+    def stock_page_plan(self, text_list, page=0, pages=1):
+        """(draw plan, slot values) of a stock page. Rows with a sparkline (third
+        element) use the smaller layout."""
+        rows = text_list[:STOCK_ROWS_PER_PAGE]
+        spark = any(len(txt) > 2 for txt in rows)
+        values = {"scroll": (page, pages) if pages > 1 else None}
+        for row, txt in enumerate(rows):
+            values["ticker{0}".format(row)] = txt[0]
+            values["price{0}".format(row)] = txt[1]
+            if spark:
+                values["spark{0}".format(row)] = txt[2] if len(txt) > 2 else None
+        template = STOCK_SPARK_PAGE if spark else STOCK_PAGE
+        return template.plan(self.fonts), values
+
+    def render_stock_ft24_page(self, text_list, page=0, pages=1):
+        plan, values = self.stock_page_plan(text_list, page, pages)
+        return plan.render(values)
+
     def update_screen_example(self):
         logging.info("Draw an example")
-        Himage = Image.new("1", (self.height, self.width), 1)
-        # 1: white color
-        drawer = ImageDraw.Draw(Himage)
-        drawer.text((10, 0), "Text mode, AB!", font=self.font24, fill=0)
-        drawer.line([(10, 29), (254, 29)], fill=0)
-        drawer.text((10, 30), "hello world, CD!", font=self.font_mono_24, fill=0)
-        drawer.line([(10, 59), (254, 59)], fill=0)
-        drawer.text((10, 60), "Time for dinner!", font=self.font24, fill=0)
-        drawer.text((10, 90), "Rainy: Yes", font=self.font24, fill=0)
-        drawer.text((10, 120), "TODO: laundry", font=self.font_mono_24, fill=0)
-        drawer.text((10, 150), "Leetcode: 154", font=self.font24, fill=0)
-        self.epd.display(self.epd.getbuffer(Himage))
+        self.show_plan(("example",), EXAMPLE_PAGE.plan(self.fonts), {})
         # self.epd.sleep()
 
+    def render_screen_example(self):
+        return EXAMPLE_PAGE.plan(self.fonts).render({})
+
     def epd_exit(self):
         self.epd.Dev_exit()
-        epd2in7.epdconfig.module_exit()
-
-    def display_posture_reminder_sign(self):
-        pr_img = Image.new("1", (self.height, self.width), 1)
-        pr_drawer = ImageDraw.Draw(pr_img)
-        pr_font = ImageFont.truetype(
-            op.join(self.font_dir, "SourceCodePro-Bold.otf"), 80
-        )
+        epdconfig = sys.modules.get("waveshare_epd.epdconfig")
+        if epdconfig is not None:
+            epdconfig.module_exit()
 
-        pr_drawer.text((70, 0), "UP!", font=pr_font, fill=0)
-        pr_drawer.text((10, 80), "RIGHT", font=pr_font, fill=0)
+    def display_posture_reminder_sign(self, full=False):
+        self.show_plan(("posture",), POSTURE_PAGE.plan(self.fonts), {}, full)
 
-        self.epd.display(self.epd.getbuffer(pr_img))
+    def render_posture_reminder_sign(self):
+        return POSTURE_PAGE.plan(self.fonts).render({})
 
-    def debug_button_press_display(self, pressed_btn_idx):
+    def debug_button_press_display(self, pressed_btn_idx, full=False):
         "Show the press event on the screen."
-        ind_img = Image.new("1", (self.height, self.width), 1)
-        ind_drawer = ImageDraw.Draw(ind_img)
-        ind_drawer.text(
-            (10, 10),
-            "Button {0} pressed".format(pressed_btn_idx),
-            font=self.font24,
-            fill=0,
+        self.show_plan(
+            ("button", pressed_btn_idx),
+            BUTTON_PAGE.plan(self.fonts),
+            {"label": "Button {0} pressed".format(pressed_btn_idx)},
+            full,
         )
-        self.epd.display(self.epd.getbuffer(ind_img))
 
-    def display_clock_current_time(self):
-
-        clk_img = Image.new("1", (self.height, self.width), 1)
-        clk_drawer = ImageDraw.Draw(clk_img)
-        clk_font = ImageFont.truetype(
-            op.join(self.font_dir, "LiberationSans-Regular.ttf"), 100
+    def render_button_press(self, pressed_btn_idx):
+        return BUTTON_PAGE.plan(self.fonts).render(
+            {"label": "Button {0} pressed".format(pressed_btn_idx)}
         )
 
-        timestamp = datetime.datetime.now(pytz.timezone('US/Pacific'))
-        clk_drawer.text(
-            (5, 0),
-            "{0:02d}:{1:02d}".format(timestamp.hour, timestamp.minute),
-            font=clk_font,
-            fill=0,
-        )
-        self.epd.display(self.epd.getbuffer(clk_img))
+    def display_clock_current_time(self, full=False):
+        "Clock frames are composed from the glyph atlas. Only the changed digits go out as partial updates."
+        if self.clock_atlas is None:
+            self.clock_atlas = GlyphAtlas(
+                self.fonts.get("sans", 100),
+                origin=(5, 0),
+                panel_size=(self.width, self.height),
+            )
+        timestamp = datetime.datetime.now(self.clock_tz)
+        hhmm = "{0:02d}:{1:02d}".format(timestamp.hour, timestamp.minute)
+        with self.metrics.timer("render_clock"):
+            buf = self.clock_atlas.compose(hhmm)
+        self.show_buffer(buf, full)
 
 
 """
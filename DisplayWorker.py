@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+
+from NodeMetrics import NULL_METRICS
+
+
+class DisplayWorker(object):
+    def __init__(self, name="epd-display", metrics=None):
+        """Runs the render + panel transfer calls on a dedicated thread, so a
+        multi-second refresh never blocks input or fetching.
+        There is one pending slot: a new frame replaces the one still waiting
+        (latest wins), the replaced one is counted as dropped. A replaced full
+        refresh is not lost, the frame that replaces it is drawn full.
+        metrics: NodeMetrics, gets the input-to-screen latency of every frame."""
+        self.slot = None  # (func, args, full, t_input, label)
+        self.busy = False
+        self.cond = threading.Condition()
+        self.running = True
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.stats = {
+            "submitted": 0,
+            "shown": 0,
+            "dropped": 0,
+            "errors": 0,
+            "latency_sum": 0.0,
+            "latency_max": 0.0,
+            "last_latency": None,
+        }
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, full=False, t_input=None, label=None):
+        """Queue func(*args) as the next frame. t_input: time.monotonic() of the
+        input that caused it (default: now), for the input-to-screen latency.
+        full: the frame needs a full refresh, func is called with full=True.
+        It also carries over to a frame replacing this one before it is drawn,
+        so every func submitted next to full frames takes a full keyword."""
+        t_input = time.monotonic() if t_input is None else t_input
+        with self.cond:
+            self.stats["submitted"] += 1
+            if self.slot is not None:
+                self.stats["dropped"] += 1
+                self.metrics.inc("display_dropped_frames_total")
+                logging.debug("Drop stale frame: {0}".format(self.slot[4]))
+                full = full or self.slot[2]
+            self.slot = (func, args, full, t_input, label or func.__name__)
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and self.slot is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                func, args, full, t_input, label = self.slot
+                self.slot = None
+                self.busy = True
+            try:
+                if full:
+                    func(*args, full=True)
+                else:
+                    func(*args)
+            except Exception:
+                logging.exception("Display job failed: {0}".format(label))
+                with self.cond:
+                    self.stats["errors"] += 1
+                self.metrics.inc("display_errors_total")
+            else:
+                latency = time.monotonic() - t_input
+                self.metrics.observe("display_latency", latency)
+                with self.cond:
+                    self.stats["shown"] += 1
+                    self.stats["latency_sum"] += latency
+                    self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+                    self.stats["last_latency"] = latency
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        "Block until nothing is pending or being drawn. Return False on timeout."
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.slot is None and not self.busy, timeout
+            )
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+    def get_stats(self):
+        with self.cond:
+            st = dict(self.stats)
+        st["avg_latency"] = st["latency_sum"] / st["shown"] if st["shown"] > 0 else None
+        return st
@@ -0,0 +1,373 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+from PIL import Image
+
+# Panel geometry of the 2.7 inch HAT, native (portrait) orientation.
+EPD_WIDTH = 176
+EPD_HEIGHT = 264
+
+
+class SimulatedEPD(object):
+    def __init__(
+        self,
+        full_refresh_seconds=6.0,
+        partial_refresh_seconds=0.3,
+        gray_refresh_seconds=6.0,
+        time_scale=0.0,
+        record_dir=None,
+        max_frames=64,
+    ):
+        """Headless stand-in for waveshare_epd.epd2in7.EPD, same methods.
+        It keeps the controller RAM and the glass as packed buffers, and it
+        understands the commands the driver sends byte by byte (full frame
+        0x10/0x13/0x12, partial window 0x15/0x16).
+        *_refresh_seconds: refresh times of the real panel. Each refresh adds
+        them to busy_seconds, and sleeps them times time_scale (0: instant,
+        1: real time).
+        record_dir: if given, every refresh is saved there as PNG.
+        max_frames: refreshes kept in memory, see frames."""
+        self.width = EPD_WIDTH
+        self.height = EPD_HEIGHT
+        self.GRAY1 = 0xFF  # white
+        self.GRAY2 = 0xC0
+        self.GRAY3 = 0x80  # gray
+        self.GRAY4 = 0x00  # blackest
+        self.row_bytes = self.width // 8
+        self.frame_bytes = self.row_bytes * self.height
+        self.timings = {
+            "full": full_refresh_seconds,
+            "partial": partial_refresh_seconds,
+            "gray": gray_refresh_seconds,
+        }
+        self.time_scale = time_scale
+        self.record_dir = record_dir
+        self.ram = bytearray([0xFF]) * self.frame_bytes
+        self.glass = bytes(self.ram)
+        self.frames = collections.deque(maxlen=max_frames)  # (mode, glass, time)
+        self.counts = {"full": 0, "partial": 0, "gray": 0}
+        self.busy_seconds = 0.0  # simulated panel time
+        self.busy_until = 0.0  # monotonic, for the busy pin
+        # Refreshes return when done, like the vendor methods. MockSpiLink
+        # clears it: the host waits on the busy pin.
+        self.wait_refresh = True
+        self.bytes_received = 0  # over the byte-wise interface
+        self.lock = threading.Lock()
+        # Controller state for send_command/send_data
+        self.command = None
+        self.args = bytearray()
+        self.data_pos = 0
+        if record_dir is not None:
+            os.makedirs(record_dir, exist_ok=True)
+
+    # Vendor API
+    def init(self):
+        return 0
+
+    def Init_4Gray(self):
+        return 0
+
+    def getbuffer(self, image):
+        from Display2In7Driver import pack_1bit
+
+        return pack_1bit(image, self.width, self.height)
+
+    def getbuffer_4Gray(self, image):
+        from Display2In7Driver import pack_4gray
+
+        return pack_4gray(image, self.width, self.height)
+
+    def display(self, image):
+        self.ram[:] = bytes(image)[: self.frame_bytes]
+        self.refresh("full", bytes(self.ram))
+
+    def display_4Gray(self, image):
+        # Only the top bit of each 2-bit code is kept for the 1-bit glass.
+        self.refresh("gray", self.gray_to_mono(bytes(image)))
+
+    def Clear(self, color=0xFF):
+        self.ram[:] = bytes([color]) * self.frame_bytes
+        self.refresh("full", bytes(self.ram))
+
+    def ReadBusy(self):
+        wait = self.busy_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def sleep(self):
+        pass
+
+    def Dev_exit(self):
+        pass
+
+    def send_command(self, command):
+        self.command = command
+        self.args = bytearray()
+        self.data_pos = 0
+        if command == 0x12:  # DISPLAY_REFRESH
+            self.refresh("full", bytes(self.ram))
+
+    def send_data(self, data):
+        self.bytes_received += 1
+        if self.command == 0x13:  # DATA_START_TRANSMISSION_2: new frame
+            if self.data_pos < self.frame_bytes:
+                self.ram[self.data_pos] = data
+            self.data_pos += 1
+        elif self.command == 0x15:  # PARTIAL_DATA_START_TRANSMISSION_2
+            if len(self.args) < 8:
+                self.args.append(data)
+                return
+            x, y, w, l = self.window()
+            row, col = divmod(self.data_pos, w // 8)
+            if row < l:
+                self.ram[(y + row) * self.row_bytes + x // 8 + col] = data
+            self.data_pos += 1
+        elif self.command == 0x16:  # PARTIAL_DISPLAY_REFRESH
+            self.args.append(data)
+            if len(self.args) == 8:
+                x, y, w, l = self.window()
+                glass = bytearray(self.glass)
+                for row in range(y, y + l):
+                    lo = row * self.row_bytes + x // 8
+                    glass[lo : lo + w // 8] = self.ram[lo : lo + w // 8]
+                self.refresh("partial", bytes(glass))
+        # 0x10 (old frame) and the init/LUT commands do not change the glass.
+
+    # Simulator
+    def window(self):
+        "(x, y, w, l) from the 8 argument bytes of 0x15/0x16."
+        a = self.args
+        return (
+            (a[0] << 8 | a[1]) & 0xFFF8,
+            a[2] << 8 | a[3],
+            (a[4] << 8 | a[5]) & 0xFFF8,
+            a[6] << 8 | a[7],
+        )
+
+    def refresh(self, mode, glass):
+        seconds = self.timings[mode]
+        with self.lock:
+            self.glass = glass
+            self.counts[mode] += 1
+            self.busy_seconds += seconds
+            self.frames.append((mode, glass, time.time()))
+            frame_no = sum(self.counts.values())
+        self.busy_until = time.monotonic() + seconds * self.time_scale
+        if self.time_scale > 0 and self.wait_refresh:
+            self.ReadBusy()
+        if self.record_dir is not None:
+            path = os.path.join(
+                self.record_dir, "frame_{0:05d}_{1}.png".format(frame_no, mode)
+            )
+            self.to_image(glass).save(path)
+        logging.debug("Simulated {0} refresh ({1:.2f} s)".format(mode, seconds))
+
+    def gray_to_mono(self, buf):
+        mono = bytearray(self.frame_bytes)
+        for i in range(self.frame_bytes):
+            hi, lo = buf[2 * i], buf[2 * i + 1]
+            bits = 0
+            for k in range(4):
+                bits |= ((hi >> (7 - 2 * k)) & 1) << (7 - k)
+                bits |= ((lo >> (7 - 2 * k)) & 1) << (3 - k)
+            mono[i] = bits
+        return bytes(mono)
+
+    def to_image(self, buf=None):
+        "Packed buffer (default: the glass) as a landscape PIL image."
+        buf = self.glass if buf is None else buf
+        portrait = Image.frombytes("1", (self.width, self.height), bytes(buf))
+        return portrait.transpose(Image.ROTATE_270)
+
+    def get_stats(self):
+        with self.lock:
+            st = dict(self.counts)
+            st["busy_seconds"] = self.busy_seconds
+            st["bytes_received"] = self.bytes_received
+        return st
+
+
+class MockSpiLink(object):
+    # HAT pins (BCM), as in epdconfig
+    RST_PIN = 17
+    DC_PIN = 25
+    CS_PIN = 8
+    BUSY_PIN = 24
+
+    def __init__(self, epd=None):
+        """Stand-in for waveshare_epd.epdconfig, the bus under the EPD. Every
+        byte written while CS is low is recorded with its DC level, and fed
+        to epd, a SimulatedEPD that plays the controller and drives the busy
+        pin (None: a new one).
+        stream(): (DC levels, bytes) so far, to compare two transfer paths."""
+        self.epd = SimulatedEPD() if epd is None else epd
+        self.epd.wait_refresh = False
+        self.pins = {self.RST_PIN: 1, self.DC_PIN: 0, self.CS_PIN: 1}
+        self.dc = bytearray()
+        self.data = bytearray()
+        self.writes = 0  # SPI write calls
+        self.pin_writes = 0
+
+    # epdconfig API
+    def digital_write(self, pin, value):
+        self.pins[pin] = value
+        self.pin_writes += 1
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:  # 0: busy
+            return 0 if self.epd.busy_until > time.monotonic() else 1
+        return self.pins.get(pin, 0)
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0)
+
+    def spi_writebyte(self, data):
+        self.transfer(data)
+
+    def spi_writebyte2(self, data):
+        self.transfer(data)
+
+    # Simulator
+    def transfer(self, data):
+        self.writes += 1
+        if self.pins[self.CS_PIN] != 0:
+            return  # not selected
+        data = bytes(data)
+        dc = self.pins[self.DC_PIN]
+        self.dc += bytes([dc]) * len(data)
+        self.data += data
+        for byte in data:
+            if dc:
+                self.epd.send_data(byte)
+            else:
+                self.epd.send_command(byte)
+
+    def wait_for_idle(self, timeout):
+        "Edge wait on the busy pin: returns when it rises, or after timeout."
+        wait = min(timeout, self.epd.busy_until - time.monotonic())
+        if wait > 0:
+            time.sleep(wait)
+
+    def stream(self):
+        return bytes(self.dc), bytes(self.data)
+
+    def reset_counts(self):
+        "Forget the stream and the call counts."
+        self.dc = bytearray()
+        self.data = bytearray()
+        self.writes = 0
+        self.pin_writes = 0
+
+
+class VendorSpiEPD(object):
+    def __init__(self, link):
+        """The byte-wise transfer path of waveshare_epd.epd2in7.EPD (send_command,
+        send_data, display, Clear, ReadBusy) on an epdconfig-like link, e.g.
+        MockSpiLink: the reference the bulk SpiTransfer is checked against off
+        the Pi. init() skips the reset and the LUT upload."""
+        self.link = link
+        self.width = EPD_WIDTH
+        self.height = EPD_HEIGHT
+
+    def init(self):
+        return 0
+
+    def send_command(self, command):
+        self.link.digital_write(self.link.DC_PIN, 0)
+        self.link.digital_write(self.link.CS_PIN, 0)
+        self.link.spi_writebyte([command])
+        self.link.digital_write(self.link.CS_PIN, 1)
+
+    def send_data(self, data):
+        self.link.digital_write(self.link.DC_PIN, 1)
+        self.link.digital_write(self.link.CS_PIN, 0)
+        self.link.spi_writebyte([data])
+        self.link.digital_write(self.link.CS_PIN, 1)
+
+    def ReadBusy(self):
+        while self.link.digital_read(self.link.BUSY_PIN) == 0:  # 0: busy
+            self.link.delay_ms(200)
+
+    def display(self, image):
+        self.send_command(0x10)
+        for i in range(0, int(self.width * self.height / 8)):
+            self.send_data(0xFF)
+        self.send_command(0x13)
+        for i in range(0, int(self.width * self.height / 8)):
+            self.send_data(image[i])
+        self.send_command(0x12)
+        self.ReadBusy()
+
+    def Clear(self, color=0xFF):
+        self.display(bytes([color]) * (self.width * self.height // 8))
+
+    def sleep(self):
+        pass
+
+    def Dev_exit(self):
+        pass
+
+
+class FakeButton(object):
+    def __init__(self, pin, hold_time=1.0):
+        "Scriptable stand-in for gpiozero.Button. Only what EpdHatButtonHandler uses."
+        self.pin = pin
+        self.hold_time = hold_time
+        self.when_pressed = None
+        self.when_held = None
+        self.is_pressed = False
+
+    def press(self):
+        self.is_pressed = True
+        if self.when_pressed is not None:
+            self.when_pressed()
+
+    def release(self):
+        self.is_pressed = False
+
+    def hold(self):
+        "Press and keep it down past hold_time, without waiting."
+        self.press()
+        if self.when_held is not None:
+            self.when_held()
+        self.release()
+
+
+class FakeButtonSource(object):
+    # GPIO pin of each HAT key, see EpdHatButtonHandler
+    KEY_PINS = {1: 5, 2: 6, 3: 13, 4: 19}
+
+    def __init__(self):
+        "Button factory for EpdHatButtonHandler(button_factory=...), with a scripted player."
+        self.buttons = {}  # pin -> FakeButton
+
+    def __call__(self, pin, hold_time=1.0):
+        self.buttons[pin] = FakeButton(pin, hold_time)
+        return self.buttons[pin]
+
+    def key(self, key):
+        return self.buttons[self.KEY_PINS[key]]
+
+    def play(self, script, background=True):
+        """Play [(delay seconds, key, action)], action is "press" or "hold".
+        Delays are relative to the previous step."""
+
+        def run():
+            for delay, key, action in script:
+                time.sleep(delay)
+                button = self.key(key)
+                if action == "hold":
+                    button.hold()
+                else:
+                    button.press()
+                    button.release()
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, name="fake-buttons", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,81 @@
+import collections
+import os.path as op
+import threading
+import time
+
+from PIL import ImageFont
+
+# Face name -> file in the fonts directory
+FONT_FACES = {
+    "sans": "LiberationSans-Regular.ttf",
+    "mono": "SourceCodePro-Regular.otf",
+    "mono_bold": "SourceCodePro-Bold.otf",
+}
+
+
+class FontRegistry(object):
+    _shared = {}  # font_dir -> registry, see shared()
+
+    def __init__(self, font_dir, max_fonts=16, max_measurements=1024):
+        """ImageFont instances keyed by (face, size). Loaded on first use, least
+        recently used ones are dropped beyond max_fonts. Text measurements are
+        cached the same way, up to max_measurements."""
+        self.font_dir = font_dir
+        self.max_fonts = max_fonts
+        self.max_measurements = max_measurements
+        self.fonts = collections.OrderedDict()
+        self.measurements = collections.OrderedDict()
+        self.lock = threading.Lock()  # renders may run on other threads
+        self.stats = {
+            "loads": 0,
+            "load_seconds": 0.0,
+            "font_hits": 0,
+            "measure_hits": 0,
+            "measure_misses": 0,
+        }
+
+    @classmethod
+    def shared(cls, font_dir):
+        "One registry per font directory, shared by every driver in the process."
+        if font_dir not in cls._shared:
+            cls._shared[font_dir] = cls(font_dir)
+        return cls._shared[font_dir]
+
+    def get(self, face, size):
+        key = (face, size)
+        with self.lock:
+            font = self.fonts.get(key)
+            if font is not None:
+                self.fonts.move_to_end(key)
+                self.stats["font_hits"] += 1
+                return font
+        t0 = time.perf_counter()
+        font = ImageFont.truetype(op.join(self.font_dir, FONT_FACES[face]), size)
+        with self.lock:
+            self.stats["loads"] += 1
+            self.stats["load_seconds"] += time.perf_counter() - t0
+            self.fonts[key] = font
+            while len(self.fonts) > self.max_fonts:
+                self.fonts.popitem(last=False)
+        return font
+
+    def measure(self, text, face, size):
+        "Bounding box (left, top, right, bottom) of the text drawn at (0, 0)."
+        key = (text, face, size)
+        with self.lock:
+            bbox = self.measurements.get(key)
+            if bbox is not None:
+                self.measurements.move_to_end(key)
+                self.stats["measure_hits"] += 1
+                return bbox
+        bbox = self.get(face, size).getbbox(text)
+        with self.lock:
+            self.stats["measure_misses"] += 1
+            self.measurements[key] = bbox
+            while len(self.measurements) > self.max_measurements:
+                self.measurements.popitem(last=False)
+        return bbox
+
+    def text_width(self, text, face, size):
+        left, _, right, _ = self.measure(text, face, size)
+        return right - left
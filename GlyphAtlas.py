@@ -0,0 +1,50 @@
+from PIL import Image, ImageDraw
+
+
+class GlyphAtlas(object):
+    def __init__(self, font, chars="0123456789:", origin=(5, 0), panel_size=(176, 264)):
+        """Glyphs rasterized once and stored already packed in panel orientation
+        (1 bit per pixel, rotated like pack_1bit), as whole panel rows. A line of
+        text is then made by joining bytes, without PIL drawing or packing.
+        font: ImageFont used for every glyph.
+        origin: (x, y) of the text on the landscape canvas.
+        panel_size: (width, height) of the panel, native orientation."""
+        self.width, self.height = panel_size
+        self.row_bytes = self.width // 8
+        self.origin = origin
+        ascent, descent = font.getmetrics()
+        # Cell height on the canvas = cell width in panel rows. Round it up to
+        # whole bytes so that every glyph row is a plain byte slice.
+        self.cell_bytes = min(self.row_bytes, -(-(origin[1] + ascent + descent) // 8))
+        cell_h = self.cell_bytes * 8
+        self.glyphs = {}  # char -> whole panel rows, see compose()
+        pad = bytes([0xFF]) * (self.row_bytes - self.cell_bytes)
+        cb = self.cell_bytes
+        for ch in chars:
+            advance = int(round(font.getlength(ch)))
+            cell = Image.new("1", (advance, cell_h), 1)
+            ImageDraw.Draw(cell).text((0, origin[1]), ch, font=font, fill=0)
+            packed = cell.transpose(Image.ROTATE_90).tobytes()
+            self.glyphs[ch] = b"".join(
+                packed[r * cb : (r + 1) * cb] + pad for r in range(advance)
+            )
+        self.blank_row = bytes([0xFF]) * self.row_bytes
+
+    def compose(self, text):
+        """Packed panel frame with the text at the origin. Glyphs past the panel
+        edge are clipped.
+        Canvas column x lands on panel row height - 1 - x, so the text runs
+        backwards down the panel: the frame is the glyph blocks joined in
+        reverse order, between blank rows."""
+        blocks = [self.glyphs[ch] for ch in reversed(text)]
+        text_rows = sum(len(b) for b in blocks) // self.row_bytes
+        head_rows = self.height - self.origin[0] - text_rows
+        body = b"".join(blocks)
+        if head_rows < 0:
+            body = body[-head_rows * self.row_bytes :]
+            head_rows = 0
+        return (
+            self.blank_row * head_rows
+            + body
+            + self.blank_row * min(self.origin[0], self.height)
+        )
@@ -0,0 +1,189 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (s) of the latency histogram buckets, from a cached frame (~1 ms)
+# to a slow upstream fetch. +Inf is implicit.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        "Cumulative-on-export latency histogram, Prometheus style."
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one: +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _NullTimer(object):
+    "Shared no-op context manager, what timer() returns when metrics are off."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _StageTimer(object):
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+class NodeMetrics(object):
+    def __init__(self, enabled=True, prefix="tps_epd"):
+        """Per-stage latency histograms and event counters of one node.
+        Modules take a NodeMetrics and call timer()/observe()/inc(). When
+        disabled these return at once, so the instrumentation can stay in.
+        Values owned by other objects (cache hit rates, worker stats) are not
+        copied on every event: add_collector() reads them at export time."""
+        self.enabled = enabled
+        self.prefix = prefix
+        self.histograms = {}  # stage -> Histogram
+        self.counters = {}  # (name, ((label, value), ...)) -> number
+        self.collectors = []  # functions returning [(name, labels, value)]
+        self.lock = threading.Lock()
+
+    def timer(self, stage):
+        "Context manager, records the wall time of its block under stage."
+        if not self.enabled:
+            return NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_collector(self, func):
+        """func() -> [(name, {label: value}, number)], called at export time.
+        None values are left out."""
+        if self.enabled:
+            self.collectors.append(func)
+
+    def get_stats(self):
+        "Snapshot: {stage: {count, sum, avg}} and the counters."
+        with self.lock:
+            stages = {
+                stage: {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "avg": h.sum / h.count if h.count > 0 else None,
+                }
+                for stage, h in self.histograms.items()
+            }
+            counters = dict(self.counters)
+        return {"stages": stages, "counters": counters}
+
+    def render_prometheus(self):
+        "All metrics in the Prometheus text exposition format."
+        lines = []
+        name = self.prefix + "_stage_seconds"
+        lines.append("# TYPE {0} histogram".format(name))
+        with self.lock:
+            for stage in sorted(self.histograms):
+                hist = self.histograms[stage]
+                cumulative = 0
+                for bound, count in zip(self.buckets_le(hist), hist.counts):
+                    cumulative += count
+                    lines.append(
+                        '{0}_bucket{{stage="{1}",le="{2}"}} {3}'.format(
+                            name, stage, bound, cumulative
+                        )
+                    )
+                lines.append('{0}_sum{{stage="{1}"}} {2}'.format(name, stage, hist.sum))
+                lines.append(
+                    '{0}_count{{stage="{1}"}} {2}'.format(name, stage, hist.count)
+                )
+            values = dict(self.counters)
+        for func in self.collectors:
+            try:
+                for metric, labels, value in func():
+                    if value is not None:
+                        values[(metric, tuple(sorted(labels.items())))] = value
+            except Exception:
+                logging.exception("Metrics collector failed")
+        for (metric, labels), value in sorted(values.items()):
+            label_text = ",".join('{0}="{1}"'.format(k, v) for k, v in labels)
+            lines.append(
+                "{0}_{1}{2} {3}".format(
+                    self.prefix,
+                    metric,
+                    "{" + label_text + "}" if len(label_text) > 0 else "",
+                    value,
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def buckets_le(hist):
+        return [str(b) for b in hist.buckets] + ["+Inf"]
+
+    def write_file(self, path):
+        "Write the text format to path atomically, e.g. for the node_exporter textfile collector."
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape is too much
+
+
+def start_metrics_server(metrics, port=9464, host="127.0.0.1"):
+    "Serve /metrics on a daemon thread. Return the server, shutdown() stops it."
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info("Metrics on http://{0}:{1}/metrics".format(host, server.server_port))
+    return server
+
+
+# Default of the instrumented modules: everything off, near-zero cost.
+NULL_METRICS = NodeMetrics(enabled=False)
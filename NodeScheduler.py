@@ -0,0 +1,103 @@
+import collections
+import heapq
+import logging
+import threading
+import time
+
+
+class NodeScheduler(object):
+    def __init__(self):
+        """Timed jobs in a priority queue, plus input events posted from other
+        threads. The loop sleeps until the next deadline or event, no polling."""
+        self.jobs = []  # heap of [deadline (monotonic), seq, name, func, interval]
+        self.seq = 0  # tie breaker, keeps FIFO order for equal deadlines
+        self.events = collections.deque()
+        self.cond = threading.Condition()
+        self.wakeups = 0
+        self.t_start = time.monotonic()
+        self.running = True
+
+    def call_later(self, delay, name, func, interval=None):
+        """Run func() after delay seconds, then every interval seconds if given.
+        A pending job with the same name is replaced."""
+        with self.cond:
+            self._cancel(name)
+            self._push(time.monotonic() + delay, name, func, interval)
+            self.cond.notify()
+
+    def is_pending(self, name):
+        with self.cond:
+            return any(job[2] == name for job in self.jobs)
+
+    def cancel(self, name):
+        with self.cond:
+            self._cancel(name)
+
+    def _cancel(self, name):
+        kept = [job for job in self.jobs if job[2] != name]
+        if len(kept) != len(self.jobs):
+            self.jobs = kept
+            heapq.heapify(self.jobs)
+
+    def _push(self, deadline, name, func, interval):
+        heapq.heappush(self.jobs, [deadline, self.seq, name, func, interval])
+        self.seq += 1
+
+    def post_event(self, event):
+        "Thread-safe, meant for input callbacks. Wakes the loop right away."
+        with self.cond:
+            self.events.append(event)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def run_pending(self, on_event):
+        """Sleep until the next deadline or event, then hand the events to
+        on_event(event) and run the due jobs, in this order."""
+        with self.cond:
+            while self.running and len(self.events) == 0:
+                if len(self.jobs) > 0:
+                    timeout = self.jobs[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                else:
+                    timeout = None
+                self.cond.wait(timeout)
+                self.wakeups += 1
+            events = list(self.events)
+            self.events.clear()
+            due = []
+            now = time.monotonic()
+            while len(self.jobs) > 0 and self.jobs[0][0] <= now:
+                deadline, _, name, func, interval = heapq.heappop(self.jobs)
+                due.append((name, func))
+                if interval is not None:
+                    # Keep the period, but do not try to catch up missed runs.
+                    next_deadline = deadline + interval
+                    if next_deadline <= now:
+                        next_deadline = now + interval
+                    self._push(next_deadline, name, func, interval)
+
+        for event in events:
+            on_event(event)
+        for name, func in due:
+            logging.debug("Run job: {0}".format(name))
+            func()
+
+    def run_forever(self, on_event):
+        while self.running:
+            self.run_pending(on_event)
+
+    def wakeups_per_hour(self):
+        hours = (time.monotonic() - self.t_start) / 3600
+        return self.wakeups / hours if hours > 0 else 0.0
+
+
+def seconds_to_next_minute(every=1):
+    "Seconds until the next wall-clock minute that is a multiple of every."
+    now = time.time()
+    period = 60 * every
+    return period - now % period
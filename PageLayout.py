@@ -0,0 +1,211 @@
+import threading
+
+from PIL import Image, ImageDraw
+
+ELLIPSIS = "…"  # end of text cut to fit, in every FONT_FACES font
+
+
+class Text(object):
+    def __init__(
+        self,
+        box,
+        text=None,
+        slot=None,
+        face="sans",
+        size=24,
+        min_size=None,
+        align="left",
+    ):
+        """Text in box (x0, y0, x1, y1) of the canvas, end exclusive, drawn at
+        its top left corner like ImageDraw.text.
+        text: static text, drawn once when the template is compiled.
+        slot: name of the value a render fills in instead (dynamic text).
+        size: font size. Text too wide for the box is drawn smaller, down to
+        min_size (None: size), on the same baseline. Still too wide at min_size,
+        it is cut and ends with an ellipsis.
+        align: "left", "right" or "center" in the box."""
+        self.box = box
+        self.text = text
+        self.slot = slot
+        self.face = face
+        self.size = size
+        self.min_size = size if min_size is None else min_size
+        self.align = align
+
+
+class Line(object):
+    def __init__(self, xy, width=1):
+        "Static line through the points xy, like ImageDraw.line."
+        self.xy = xy
+        self.width = width
+
+
+class Custom(object):
+    def __init__(self, slot, box, draw):
+        """Dynamic drawing in box, e.g. a sparkline.
+        draw(drawer, value, size): draws value on an empty image of the box size,
+        (0, 0) is the top left of the box. Not called when the value is None."""
+        self.slot = slot
+        self.box = box
+        self.draw = draw
+
+
+class PageTemplate(object):
+    def __init__(self, name, elements, size=(264, 176)):
+        """A page declared as static elements (Text without slot, Line) and
+        dynamic slots (Text with slot, Custom). Dynamic boxes must not overlap
+        each other or static elements: a render clears the whole box.
+        size: canvas (width, height), landscape."""
+        self.name = name
+        self.elements = list(elements)
+        self.size = size
+        self.plans = {}  # id(fonts) -> DrawPlan
+        self.lock = threading.Lock()
+
+    def plan(self, fonts):
+        "The compiled DrawPlan for a FontRegistry, made on first use."
+        with self.lock:
+            plan = self.plans.get(id(fonts))
+            if plan is None:
+                plan = self.plans[id(fonts)] = DrawPlan(self, fonts)
+            return plan
+
+
+class DrawPlan(object):
+    def __init__(self, template, fonts):
+        """A template compiled for one FontRegistry: the static elements are
+        rasterized once into a layer every render starts from. Renders only
+        draw the slots, and the boxes a change of values touches are known
+        without comparing frames. Stateless after compile, renders may run on
+        any thread."""
+        self.template = template
+        self.fonts = fonts
+        self.slots = []  # dynamic elements, in template order
+        self.static_layer = Image.new("1", template.size, 1)
+        drawer = ImageDraw.Draw(self.static_layer)
+        for el in template.elements:
+            if isinstance(el, Line):
+                drawer.line(el.xy, fill=0, width=el.width)
+            elif isinstance(el, Text) and el.slot is None:
+                self.draw_text(drawer, el, el.text, el.box[:2])
+            else:
+                self.slots.append(el)
+
+    def fit(self, el, text):
+        """(size, text, bbox) of the text in the box of el. bbox is relative to
+        the top left of the box."""
+        x0, y0, x1, y1 = el.box
+        width = x1 - x0
+        for size in range(el.size, el.min_size - 1, -1):
+            if self.fonts.measure(text, el.face, size)[2] <= width:
+                break
+        else:
+            size = el.min_size
+            while len(text) > 0 and (
+                self.fonts.measure(text + ELLIPSIS, el.face, size)[2] > width
+            ):
+                text = text[:-1]
+            text += ELLIPSIS
+        left, top, right, bottom = self.fonts.measure(text, el.face, size)
+        dx = 0
+        if el.align == "right":
+            dx = width - right
+        elif el.align == "center":
+            dx = (width - right - left) // 2
+        # Smaller sizes keep the baseline of the full size.
+        dy = (
+            self.fonts.get(el.face, el.size).getmetrics()[0]
+            - self.fonts.get(el.face, size).getmetrics()[0]
+        )
+        return size, text, (left + dx, top + dy, right + dx, bottom + dy)
+
+    def draw_text(self, drawer, el, text, origin):
+        size, text, bbox = self.fit(el, text)
+        left, top = self.fonts.measure(text, el.face, size)[:2]
+        xy = (origin[0] + bbox[0] - left, origin[1] + bbox[1] - top)
+        drawer.text(xy, text, font=self.fonts.get(el.face, size), fill=0)
+
+    def render(self, values):
+        """Canvas of the page. values: {slot: value}, text for Text slots.
+        Missing or None values leave their box empty."""
+        canvas = self.static_layer.copy()
+        canvas_drawer = ImageDraw.Draw(canvas)
+        for el in self.slots:
+            value = values.get(el.slot)
+            if value is None:
+                continue
+            x0, y0, x1, y1 = el.box
+            if isinstance(el, Text) and self.ink_box(el, value) == self.ink_box(
+                el, value, clip=False
+            ):
+                self.draw_text(canvas_drawer, el, value, (x0, y0))
+                continue
+            # Drawn on its own image, so nothing spills out of the box.
+            img = Image.new("1", (x1 - x0, y1 - y0), 1)
+            drawer = ImageDraw.Draw(img)
+            if isinstance(el, Custom):
+                el.draw(drawer, value, img.size)
+            else:
+                self.draw_text(drawer, el, value, (0, 0))
+            canvas.paste(img, (x0, y0))
+        return canvas
+
+    def ink_box(self, el, value, clip=True):
+        """Canvas box a slot value can draw on, None when it draws nothing.
+        clip: cut to the slot box, like the render does."""
+        if value is None:
+            return None
+        if isinstance(el, Custom):
+            return el.box
+        x0, y0, x1, y1 = el.box
+        left, top, right, bottom = self.fit(el, value)[2]
+        box = (x0 + left, y0 + top, x0 + right, y0 + bottom)
+        if clip:
+            box = (max(x0, box[0]), max(y0, box[1]), min(x1, box[2]), min(y1, box[3]))
+        return box if box[0] < box[2] and box[1] < box[3] else None
+
+    def dirty_boxes(self, old_values, new_values):
+        """Canvas boxes (x0, y0, x1, y1) that differ between the renders of
+        old_values and new_values: the old and new ink of every changed slot."""
+        boxes = []
+        for el in self.slots:
+            old, new = old_values.get(el.slot), new_values.get(el.slot)
+            if old == new:
+                continue
+            inks = [b for b in (self.ink_box(el, old), self.ink_box(el, new)) if b]
+            if len(inks) > 0:
+                boxes.append(
+                    (
+                        min(b[0] for b in inks),
+                        min(b[1] for b in inks),
+                        max(b[2] for b in inks),
+                        max(b[3] for b in inks),
+                    )
+                )
+        return boxes
+
+    def dirty_windows(self, old_values, new_values, panel_size, merge_gap=8):
+        """dirty_boxes() as panel windows, like find_dirty_windows() returns:
+        panel orientation, x in whole bytes, windows closer than merge_gap rows
+        merged. panel_size: (width, height) of the panel, native orientation.
+        The canvas is rotated onto the panel like pack_1bit: canvas column x is
+        panel row height - 1 - x, canvas row y is panel column y."""
+        width, height = panel_size
+        windows = [
+            (y0 // 8 * 8, height - x1, min(width, -(-y1 // 8) * 8), height - x0)
+            for x0, y0, x1, y1 in self.dirty_boxes(old_values, new_values)
+        ]
+        windows.sort(key=lambda w: w[1])
+        merged = []
+        for w in windows:
+            if len(merged) > 0 and w[1] - merged[-1][3] < merge_gap:
+                m = merged[-1]
+                merged[-1] = (
+                    min(m[0], w[0]),
+                    m[1],
+                    max(m[2], w[2]),
+                    max(m[3], w[3]),
+                )
+            else:
+                merged.append(w)
+        return merged
@@ -0,0 +1,82 @@
+# Info dict keys kept in a Quote, in slot order.
+INFO_KEYS = (
+    "symbol",
+    "bid",
+    "ask",
+    "bidSize",
+    "askSize",
+    "previousClose",
+    "regularMarketPrice",
+)
+
+
+class Quote(object):
+    """The displayed fields of one quote, built at parse time. Fixed slots
+    instead of the info dict: no per-instance dict and no key strings,
+    a bit over half the memory of even a trimmed dict. Missing fields are None.
+    Quotes are not changed once built, merged() makes a new one."""
+
+    __slots__ = (
+        "symbol",
+        "bid",
+        "ask",
+        "bid_size",
+        "ask_size",
+        "previous_close",
+        "price",
+    )
+
+    def __init__(self, *values):
+        for slot, value in zip(self.__slots__, values):
+            setattr(self, slot, value)
+        for slot in self.__slots__[len(values) :]:
+            setattr(self, slot, None)
+
+    @classmethod
+    def from_info(cls, info):
+        "From a yfinance info dict or a v7 quote, any other keys are dropped."
+        return cls(*(info.get(key) for key in INFO_KEYS))
+
+    def values(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def get(self, key, default=None):
+        "Value by info dict key, like dict.get."
+        try:
+            value = getattr(self, self.__slots__[INFO_KEYS.index(key)])
+        except ValueError:
+            return default
+        return default if value is None else value
+
+    def to_info(self):
+        "Info dict of the fields that are set, e.g. for JSON."
+        return {
+            key: value
+            for key, value in zip(INFO_KEYS, self.values())
+            if value is not None
+        }
+
+    def merged(self, info):
+        "New quote: the fields given in info (e.g. a streamed update) replace these."
+        return Quote(
+            *(
+                info[key] if info.get(key) is not None else value
+                for key, value in zip(INFO_KEYS, self.values())
+            )
+        )
+
+    def market_price(self):
+        """Bid/ask weighted by size. 0 without a bid (field missing), the last
+        price when both sizes are 0."""
+        if self.bid is None or self.ask is None:
+            return 0
+        bid_size, ask_size = self.bid_size or 0, self.ask_size or 0
+        if bid_size + ask_size == 0:
+            return self.price or 0
+        return (self.bid * bid_size + self.ask * ask_size) / (bid_size + ask_size)
+
+    def __eq__(self, other):
+        return isinstance(other, Quote) and self.values() == other.values()
+
+    def __repr__(self):
+        return "Quote{0}".format(self.values())
@@ -0,0 +1,348 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Quote import Quote
+
+# One JSON object per line, both ways.
+#   client -> broker: {"sub": [symbols]}
+#   broker -> client: {"fields": [...]} once, then {"t": fetch time, "q": {symbol: [values]}}
+# Quote values are sent as lists in the order of "fields", changed quotes only.
+DEFAULT_PATH = "/tmp/tps_epd_quotes.sock"
+# The same quotes as a QuoteStream source, GET /stream?symbols=A,B,C over HTTP:
+# one chunk per line, {"symbol": ..., field: value...} per changed quote, an
+# empty line every STREAM_HEARTBEAT_SECONDS.
+STREAM_HEARTBEAT_SECONDS = 10
+STREAM_SEND_TIMEOUT = 30  # s, a stream client that stops reading is dropped
+
+
+class StreamClient(object):
+    def __init__(self, wfile):
+        "A QuoteStream subscriber, an open chunked HTTP response."
+        self.wfile = wfile
+        self.lock = threading.Lock()  # the fetch loop and the heartbeat write
+        self.closed = threading.Event()
+
+    def write_lines(self, lines):
+        data = b"".join(
+            b"%x\r\n%s\r\n" % (len(line) + 1, line + b"\n") for line in lines
+        )
+        with self.lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                self.closed.set()
+                raise
+        return len(data)
+
+
+class BrokerStreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/stream":
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        symbols = set(query.get("symbols", [""])[0].split(",")) - {""}
+        self.connection.settimeout(STREAM_SEND_TIMEOUT)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.server.broker.serve_stream(StreamClient(self.wfile), symbols)
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        logging.debug("Broker stream: " + format % args)
+
+
+class QuoteBroker(object):
+    def __init__(
+        self,
+        fetcher,
+        path=DEFAULT_PATH,
+        refresh_seconds=60,
+        requests_per_hour=720,
+        stream_port=None,
+    ):
+        """One fetch loop for every process on the machine. Clients subscribe
+        to symbols over a Unix socket, the broker fetches the union of all
+        subscriptions once per round and sends each client the quotes of its
+        own symbols that changed.
+        fetcher: YahooFinanceFetcher used for the upstream calls
+        (fetch_info_dicts, last_fetch_stats). Its fields, which must be set,
+        are the ones published.
+        refresh_seconds: shortest time between two rounds.
+        requests_per_hour: global upstream budget. A round that would overspend
+        it waits for the budget to refill.
+        stream_port: also serve the quotes over HTTP in the QuoteStream format,
+        for TPS_EPD_QUOTE_STREAM=http://host:port/stream. None: off."""
+        self.fetcher = fetcher
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self.requests_per_hour = requests_per_hour
+        self.stream_port = stream_port
+        self.fields = list(fetcher.fields)
+        self.lock = threading.Condition()
+        self.send_lock = threading.Lock()  # one writer at a time per line
+        self.subs = {}  # socket or StreamClient -> set of symbols
+        self.quotes = {}  # symbol -> (values, fetch time)
+        self.tokens = requests_per_hour / 12.0  # 5 minutes of budget to start
+        self.t_tokens = time.monotonic()
+        self.cost_per_symbol = 1.0  # upstream requests per symbol, measured
+        self.new_symbols = False  # a subscription added symbols, fetch now
+        self.running = True
+        self.stats = {"rounds": 0, "requests": 0, "waits": 0, "sent_bytes": 0}
+
+    # Clients
+    def serve_forever(self):
+        "Accept clients and run the fetch loop. Blocks."
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over from a previous run
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(16)
+        threading.Thread(target=self.accept_loop, name="broker", daemon=True).start()
+        logging.info("Quote broker on {0}".format(self.path))
+        if self.stream_port is not None:
+            self.http = ThreadingHTTPServer(
+                ("0.0.0.0", self.stream_port), BrokerStreamHandler
+            )
+            self.http.daemon_threads = True
+            self.http.broker = self
+            threading.Thread(
+                target=self.http.serve_forever, name="broker-stream", daemon=True
+            ).start()
+            logging.info(
+                "Quote stream on http://0.0.0.0:{0}/stream".format(
+                    self.http.server_port
+                )
+            )
+        self.fetch_loop()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self.serve_client, args=(sock,), daemon=True
+            ).start()
+
+    def serve_client(self, sock):
+        with self.lock:
+            self.subs[sock] = set()
+        try:
+            self.send(sock, {"fields": self.fields})
+            for line in sock.makefile("r", encoding="utf-8"):
+                msg = json.loads(line)
+                cached = self.subscribe(sock, set(msg.get("sub", [])))
+                if len(cached) > 0:
+                    # Last quotes right away, the next round sends the changes.
+                    t = min(ts for _, ts in cached.values())
+                    self.send(
+                        sock, {"t": t, "q": {tk: v for tk, (v, _) in cached.items()}}
+                    )
+        except (OSError, ValueError) as e:
+            logging.debug("Broker client gone: {0}".format(e))
+        finally:
+            with self.lock:
+                self.subs.pop(sock, None)
+            sock.close()
+
+    def subscribe(self, client, symbols):
+        "Add symbols to a client. Return {symbol: (values, time)} of those cached."
+        with self.lock:
+            known = set().union(*self.subs.values())
+            self.subs[client] |= symbols
+            if not symbols <= known:
+                self.new_symbols = True
+                self.lock.notify_all()
+            return {tk: self.quotes[tk] for tk in symbols if tk in self.quotes}
+
+    def serve_stream(self, client, symbols):
+        "Send the cached quotes, then the changes and heartbeats until the client goes."
+        with self.lock:
+            self.subs[client] = set()
+        try:
+            cached = self.subscribe(client, symbols)
+            self.send_stream(client, {tk: v for tk, (v, _) in cached.items()})
+            while self.running and not client.closed.wait(STREAM_HEARTBEAT_SECONDS):
+                client.write_lines([b""])
+        except OSError as e:
+            logging.debug("Broker stream client gone: {0}".format(e))
+        finally:
+            with self.lock:
+                self.subs.pop(client, None)
+
+    def send_stream(self, client, quotes):
+        "quotes: {symbol: values}, one line each with the fields that are set."
+        lines = []
+        for tk, values in quotes.items():
+            update = {f: v for f, v in zip(self.fields, values) if v is not None}
+            update["symbol"] = tk
+            lines.append(json.dumps(update, separators=(",", ":")).encode("utf-8"))
+        if len(lines) > 0:
+            sent = client.write_lines(lines)
+            with self.send_lock:
+                self.stats["sent_bytes"] += sent
+
+    def send(self, sock, msg):
+        data = (json.dumps(msg, separators=(",", ":")) + "\n").encode("utf-8")
+        with self.send_lock:
+            sock.sendall(data)
+            self.stats["sent_bytes"] += len(data)
+
+    # Fetch loop
+    def refill(self):
+        now = time.monotonic()
+        rate = self.requests_per_hour / 3600.0
+        cap = max(self.requests_per_hour / 12.0, 1.0)
+        self.tokens = min(cap, self.tokens + (now - self.t_tokens) * rate)
+        self.t_tokens = now
+
+    def fetch_loop(self):
+        while self.running:
+            with self.lock:
+                symbols = sorted(set().union(*self.subs.values()))
+                self.new_symbols = False
+            if len(symbols) > 0:
+                self.fetch_round(symbols)
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: self.new_symbols or not self.running,
+                    self.refresh_seconds,
+                )
+
+    def fetch_round(self, symbols):
+        "Fetch the symbols within the budget, then publish the changes."
+        with self.lock:
+            self.refill()
+            cost = max(1.0, self.cost_per_symbol * len(symbols))
+            if self.tokens < cost:
+                wait = (cost - self.tokens) * 3600.0 / self.requests_per_hour
+                logging.info(
+                    "Request budget spent, next fetch in {0:.0f} s".format(wait)
+                )
+                self.stats["waits"] += 1
+                self.lock.wait_for(lambda: not self.running, wait)
+                self.refill()
+        fetched = self.fetcher.fetch_info_dicts(symbols)
+        t = time.time()
+        requests = self.fetcher.last_fetch_stats.get("requests", len(symbols))
+        with self.lock:
+            self.tokens -= requests
+            self.cost_per_symbol = requests / len(symbols)
+            self.stats["rounds"] += 1
+            self.stats["requests"] += requests
+            changed = {}
+            for tk, info in fetched.items():
+                values = [info.get(f) for f in self.fields]
+                if tk not in self.quotes or self.quotes[tk][0] != values:
+                    changed[tk] = values
+                self.quotes[tk] = (values, t)
+            subs = list(self.subs.items())
+        for sock, symbols_wanted in subs:
+            update = {tk: v for tk, v in changed.items() if tk in symbols_wanted}
+            if len(update) > 0:
+                try:
+                    if isinstance(sock, StreamClient):
+                        self.send_stream(sock, update)
+                    else:
+                        self.send(sock, {"t": t, "q": update})
+                except OSError:
+                    pass  # serve_client / serve_stream clean up
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        self.listener.close()
+        if self.stream_port is not None:
+            self.http.shutdown()
+
+    def get_stats(self):
+        with self.lock:
+            st = dict(self.stats)
+            st["clients"] = len(self.subs)
+            st["symbols"] = len(set().union(*self.subs.values()))
+        return st
+
+
+class QuoteBrokerClient(object):
+    def __init__(self, symbols, path=DEFAULT_PATH):
+        """Subscriber side, used by YahooFinanceFetcher(broker_path=...).
+        Keeps the latest quote of each symbol as the broker publishes them, and
+        reconnects in the background when the broker restarts."""
+        self.symbols = list(symbols)
+        self.path = path
+        self.fields = []
+        self.quotes = {}  # symbol -> (Quote, fetch time)
+        self.waited = False  # first get_quotes() after (re)connecting done
+        self.cond = threading.Condition()
+        self.running = True
+        threading.Thread(target=self.run, name="broker-client", daemon=True).start()
+
+    def run(self):
+        backoff = 1.0
+        while self.running:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                with self.cond:
+                    self.waited = False
+                sock.sendall((json.dumps({"sub": self.symbols}) + "\n").encode("utf-8"))
+                backoff = 1.0
+                for line in sock.makefile("r", encoding="utf-8"):
+                    self.handle(json.loads(line))
+                raise ConnectionError("Broker closed the connection")
+            except (OSError, ValueError) as e:
+                sock.close()
+                logging.warning(
+                    "Quote broker {0} unavailable ({1}), retry in {2:.0f} s".format(
+                        self.path, e, backoff
+                    )
+                )
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    def handle(self, msg):
+        with self.cond:
+            if "fields" in msg:
+                self.fields = msg["fields"]
+            for tk, values in msg.get("q", {}).items():
+                self.quotes[tk] = (
+                    Quote.from_info(dict(zip(self.fields, values))),
+                    msg["t"],
+                )
+            self.cond.notify_all()
+
+    def get_quotes(self, symbols, max_age=None, timeout=0.0):
+        """{symbol: Quote} of the symbols the broker has a quote for, at most
+        max_age seconds old. The first call after connecting waits up to
+        timeout for the broker to fetch the new symbols."""
+        with self.cond:
+            if not self.waited:
+                self.cond.wait_for(
+                    lambda: all(tk in self.quotes for tk in symbols), timeout
+                )
+                self.waited = True
+            now = time.time()
+            return {
+                tk: self.quotes[tk][0]
+                for tk in symbols
+                if tk in self.quotes
+                and (max_age is None or now - self.quotes[tk][1] <= max_age)
+            }
+
+    def stop(self):
+        self.running = False
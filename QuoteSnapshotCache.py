@@ -0,0 +1,52 @@
+import json
+import logging as lg
+import os
+import time
+
+
+class QuoteSnapshotCache:
+    def __init__(self, path, ttl=900):
+        """Last-known quotes on disk, so the first frame does not wait for the network.
+        path: snapshot file (compact JSON).
+        ttl: seconds after which a saved quote counts as stale."""
+        self.path = path
+        self.ttl = ttl
+
+    def save(self, tks_info, tks_ts):
+        "Write the quotes that have a fetch timestamp. Atomic: a crash never leaves half a file."
+        quotes = {
+            tk: {"ts": round(tks_ts[tk], 1), "info": info}
+            for tk, info in tks_info.items()
+            if info is not None and tks_ts.get(tk) is not None
+        }
+        if len(quotes) == 0:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"v": 1, "quotes": quotes}, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            lg.error("Cannot write quote snapshot {0}: {1}".format(self.path, e))
+
+    def load(self):
+        "Return {ticker: (info, fetch timestamp)}. Empty if there is no usable snapshot."
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+            return {
+                tk: (entry["info"], entry["ts"])
+                for tk, entry in snapshot["quotes"].items()
+            }
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            lg.error("Ignore broken quote snapshot {0}: {1}".format(self.path, e))
+            return {}
+
+    def is_stale(self, ts, now=None):
+        if ts is None:
+            return True
+        now = time.time() if now is None else now
+        return now - ts > self.ttl
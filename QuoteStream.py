@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+import time
+
+import requests
+
+# Yahoo Finance's pricing streamer: a websocket that pushes base64 protobuf
+# PricingData messages of the subscribed symbols, decoded by yfinance.WebSocket.
+YAHOO_STREAM_URL = "wss://streamer.finance.yahoo.com/?version=2"
+# PricingData fields (proto names) -> quote fields.
+PRICING_FIELDS = {
+    "id": "symbol",
+    "price": "regularMarketPrice",
+    "previous_close": "previousClose",
+    "bid": "bid",
+    "ask": "ask",
+    "bid_size": "bidSize",
+    "ask_size": "askSize",
+}
+
+
+def pricing_update(pricing):
+    """A decoded PricingData message (dict, proto field names) as a stream
+    update. Fields at their proto default are left out of the message, so
+    missing ones are kept from the last quote. A message without bid and ask
+    is a trade: the sizes are zeroed, so that market_price() is the traded
+    price and not the last polled bid/ask."""
+    update = {}
+    for field, key in PRICING_FIELDS.items():
+        if field in pricing:
+            value = pricing[field]
+            # int64 fields come as strings from MessageToDict.
+            update[key] = int(value) if key in ("bidSize", "askSize") else value
+    if "bid" not in update and "ask" not in update and "regularMarketPrice" in update:
+        update["bidSize"] = update["askSize"] = 0
+    return update
+
+
+class QuoteStream(object):
+    def __init__(
+        self,
+        fetcher,
+        stream_url,
+        on_update=None,
+        read_timeout=30.0,
+        max_backoff=60.0,
+    ):
+        """Push quotes over one long-lived connection instead of polling. Each
+        update is decoded as it arrives and merged into the fetcher's quotes,
+        as if refresh_stock_info_dict had fetched it.
+        stream_url: ws:// or wss://, a Yahoo pricing streamer, e.g.
+        YAHOO_STREAM_URL: the symbols are subscribed over the websocket and
+        every trade or quote is pushed as it happens (yfinance.WebSocket).
+        http:// or https://, the local stand-in: GET stream_url?symbols=A,B,C
+        answers with newline-delimited JSON, one update per line, and empty
+        lines as heartbeats. QuoteBroker (tps_epd_quote_broker.py
+        --stream-port) and the benchmark stub serve it.
+        on_update(symbols): called from the stream thread with the symbols
+        whose displayed fields changed.
+        read_timeout: no line (not even a heartbeat) for this long means the
+        connection is dead, reconnect. The websocket uses its own pings.
+        max_backoff: cap of the exponential reconnect delay (s).
+        While is_live() is False, the caller keeps polling."""
+        self.fetcher = fetcher
+        self.stream_url = stream_url
+        self.on_update = on_update
+        self.read_timeout = read_timeout
+        self.max_backoff = max_backoff
+        self.live = False
+        self.stopped = threading.Event()
+        self.conn = None  # open response or websocket, stop() closes it
+        self.stats = {
+            "connects": 0,
+            "updates": 0,
+            "changes": 0,
+            "unmerged": 0,
+            "bytes": 0,
+        }
+        self.thread = threading.Thread(
+            target=self.run, name="quote-stream", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def is_live(self):
+        "Connected and receiving. False while reconnecting: poll instead."
+        return self.live
+
+    def run(self):
+        """Connect, read, reconnect with backoff until stop(). Any other error
+        ends the thread: is_live() turns False and the caller polls again."""
+        backoff = 1.0
+        try:
+            while not self.stopped.is_set():
+                connects = self.stats["connects"]
+                try:
+                    if self.stream_url.startswith(("ws://", "wss://")):
+                        self.read_websocket()
+                    else:
+                        self.read_lines()
+                    raise ConnectionError("Stream ended")
+                except Exception as e:
+                    self.live = False
+                    if self.stopped.is_set():
+                        return  # stop() closed the connection under the read
+                    if not isinstance(
+                        e, (requests.RequestException, OSError, ValueError)
+                    ):
+                        raise
+                    if self.stats["connects"] > connects:
+                        backoff = 1.0  # it was up: start over from the shortest wait
+                    logging.warning(
+                        "Quote stream down ({0}), polling; retry in {1:.0f} s".format(
+                            type(e).__name__, backoff
+                        )
+                    )
+                    self.stopped.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+        except Exception:
+            logging.exception("Quote stream failed, polling from now on")
+        finally:
+            self.live = False
+
+    def connected(self):
+        self.live = True
+        self.stats["connects"] += 1
+        logging.info("Quote stream connected: {0}".format(self.stream_url))
+
+    def read_lines(self):
+        "The newline-delimited JSON stream, until it ends."
+        resp = self.conn = self.fetcher.session.get(
+            self.stream_url,
+            params={"symbols": ",".join(self.fetcher.stock_list)},
+            stream=True,
+            timeout=(self.fetcher.ticker_timeout, self.read_timeout),
+        )
+        try:
+            resp.raise_for_status()
+            self.connected()
+            for line in resp.iter_lines():
+                self.stats["bytes"] += len(line) + 1
+                if len(line) > 0:
+                    self.handle_line(line)
+                if self.stopped.is_set():
+                    return
+        finally:
+            resp.close()
+
+    def read_websocket(self):
+        "The Yahoo pricing streamer, until the connection drops."
+        from websockets.exceptions import WebSocketException
+
+        from YahooFinanceFetcher import import_yfinance
+
+        ws = self.conn = import_yfinance().WebSocket(self.stream_url, verbose=False)
+        try:
+            ws.subscribe(list(self.fetcher.stock_list))  # connects
+            self.connected()
+            # Returns when the connection drops or stop() closes it.
+            ws.listen(lambda pricing: self.merge(pricing_update(pricing)))
+        except WebSocketException as e:
+            raise ConnectionError(str(e)) from e
+        finally:
+            ws.close()
+
+    def handle_line(self, line):
+        self.merge(json.loads(line))
+
+    def merge(self, update):
+        "Merge one update, {symbol, field: value...}. Fields not in it are kept."
+        tk = update.get("symbol")
+        if tk not in self.fetcher.tks_info:
+            return
+        self.stats["updates"] += 1
+        old = self.fetcher.tks_info[tk]
+        if old is None:
+            # Updates carry the moving fields only, a poll brings the rest first.
+            self.stats["unmerged"] += 1
+            return
+        info = old.merged(update)
+        # One assignment, so the render thread never sees a half-merged quote.
+        self.fetcher.tks_info[tk] = info
+        self.fetcher.tks_ts[tk] = time.time()
+        self.fetcher.tks_failed.discard(tk)
+        self.fetcher.record_ticks([tk], self.fetcher.tks_ts[tk])
+        if info != old:
+            self.stats["changes"] += 1
+            if self.on_update is not None:
+                self.on_update([tk])
+
+    def stop(self):
+        self.stopped.set()
+        self.live = False
+        conn = self.conn
+        if conn is not None:
+            conn.close()
+
+    def get_stats(self):
+        st = dict(self.stats)
+        st["live"] = self.live
+        return st
@@ -0,0 +1,147 @@
+import collections
+import logging
+import time
+
+from NodeMetrics import NULL_METRICS
+
+# Decisions
+SKIP = "skip"
+PARTIAL = "partial"
+FULL = "full"
+
+
+class RefreshPolicy(object):
+    def __init__(
+        self,
+        thresholds=None,
+        default_threshold=(None, 0.1),
+        max_staleness=900,
+        refreshes_per_hour=30,
+        full_rows=0.5,
+        metrics=None,
+    ):
+        """Decides for every new stock list whether it is worth a panel refresh:
+        SKIP, PARTIAL (changed windows only) or FULL.
+        thresholds: {symbol: (dollars, percent)}, the smallest price move that
+        is shown right away, absolute or in percent of the shown price. Either
+        may be None. default_threshold: the same for the other symbols.
+        max_staleness: smaller moves are shown once the screen is this many
+        seconds old.
+        refreshes_per_hour: budget of the refreshes the policy lets through.
+        Over it, changes wait until the oldest one is an hour old. Forced
+        refreshes (first list, key presses) always go, and count.
+        full_rows: a full refresh when at least this fraction of the rows
+        changed, partial windows would cover most of the panel anyway.
+        metrics: NodeMetrics, gets refresh_decisions_total{decision, reason}."""
+        self.thresholds = {} if thresholds is None else dict(thresholds)
+        self.default_threshold = default_threshold
+        self.max_staleness = max_staleness
+        self.refreshes_per_hour = refreshes_per_hour
+        self.full_rows = full_rows
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.metrics.add_collector(self.collect_metrics)
+        self.shown_rows = None  # what is on the panel
+        self.shown_prices = {}
+        self.t_shown = None
+        self.recent = (
+            collections.deque()
+        )  # monotonic times of the last hour's refreshes
+        self.stats = collections.Counter()  # decision and "decision/reason" counts
+
+    def significant_moves(self, prices):
+        "Symbols whose price moved past their threshold since the last refresh."
+        moved = []
+        for tk, price in prices.items():
+            old = self.shown_prices.get(tk)
+            if price is None or old is None or price == old:
+                continue
+            dollars, percent = self.thresholds.get(tk, self.default_threshold)
+            diff = abs(price - old)
+            if (dollars is not None and diff >= dollars) or (
+                percent is not None and old != 0 and diff * 100.0 / abs(old) >= percent
+            ):
+                moved.append(tk)
+        return moved
+
+    def layout_changed(self, rows, prices):
+        "Rows added or removed, a stale mark or a Service N/A came or went."
+        if len(rows) != len(self.shown_rows):
+            return True
+        if [r[0] for r in rows] != [r[0] for r in self.shown_rows]:
+            return True
+        return any(
+            (price is None) != (self.shown_prices.get(tk) is None)
+            for tk, price in prices.items()
+        )
+
+    def budget_left(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.refreshes_per_hour - sum(
+            1 for t in list(self.recent) if now - t < 3600
+        )
+
+    def decide(self, rows, prices, force=False, now=None):
+        """Decision for the new rows (format_display_2in7) and their prices
+        ({symbol: price or None}). Anything but SKIP is taken as shown.
+        force: a refresh asked for, e.g. by a key press."""
+        now = time.monotonic() if now is None else now
+        moved = []
+        if self.shown_rows is None:
+            decision, reason = FULL, "first"
+        elif force:
+            decision, reason = FULL, "forced"
+        elif rows == self.shown_rows:
+            decision, reason = SKIP, "unchanged"
+        else:
+            moved = self.significant_moves(prices)
+            if self.layout_changed(rows, prices):
+                decision, reason = PARTIAL, "layout"
+            elif len(moved) > 0:
+                decision, reason = PARTIAL, "threshold"
+            elif now - self.t_shown >= self.max_staleness:
+                decision, reason = PARTIAL, "staleness"
+            else:
+                decision, reason = SKIP, "below_threshold"
+            if decision != SKIP and self.budget_left(now) <= 0:
+                decision, reason = SKIP, "budget"
+        if decision == PARTIAL:
+            # Ticker and price text only: a sparkline that gained a pixel
+            # does not make a row count for a full refresh.
+            changed = sum(
+                1
+                for i, row in enumerate(rows)
+                if i >= len(self.shown_rows) or row[:2] != self.shown_rows[i][:2]
+            )
+            if changed >= self.full_rows * len(rows):
+                decision = FULL
+        self.stats[decision] += 1
+        self.stats[decision + "/" + reason] += 1
+        self.metrics.inc("refresh_decisions_total", decision=decision, reason=reason)
+        if decision == SKIP:
+            logging.debug("Refresh policy: skip ({0})".format(reason))
+            return decision
+        logging.info(
+            "Refresh policy: {0} refresh ({1}{2})".format(
+                decision, reason, ": " + ", ".join(moved) if len(moved) > 0 else ""
+            )
+        )
+        while len(self.recent) > 0 and now - self.recent[0] >= 3600:
+            self.recent.popleft()
+        self.recent.append(now)
+        self.shown_rows = list(rows)
+        self.shown_prices = dict(prices)
+        self.t_shown = now
+        return decision
+
+    def get_stats(self):
+        "Decision counts, by decision and by decision/reason, and the budget left."
+        st = dict(self.stats)
+        st["budget_left"] = self.budget_left()
+        return st
+
+    def collect_metrics(self):
+        age = None if self.t_shown is None else time.monotonic() - self.t_shown
+        return [
+            ("refresh_budget_left", {}, self.budget_left()),
+            ("stock_screen_age_seconds", {}, age),
+        ]
@@ -0,0 +1,333 @@
+import logging
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from Display2In7Driver import Display2In7Driver, find_dirty_windows
+from EpdSimulator import SimulatedEPD
+
+# Wire format: every message is HEADER + payload, big endian.
+#   magic "TE", version, message type, payload length
+HEADER = struct.Struct("!2sBBI")
+MAGIC = b"TE"
+VERSION = 1
+MSG_HELLO = 1  # node -> server: node id, utf-8
+MSG_FRAME = 2  # server -> node: flags, whole packed frame
+MSG_WINDOWS = 3  # server -> node: flags, count, (x0, y0, x1, y1, rows...) * count
+MSG_KEY = 4  # node -> server: key number, event kind
+WINDOW = struct.Struct("!HHHH")
+# Payload flags of MSG_FRAME/MSG_WINDOWS
+FLAG_FULL = 0x01  # full refresh on the node
+FLAG_ZLIB = 0x02  # the rest of the payload is zlib compressed
+KEY_KINDS = ("press", "double", "long")
+MAX_PAYLOAD = 64 * 1024
+SEND_TIMEOUT = 10  # s, a node that stops reading is dropped after this
+
+
+def send_message(sock, msg_type, payload=b""):
+    sock.sendall(HEADER.pack(MAGIC, VERSION, msg_type, len(payload)) + payload)
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    "Return (message type, payload). Raise ConnectionError on a bad header."
+    magic, version, msg_type, length = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if magic != MAGIC or version != VERSION or length > MAX_PAYLOAD:
+        raise ConnectionError("Bad header: {0} v{1}".format(magic, version))
+    return msg_type, recv_exact(sock, length)
+
+
+def pack_payload(flags, body):
+    "Compress the body when that makes it smaller. Packed frames are mostly white."
+    packed = zlib.compress(body, 6)
+    if len(packed) < len(body):
+        return bytes([flags | FLAG_ZLIB]) + packed
+    return bytes([flags]) + body
+
+
+def unpack_payload(payload):
+    flags = payload[0]
+    body = payload[1:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    return flags, body
+
+
+def encode_windows(buf, windows, row_bytes):
+    "Window rectangles (panel orientation, x multiple of 8) and their bytes, row by row."
+    parts = [struct.pack("!H", len(windows))]
+    for x0, y0, x1, y1 in windows:
+        parts.append(WINDOW.pack(x0, y0, x1, y1))
+        c0, c1 = x0 // 8, x1 // 8
+        for row in range(y0, y1):
+            parts.append(buf[row * row_bytes + c0 : row * row_bytes + c1])
+    return b"".join(parts)
+
+
+def apply_windows(frame, body, row_bytes):
+    "Write the windows of an encoded body into frame (bytearray), in place."
+    (count,) = struct.unpack_from("!H", body, 0)
+    pos = 2
+    for _ in range(count):
+        x0, y0, x1, y1 = WINDOW.unpack_from(body, pos)
+        pos += WINDOW.size
+        c0, c1 = x0 // 8, x1 // 8
+        for row in range(y0, y1):
+            frame[row * row_bytes + c0 : row * row_bytes + c1] = body[
+                pos : pos + c1 - c0
+            ]
+            pos += c1 - c0
+    return count
+
+
+class RenderServer(object):
+    def __init__(self, host="127.0.0.1", port=7340, row_bytes=22, on_key=None):
+        """Central side of the thin-client mode. Nodes connect and say their
+        node id, the server sends them packed frames: the whole frame on
+        connect, afterwards only the changed windows when that is smaller.
+        on_key(node_id, key, kind): called from the connection threads when a
+        node reports a key press.
+        port: 0 picks a free port, see the port attribute."""
+        self.row_bytes = row_bytes
+        self.on_key = on_key
+        self.lock = threading.Lock()
+        self.conns = {}  # node id -> socket
+        self.send_locks = {}  # socket -> lock, one push at a time per node
+        self.frames = {}  # node id -> (latest frame, full), sent or not
+        self.sent = {}  # node id -> frame the node has
+        self.stats = {"frames": 0, "windows": 0, "skipped": 0, "bytes": 0}
+        self.listener = socket.create_server((host, port))
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        threading.Thread(
+            target=self.accept_loop, name="render-server", daemon=True
+        ).start()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                sock, addr = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Send timeout only: the socket blocks in recv waiting for keys.
+            sock.setsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_SNDTIMEO,
+                struct.pack("ll", SEND_TIMEOUT, 0),
+            )
+            threading.Thread(
+                target=self.serve_node, args=(sock, addr), daemon=True
+            ).start()
+
+    def serve_node(self, sock, addr):
+        node_id = None
+        try:
+            msg_type, payload = recv_message(sock)
+            if msg_type != MSG_HELLO:
+                raise ConnectionError("Expected HELLO")
+            node_id = payload.decode("utf-8")
+            logging.info("Node {0} connected from {1}".format(node_id, addr[0]))
+            with self.lock:
+                old = self.conns.get(node_id)
+                if old is not None:
+                    old.close()
+                self.conns[node_id] = sock
+                self.send_locks[sock] = threading.Lock()
+                self.sent.pop(node_id, None)  # the node starts from scratch
+                pending = self.frames.get(node_id)
+            if pending is not None:
+                self.push_frame(node_id, pending[0], full=True)
+            while True:
+                msg_type, payload = recv_message(sock)
+                if msg_type == MSG_KEY and self.on_key is not None:
+                    self.on_key(node_id, payload[0], KEY_KINDS[payload[1]])
+        except (ConnectionError, OSError, UnicodeDecodeError, IndexError) as e:
+            logging.info("Node {0} disconnected: {1}".format(node_id, e))
+        finally:
+            with self.lock:
+                if self.conns.get(node_id) is sock:
+                    del self.conns[node_id]
+                self.send_locks.pop(sock, None)
+            sock.close()
+
+    def push_frame(self, node_id, buf, full=False):
+        """Send a packed frame to a node. Nodes that are not connected get it
+        when they connect. Return the payload bytes sent.
+        The server lock is only held to read and update the state, the send
+        runs under the node's own lock: a node that stops reading holds up
+        its own frames, not the others or new connections."""
+        with self.lock:
+            self.frames[node_id] = (buf, full)
+            sock = self.conns.get(node_id)
+            send_lock = self.send_locks.get(sock)
+        if sock is None or send_lock is None:
+            return 0
+        # Held from the diff to the send, so that the node gets the windows
+        # in the order they were computed.
+        with send_lock:
+            with self.lock:
+                if self.conns.get(node_id) is not sock:
+                    return 0  # reconnected meanwhile, serve_node sends the frame
+                last = self.sent.get(node_id)
+            flags = FLAG_FULL if full else 0
+            if last is None:
+                msg_type, payload = MSG_FRAME, pack_payload(flags, buf)
+            else:
+                windows = find_dirty_windows(last, buf, self.row_bytes)
+                if len(windows) == 0 and not full:
+                    with self.lock:
+                        self.stats["skipped"] += 1
+                    return 0
+                body = encode_windows(buf, windows, self.row_bytes)
+                if len(body) < len(buf):
+                    msg_type, payload = MSG_WINDOWS, pack_payload(flags, body)
+                else:
+                    msg_type, payload = MSG_FRAME, pack_payload(flags, buf)
+            try:
+                send_message(sock, msg_type, payload)
+            except OSError as e:
+                logging.warning("Send to {0} failed: {1}".format(node_id, e))
+                # A partial message: drop the node, it starts over on reconnect.
+                # shutdown wakes serve_node, which closes the socket.
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return 0
+            with self.lock:
+                if self.conns.get(node_id) is sock:
+                    self.sent[node_id] = buf
+                self.stats["frames" if msg_type == MSG_FRAME else "windows"] += 1
+                self.stats["bytes"] += HEADER.size + len(payload)
+        return HEADER.size + len(payload)
+
+    def connected_nodes(self):
+        with self.lock:
+            return sorted(self.conns)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def stop(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            for sock in self.conns.values():
+                sock.close()
+
+
+class RemoteNodeDriver(Display2In7Driver):
+    def __init__(self, server, node_id, **kwargs):
+        """Renders the pages of a remote node on the server. Same page methods
+        as Display2In7Driver, with its frame cache and the shared fonts, but
+        every frame goes to the node instead of a local panel."""
+        self.server = server
+        super().__init__(node_id, epd=SimulatedEPD(), **kwargs)
+
+    def show_buffer(self, buf, full=False, windows=None):
+        "Whole frames go out, the node finds its own windows."
+        if buf == self.last_frame and not full:
+            self.refresh_stats["skipped"] += 1
+            return
+        self.last_frame = buf
+        self.server.push_frame(self.node_id, buf, full)
+
+
+class RenderClient(object):
+    def __init__(
+        self, host, port, node_id, on_frame, frame_bytes=22 * 264, row_bytes=22
+    ):
+        """Thin node: receives frames from a RenderServer and hands each
+        complete packed frame to on_frame(buf, full), e.g. a DisplayWorker
+        submit of Display2In7Driver.show_buffer. No fetching or drawing here."""
+        self.host = host
+        self.port = port
+        self.node_id = node_id
+        self.on_frame = on_frame
+        self.row_bytes = row_bytes
+        self.frame = bytearray([0xFF]) * frame_bytes
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.running = True
+        self.stats = {"frames": 0, "windows": 0, "bytes": 0, "connects": 0}
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_message(sock, MSG_HELLO, self.node_id.encode("utf-8"))
+        self.sock = sock
+        self.stats["connects"] += 1
+
+    def receive_one(self):
+        "Handle one message from the server."
+        msg_type, payload = recv_message(self.sock)
+        self.stats["bytes"] += HEADER.size + len(payload)
+        flags, body = unpack_payload(payload)
+        if msg_type == MSG_FRAME:
+            if len(body) != len(self.frame):
+                raise ConnectionError("Frame of {0} bytes".format(len(body)))
+            self.frame[:] = body
+            self.stats["frames"] += 1
+        elif msg_type == MSG_WINDOWS:
+            apply_windows(self.frame, body, self.row_bytes)
+            self.stats["windows"] += 1
+        else:
+            return
+        self.on_frame(bytes(self.frame), bool(flags & FLAG_FULL))
+
+    def send_key(self, event):
+        "EpdHatButtonHandler on_event callback: forward the key to the server."
+        with self.send_lock:
+            if self.sock is None:
+                return
+            try:
+                payload = bytes([event.key, KEY_KINDS.index(event.kind)])
+                send_message(self.sock, MSG_KEY, payload)
+            except OSError as e:
+                logging.warning("Key not sent: {0}".format(e))
+
+    def run_forever(self, max_backoff=60.0):
+        "Connect, receive frames, reconnect with exponential backoff."
+        backoff = 1.0
+        while self.running:
+            try:
+                self.connect()
+                backoff = 1.0
+                while self.running:
+                    self.receive_one()
+            except (ConnectionError, OSError, zlib.error) as e:
+                if not self.running:
+                    return
+                logging.warning(
+                    "Render server {0}:{1} lost ({2}), retry in {3:.0f} s".format(
+                        self.host, self.port, e, backoff
+                    )
+                )
+                with self.send_lock:
+                    self.sock = None
+                time.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+
+    def start(self):
+        threading.Thread(
+            target=self.run_forever, name="render-client", daemon=True
+        ).start()
+
+    def stop(self):
+        self.running = False
+        with self.send_lock:
+            if self.sock is not None:
+                self.sock.close()
@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+
+from NodeMetrics import NULL_METRICS
+
+# Controller commands of the 2.7 inch panel, see Display2In7Driver.
+DATA_START_TRANSMISSION_1 = 0x10  # old frame
+DATA_START_TRANSMISSION_2 = 0x13  # new frame
+DISPLAY_REFRESH = 0x12
+PARTIAL_DATA_START_TRANSMISSION_2 = 0x15
+PARTIAL_DISPLAY_REFRESH = 0x16
+# Largest write spidev takes in one ioctl (its default bufsiz).
+SPI_CHUNK_BYTES = 4096
+
+
+def partial_window_args(x0, y0, x1, y1):
+    "The 8 argument bytes of the partial commands (0x15/0x16) for a window."
+    w = x1 - x0
+    l = y1 - y0
+    return bytes(
+        [
+            x0 >> 8,
+            x0 & 0xF8,
+            y0 >> 8,
+            y0 & 0xFF,
+            w >> 8,
+            w & 0xF8,
+            l >> 8,
+            l & 0xFF,
+        ]
+    )
+
+
+def busy_edge_waiter(link):
+    """wait(timeout) that returns when the busy pin goes idle (rises) or after
+    timeout seconds, on edge events instead of polling where possible:
+    the link's own wait_for_idle (EpdSimulator.MockSpiLink), the gpiozero busy
+    button of newer epdconfig versions, or RPi.GPIO.wait_for_edge. Otherwise
+    a 5 ms poll, still finer than the vendor's 200 ms."""
+    if hasattr(link, "wait_for_idle"):
+        return link.wait_for_idle
+    impl = getattr(link, "implementation", None)
+    busy = getattr(impl, "GPIO_BUSY_PIN", None)
+    if hasattr(busy, "wait_for_active"):
+        return lambda timeout: busy.wait_for_active(timeout)
+    try:
+        import RPi.GPIO as GPIO
+    except (ImportError, RuntimeError):
+        GPIO = None
+    if GPIO is not None:
+        pin = link.BUSY_PIN
+        return lambda timeout: GPIO.wait_for_edge(
+            pin, GPIO.RISING, timeout=max(1, int(timeout * 1000))
+        )
+    return lambda timeout: time.sleep(min(timeout, 0.005))
+
+
+class SpiTransfer(object):
+    def __init__(
+        self, link, chunk_bytes=SPI_CHUNK_BYTES, busy_timeout=30.0, metrics=None
+    ):
+        """Frame uploads to the panel controller as bulk SPI writes, under
+        Display2In7Driver. The vendor EPD sends every byte with its own
+        send_data() call: a Python call, DC and CS pin writes and a 1-byte SPI
+        transfer each, for 2 x 5808 bytes per full frame. Here DC and CS are
+        set once per command or data block, and the block goes out in
+        chunk_bytes writes. The bytes on the bus are the vendor's, in the same
+        order (checked against the vendor path in tps_epd_benchmark.py).
+        link: the waveshare_epd.epdconfig module, or anything with its pin
+        constants and digital_write/digital_read/spi_writebyte(2) functions,
+        e.g. EpdSimulator.MockSpiLink.
+        busy_timeout: longest wait (s) for the busy pin after a refresh.
+        metrics: NodeMetrics, gets the spi_write and busy_wait timings."""
+        self.link = link
+        self.chunk_bytes = chunk_bytes
+        self.busy_timeout = busy_timeout
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.dc_pin = link.DC_PIN
+        self.cs_pin = link.CS_PIN
+        self.busy_pin = link.BUSY_PIN
+        self.write = getattr(link, "spi_writebyte2", None)
+        if self.write is None:  # older epdconfig: writebytes takes lists only
+            self.write = lambda data: link.spi_writebyte(list(data))
+        self.wait_edge = busy_edge_waiter(link)
+        self.lock = threading.Lock()
+        self.stats = {
+            "frames": 0,
+            "bytes": 0,
+            "spi_seconds": 0.0,
+            "busy_seconds": 0.0,
+            "last_bytes": 0,
+            "last_spi_seconds": 0.0,
+            "last_busy_seconds": 0.0,
+        }
+        self.frame_bytes = 0  # of the frame being sent
+        self.frame_spi_seconds = 0.0
+
+    def send_command(self, command):
+        self.link.digital_write(self.dc_pin, 0)
+        self.link.digital_write(self.cs_pin, 0)
+        self.write(bytes([command]))
+        self.link.digital_write(self.cs_pin, 1)
+        self.frame_bytes += 1
+
+    def send_data(self, data):
+        "A block of data bytes, one CS frame, chunk_bytes per write."
+        t0 = time.perf_counter()
+        data = bytes(data)
+        self.link.digital_write(self.dc_pin, 1)
+        self.link.digital_write(self.cs_pin, 0)
+        for lo in range(0, len(data), self.chunk_bytes):
+            self.write(data[lo : lo + self.chunk_bytes])
+        self.link.digital_write(self.cs_pin, 1)
+        self.frame_bytes += len(data)
+        self.frame_spi_seconds += time.perf_counter() - t0
+
+    def wait_idle(self):
+        "Block until the busy pin is high again (0: busy). Return the seconds waited."
+        t0 = time.perf_counter()
+        deadline = time.monotonic() + self.busy_timeout
+        while self.link.digital_read(self.busy_pin) == 0:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                logging.warning(
+                    "Panel still busy after {0:.0f} s".format(self.busy_timeout)
+                )
+                break
+            # Short slices: a missed edge costs at most 0.1 s.
+            self.wait_edge(min(left, 0.1))
+        return time.perf_counter() - t0
+
+    def display(self, buf):
+        "Full frame, the vendor display(): old frame all white, new frame, refresh."
+        with self.lock:
+            self.send_command(DATA_START_TRANSMISSION_1)
+            self.send_data(bytes([0xFF]) * len(buf))
+            self.send_command(DATA_START_TRANSMISSION_2)
+            self.send_data(buf)
+            self.send_command(DISPLAY_REFRESH)
+            self.end_frame()
+
+    def clear(self, frame_bytes, color=0xFF):
+        "The vendor Clear(): the whole panel in one color."
+        self.display(bytes([color]) * frame_bytes)
+
+    def partial_window(self, buf, x0, y0, x1, y1, row_bytes):
+        """One window of a packed frame (panel orientation, x multiple of 8),
+        the same bytes as Display2In7Driver.push_partial_window sends through
+        the vendor EPD."""
+        args = partial_window_args(x0, y0, x1, y1)
+        c0, c1 = x0 // 8, x1 // 8
+        rows = b"".join(
+            buf[row * row_bytes + c0 : row * row_bytes + c1] for row in range(y0, y1)
+        )
+        with self.lock:
+            self.send_command(PARTIAL_DATA_START_TRANSMISSION_2)
+            self.send_data(args + rows)
+            self.send_command(PARTIAL_DISPLAY_REFRESH)
+            self.send_data(args)
+            self.end_frame()
+
+    def end_frame(self):
+        busy = self.wait_idle()
+        st = self.stats
+        st["frames"] += 1
+        st["bytes"] += self.frame_bytes
+        st["spi_seconds"] += self.frame_spi_seconds
+        st["busy_seconds"] += busy
+        st["last_bytes"] = self.frame_bytes
+        st["last_spi_seconds"] = self.frame_spi_seconds
+        st["last_busy_seconds"] = busy
+        self.metrics.observe("spi_write", self.frame_spi_seconds)
+        self.metrics.observe("busy_wait", busy)
+        self.metrics.inc("spi_bytes_total", self.frame_bytes)
+        self.frame_bytes = 0
+        self.frame_spi_seconds = 0.0
+
+    def get_stats(self):
+        "Totals and the last frame: bytes, seconds writing SPI and waiting for busy."
+        with self.lock:
+            st = dict(self.stats)
+        st["avg_spi_seconds"] = (
+            st["spi_seconds"] / st["frames"] if st["frames"] > 0 else None
+        )
+        return st
@@ -0,0 +1,157 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class TickHistory(object):
+    def __init__(self, symbols, capacity=2048, min_interval=30.0, path=None):
+        """Recent (time, price) ticks of every symbol, in fixed-size ring
+        buffers: memory stays at capacity * 12 bytes per symbol however long
+        the node runs.
+        capacity: ticks kept per symbol, the oldest are overwritten.
+        min_interval: ticks are kept one per min_interval (s) time bucket, a
+        tick in the same bucket as the previous one replaces it, so a fast
+        stream does not push the day out of the buffer. With the defaults a
+        buffer covers about 17 hours.
+        path: .npy file the buffers are memory-mapped to, so the history
+        survives restarts. None keeps them in RAM only."""
+        self.symbols = list(symbols)
+        self.capacity = capacity
+        self.min_interval = min_interval
+        self.path = path
+        self.dtype = np.dtype(
+            [
+                ("symbol", "U16"),
+                (
+                    "count",
+                    "<i8",
+                ),  # ticks ever written, the next slot is count % capacity
+                ("t", "<f8", (capacity,)),
+                ("p", "<f4", (capacity,)),
+            ]
+        )
+        self.index = {tk: i for i, tk in enumerate(self.symbols)}
+        self.lock = threading.Lock()
+        self.t_flush = 0.0
+        self.data = self.open()
+
+    def open(self):
+        if self.path is None:
+            data = np.zeros(len(self.symbols), dtype=self.dtype)
+            data["symbol"] = self.symbols
+            return data
+        old = None
+        if os.path.exists(self.path):
+            try:
+                old = np.lib.format.open_memmap(self.path, mode="r+")
+            except (OSError, ValueError) as e:
+                logging.error(
+                    "Ignore broken tick history {0}: {1}".format(self.path, e)
+                )
+        if old is not None and old.dtype == self.dtype:
+            if list(old["symbol"]) == self.symbols:
+                logging.info("Tick history restored from {0}".format(self.path))
+                return old
+        # New file, with the ticks of the symbols the old one had.
+        tmp_path = self.path + ".tmp"
+        data = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=self.dtype, shape=(len(self.symbols),)
+        )
+        data["symbol"] = self.symbols
+        if old is not None and old.dtype == self.dtype:
+            for i, tk in enumerate(old["symbol"]):
+                if tk in self.index:
+                    data[self.index[tk]] = old[i]
+        data.flush()
+        os.replace(tmp_path, self.path)
+        return data
+
+    def append(self, tk, t, price):
+        "Add a tick. Unknown symbols are ignored."
+        i = self.index.get(tk)
+        if i is None:
+            return
+        with self.lock:
+            count = int(self.data["count"][i])
+            last = (count - 1) % self.capacity
+            # Same bucket as the previous tick: replace it. Buckets are fixed,
+            # so a steady stream of close ticks still moves on to new slots.
+            if count > 0 and (
+                t // self.min_interval == self.data["t"][i, last] // self.min_interval
+            ):
+                slot = last
+            else:
+                slot = count % self.capacity
+                self.data["count"][i] = count + 1
+            self.data["t"][i, slot] = t
+            self.data["p"][i, slot] = price
+
+    def flush(self, min_seconds=60.0):
+        "Write a memory-mapped history to disk, at most every min_seconds."
+        if self.path is None or time.monotonic() - self.t_flush < min_seconds:
+            return
+        with self.lock:
+            self.data.flush()
+        self.t_flush = time.monotonic()
+
+    def series(self, tk):
+        "(times, prices) of a symbol, oldest first. Copies."
+        i = self.index[tk]
+        with self.lock:
+            count = int(self.data["count"][i])
+            t, p = self.data["t"][i], self.data["p"][i]
+            if count <= self.capacity:
+                return t[:count].copy(), p[:count].copy()
+            head = count % self.capacity
+            return np.roll(t, -head), np.roll(p, -head)
+
+    def downsample(self, tk, since, until, width):
+        """Min and max price of each of width equal time columns between since
+        and until (epoch seconds). NaN where a column has no tick."""
+        t, p = self.series(tk)
+        i0, i1 = np.searchsorted(t, [since, until])
+        t, p = t[i0:i1], p[i0:i1]
+        lo = np.full(width, np.nan)
+        hi = np.full(width, np.nan)
+        if len(t) == 0:
+            return lo, hi
+        cols = ((t - since) * width / (until - since)).astype(np.intp)
+        # Times are sorted, so every column is one run of ticks.
+        starts = np.flatnonzero(np.r_[True, cols[1:] != cols[:-1]])
+        lo[cols[starts]] = np.minimum.reduceat(p, starts)
+        hi[cols[starts]] = np.maximum.reduceat(p, starts)
+        return lo, hi
+
+    def sparkline(self, tk, since, until, width, height, ref=None):
+        """Pixel columns of a symbol's sparkline, hashable (a frame cache key):
+        (((top, bottom) or None for each column), y of ref or None). y is 0 at
+        the top. Each column spans the min/max band of its ticks. ref, e.g. the
+        previous close, is kept inside the scale. None without ticks."""
+        lo, hi = self.downsample(tk, since, until, width)
+        have = ~np.isnan(lo)
+        if not have.any():
+            return None
+        vmin, vmax = lo[have].min(), hi[have].max()
+        if ref is not None:
+            vmin, vmax = min(vmin, ref), max(vmax, ref)
+        scale = (height - 1) / (vmax - vmin) if vmax > vmin else 0.0
+        if scale > 0:
+            top = np.rint((vmax - np.where(have, hi, vmax)) * scale).astype(np.intp)
+            bottom = np.rint((vmax - np.where(have, lo, vmax)) * scale).astype(np.intp)
+        else:  # flat: a line in the middle
+            top = bottom = np.full(width, height // 2)
+        cols = tuple(
+            (int(y0), int(y1)) if ok else None for y0, y1, ok in zip(top, bottom, have)
+        )
+        ref_y = None
+        if ref is not None:
+            ref_y = int(round((vmax - ref) * scale)) if scale > 0 else height // 2
+        return cols, ref_y
+
+    def get_stats(self):
+        with self.lock:
+            ticks = int(np.minimum(self.data["count"], self.capacity).sum())
+        return {"symbols": len(self.symbols), "ticks": ticks, "bytes": self.data.nbytes}
@@ -0,0 +1,230 @@
+import datetime
+
+import pytz
+
+# Session states
+CLOSED = "closed"
+PRE_MARKET = "pre"
+REGULAR = "regular"
+POST_MARKET = "post"
+
+
+def nth_weekday(year, month, weekday, n):
+    "n-th (1-based, -1 for the last) weekday (0: Monday) of the month."
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        offset = (weekday - first.weekday()) % 7 + 7 * (n - 1)
+        return first + datetime.timedelta(days=offset)
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    last = next_month - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def easter(year):
+    "Gregorian Easter Sunday (anonymous algorithm)."
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def observed(day):
+    "Saturday holidays move to Friday, Sunday ones to Monday."
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+
+def nyse_holidays(year):
+    "Full-day NYSE closures of the year, by the exchange's standing rules."
+    days = {
+        nth_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        nth_weekday(year, 2, 0, 3),  # Washington's Birthday
+        easter(year) - datetime.timedelta(days=2),  # Good Friday
+        nth_weekday(year, 5, 0, -1),  # Memorial Day
+        observed(datetime.date(year, 7, 4)),  # Independence Day
+        nth_weekday(year, 9, 0, 1),  # Labor Day
+        nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        observed(datetime.date(year, 12, 25)),  # Christmas
+    }
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() != 5:  # no Friday make-up day in the old year
+        days.add(observed(new_year))
+    if year >= 2022:
+        days.add(observed(datetime.date(year, 6, 19)))  # Juneteenth
+    return days
+
+
+def nyse_half_days(year):
+    "Early closes (13:00): the day before Independence Day, after Thanksgiving, Christmas Eve."
+    days = {nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1)}
+    for month, day in ((7, 3), (12, 24)):
+        date = datetime.date(year, month, day)
+        if date.weekday() < 4:  # Monday to Thursday, else it is a holiday or weekend
+            days.add(date)
+    return days
+
+
+class TradingCalendar(object):
+    def __init__(
+        self,
+        tz="America/New_York",
+        regular=((9, 30), (16, 0)),
+        extended=((4, 0), (20, 0)),
+        half_day_close=(13, 0),
+        extra_closed=(),
+        poll_extended=False,
+        edge_minutes=15,
+        edge_seconds=60,
+        mid_seconds=300,
+        extended_seconds=900,
+    ):
+        """Exchange sessions in the exchange's own time zone, whatever the
+        node's clock is set to. Default: NYSE/Nasdaq with their holidays and
+        early closes.
+        regular/extended: ((open h, m), (close h, m)) of the regular session
+        and of pre-market start / post-market end.
+        extra_closed: more closed dates (unscheduled closures).
+        poll_extended: also refresh during pre and post market.
+        edge_minutes/edge_seconds: refresh every edge_seconds this close to the
+        open and the close. mid_seconds: the rest of the regular session.
+        extended_seconds: pre and post market, if polled."""
+        self.tz = pytz.timezone(tz)
+        self.regular = regular
+        self.extended = extended
+        self.half_day_close = half_day_close
+        self.extra_closed = set(extra_closed)
+        self.poll_extended = poll_extended
+        self.edge = datetime.timedelta(minutes=edge_minutes)
+        self.edge_seconds = edge_seconds
+        self.mid_seconds = mid_seconds
+        self.extended_seconds = extended_seconds
+        self.years = {}  # year -> (holidays, half days)
+
+    def now(self):
+        return datetime.datetime.now(self.tz)
+
+    def local(self, dt=None):
+        "dt (aware, any zone; default now) in exchange time."
+        return self.now() if dt is None else dt.astimezone(self.tz)
+
+    def year_days(self, year):
+        if year not in self.years:
+            self.years[year] = (nyse_holidays(year), nyse_half_days(year))
+        return self.years[year]
+
+    def is_trading_day(self, date):
+        return (
+            date.weekday() < 5
+            and date not in self.year_days(date.year)[0]
+            and date not in self.extra_closed
+        )
+
+    def at(self, date, hm):
+        return self.tz.localize(datetime.datetime.combine(date, datetime.time(*hm)))
+
+    def session_times(self, date):
+        """(pre-market start, open, close, post-market end) of a trading day,
+        aware datetimes. None on a closed day."""
+        if not self.is_trading_day(date):
+            return None
+        close = self.regular[1]
+        post_end = self.extended[1]
+        if date in self.year_days(date.year)[1]:
+            close = self.half_day_close
+            post_end = (close[0] + 4, close[1])  # 17:00 on early-close days
+        return (
+            self.at(date, self.extended[0]),
+            self.at(date, self.regular[0]),
+            self.at(date, close),
+            self.at(date, post_end),
+        )
+
+    def session(self, dt=None):
+        "CLOSED, PRE_MARKET, REGULAR or POST_MARKET at dt (default now)."
+        dt = self.local(dt)
+        times = self.session_times(dt.date())
+        if times is None:
+            return CLOSED
+        pre, open_, close, post = times
+        if open_ <= dt < close:
+            return REGULAR
+        if pre <= dt < open_:
+            return PRE_MARKET
+        if close <= dt < post:
+            return POST_MARKET
+        return CLOSED
+
+    def is_open(self, dt=None):
+        return self.session(dt) == REGULAR
+
+    def next_session_start(self, dt=None):
+        "Next time polling starts again: the open, or pre-market with poll_extended."
+        dt = self.local(dt)
+        date = dt.date()
+        for _ in range(15):  # the longest closure is a few days
+            times = self.session_times(date)
+            if times is not None:
+                start = times[0] if self.poll_extended else times[1]
+                if start > dt:
+                    return start
+            date += datetime.timedelta(days=1)
+        return None
+
+    def last_close(self, dt=None):
+        "Most recent regular-session close at or before dt (default now)."
+        dt = self.local(dt)
+        date = dt.date()
+        for _ in range(15):
+            times = self.session_times(date)
+            if times is not None and times[2] <= dt:
+                return times[2]
+            date -= datetime.timedelta(days=1)
+        return None
+
+    def session_window(self, dt=None):
+        "(open, close) of the regular session at dt (default now), or of the last one before it."
+        dt = self.local(dt)
+        date = dt.date()
+        for _ in range(15):
+            times = self.session_times(date)
+            if times is not None and times[1] <= dt:
+                return times[1], times[2]
+            date -= datetime.timedelta(days=1)
+        return None
+
+    def refresh_delay(self, dt=None):
+        """Seconds until the next quote refresh. Fast around the open and the
+        close, slower mid-session, and when the market is closed, the time
+        until it opens again. A refresh just after the close gets the closing
+        price."""
+        dt = self.local(dt)
+        state = self.session(dt)
+        times = self.session_times(dt.date())
+        if state == REGULAR:
+            _, open_, close, _ = times
+            near_edge = dt - open_ < self.edge or close - dt <= self.edge
+            delay = self.edge_seconds if near_edge else self.mid_seconds
+            # Never sleep past the close: one fetch right after it.
+            return min(delay, (close - dt).total_seconds() + 1)
+        if state in (PRE_MARKET, POST_MARKET) and self.poll_extended:
+            if state == PRE_MARKET:
+                return min(self.extended_seconds, (times[1] - dt).total_seconds())
+            return self.extended_seconds
+        start = self.next_session_start(dt)
+        if start is None:
+            return 24 * 3600.0
+        return max((start - dt).total_seconds(), 1.0)
+
+    def trading_date(self, dt=None):
+        "Exchange-local date, the key of the per-day request counts."
+        return self.local(dt).date()
@@ -1,35 +1,196 @@
+import concurrent.futures as cf
 import datetime
+import json
 import logging as lg
 import requests
+import threading
+import time
 import urllib
 
-import yfinance as yh
+from NodeMetrics import NULL_METRICS
+from Quote import INFO_KEYS, Quote
+from QuoteBroker import QuoteBrokerClient
+from QuoteSnapshotCache import QuoteSnapshotCache
+from TradingCalendar import TradingCalendar
+
+# Appended to the ticker of a row whose quote is stale.
+STALE_MARK = "*"
+
+# The quote fields the display actually uses, the ones a Quote keeps.
+QUOTE_FIELDS = INFO_KEYS
+# Yahoo's multi-symbol quote endpoint: plain JSON, no yfinance or pandas needed.
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+YAHOO_CRUMB_URL = "https://query1.finance.yahoo.com/v1/test/getcrumb"
+
+
+def import_yfinance():
+    """yfinance, imported on first use. It pulls in pandas and NumPy, which
+    takes seconds on a Pi Zero, so nothing imports it at module load. The
+    import lock makes concurrent first calls wait for one import."""
+    import yfinance
+
+    return yfinance
+
+
+def preload_yfinance():
+    "Import yfinance on a background thread, to have it ready for the first fetch."
+    thread = threading.Thread(
+        target=import_yfinance, name="import-yfinance", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def parse_quote_response(data, symbols):
+    "v7 quoteResponse JSON (bytes or str) to {symbol: Quote}, for the symbols asked."
+    quotes = json.loads(data)["quoteResponse"]["result"]
+    return {
+        q["symbol"]: Quote.from_info(q) for q in quotes if q.get("symbol") in symbols
+    }
+
+
+class PooledSession(requests.Session):
+    "Long-lived keep-alive session shared by all tickers. Counts requests, bytes and new connections."
+
+    def __init__(self, pool_size=8, timeout=10.0):
+        super().__init__()
+        self.timeout = timeout  # default for every request, yfinance ones included
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size
+        )
+        self.mount("https://", self.adapter)
+        self.mount("http://", self.adapter)
+        self.request_count = 0
+        self.bytes_received = 0
+        self.connection_count = 0
+        self.count_lock = threading.Lock()
+        self.hooks["response"].append(self.count_response)
+        self.count_connections(self.adapter.poolmanager)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+    def count_response(self, resp, *args, **kwargs):
+        if kwargs.get("stream"):
+            size = int(resp.headers.get("Content-Length", 0))  # do not drain streams
+        else:
+            size = len(resp.content)
+        with self.count_lock:
+            self.request_count += 1
+            self.bytes_received += size
+
+    def count_connections(self, poolmanager):
+        """Count every connection the pools of poolmanager open. The pools' own
+        num_connections is lost when a pool is evicted (pool_connections=4),
+        so each new pool gets its _new_conn wrapped instead."""
+        new_pool = poolmanager._new_pool
+
+        def counting_new_pool(*args, **kwargs):
+            pool = new_pool(*args, **kwargs)
+            new_conn = pool._new_conn
+
+            def counting_new_conn():
+                with self.count_lock:
+                    self.connection_count += 1
+                return new_conn()
+
+            pool._new_conn = counting_new_conn
+            return pool
+
+        poolmanager._new_pool = counting_new_pool
+
+    def connections_opened(self):
+        "Connections opened so far, evicted pools included. Never goes down."
+        return self.connection_count
+
+    def counters(self):
+        return {
+            "requests": self.request_count,
+            "connections": self.connections_opened(),
+            "bytes": self.bytes_received,
+        }
 
 
 class YahooFinanceFetcher:
-    def __init__(self, stock_list):
-        "Call the Yahoo Finance API to fetch the latest stock info"
-        if len(stock_list) > 6:
-            stock_list = stock_list[:6]
-        elif len(stock_list) == 0:
+    def __init__(
+        self,
+        stock_list,
+        quote_url=None,
+        max_workers=8,
+        batch_size=50,
+        ticker_timeout=10.0,
+        refresh_timeout=20.0,
+        fields=QUOTE_FIELDS,
+        snapshot_path=None,
+        snapshot_ttl=900,
+        metrics=None,
+        broker_path=None,
+        calendar=None,
+        history=None,
+    ):
+        """Call the Yahoo Finance API to fetch the latest stock info.
+        quote_url: multi-symbol quote endpoint (v7 "quoteResponse" JSON), e.g.
+        YAHOO_QUOTE_URL. Parsed without pandas, yfinance is never imported. If
+        None, every symbol is fetched through yfinance `.info` instead.
+        max_workers: size of the worker pool used for one refresh.
+        batch_size: symbols per request when quote_url is given.
+        ticker_timeout/refresh_timeout: per-request and whole-refresh deadlines (s).
+        fields: quote fields to request. None asks for the full info dict.
+        Either way only the Quote fields are kept.
+        snapshot_path: where the last good quotes are persisted. None disables it.
+        snapshot_ttl: seconds after which a quote is shown as stale.
+        metrics: NodeMetrics for the fetch/request/parse timings and errors.
+        broker_path: Unix socket of a QuoteBroker. If given, quotes come from
+        the broker, which fetches for every process on the machine.
+        calendar: TradingCalendar of the exchange. Default: NYSE hours.
+        history: TickHistory that gets every fetched price, for the sparklines."""
+        if len(stock_list) == 0:
             lg.error("Empty stock list. Program stopped")
             return
 
         self.stock_list = stock_list
+        self.quote_url = quote_url
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.ticker_timeout = ticker_timeout
+        self.refresh_timeout = refresh_timeout
+        self.fields = fields
+        self.session = PooledSession(pool_size=max_workers, timeout=ticker_timeout)
+        self.last_fetch_stats = {}
+        self.metrics = NULL_METRICS if metrics is None else metrics
         lg.info("Stock List: {0}".format(stock_list))
 
-        self.tks = {x: None for x in self.stock_list}  # assume they are valid
-        self.tks_info = {x: None for x in self.stock_list}
-        self.create_stock_handler()
+        self.tks = {
+            x: None for x in self.stock_list
+        }  # yfinance handles, made per fetch
+        self.crumb = None  # of the Yahoo session, see fetch_crumb
+        self.crumb_lock = threading.Lock()
+        self.tks_info = {x: None for x in self.stock_list}  # Quote records
+        self.tks_ts = {x: None for x in self.stock_list}  # time of the last good fetch
+        self.tks_failed = set()  # failed in the latest refresh
+        self.snapshot = QuoteSnapshotCache(snapshot_path, snapshot_ttl)
+        self.calendar = TradingCalendar() if calendar is None else calendar
+        self.daily_requests = {}  # exchange date -> upstream requests, last week
+        self.history = history
+        self.broker = None
+        if broker_path is not None:
+            self.broker = QuoteBrokerClient(self.stock_list, broker_path)
+
+    def needs_yfinance(self):
+        return self.quote_url is None and self.broker is None
 
     def create_stock_handler(self):
-        "May not need this again. (20201221)"
+        "All handlers share the fetcher's session, so connections and cookies survive across refreshes."
+        yh = import_yfinance()
         for tk in self.stock_list:
-            self.tks[tk] = yh.Ticker(tk)
+            self.tks[tk] = yh.Ticker(tk, session=self.session)
 
     def check_stock_integrity(self, stock_name):
         "Some stock, like UVXY, failed to get info thru API. This function test whether the whole process works for the stock or not."
-        temp_stock = yh.Ticker(stock_name)
+        temp_stock = import_yfinance().Ticker(stock_name, session=self.session)
         try:
             info_d = temp_stock.info
             lg.info("The given stock {0} works well.".format(stock_name))
@@ -39,82 +200,260 @@ class YahooFinanceFetcher:
         return
 
     def refresh_stock_info_dict(self):
-        "Recreate the ticker handlers to triger the fetch."
+        "Fetch the whole watchlist in one go. Symbols that fail or miss the deadline keep their last-known info."
+        fetched = self.fetch_info_dicts(self.stock_list)
+        now = time.time()
+        self.tks_failed = set()
         for tk in self.stock_list:
-            # TODO: this is not elegant. find a better way later.
-            self.tks[tk] = None
-            self.tks[tk] = yh.Ticker(tk)  # re-create the stock handler.
-            try:
-                info_json = self.tks[tk].info  # fetch from server
-            except:  # too many error cases here. will by pass whatever error it is.
-                lg.error("Connection error, waiting for the next round")
-                info_json = {"previousClose": 0, "bid": 0, "ask": 0, "bidSize": 1, "askSize": 1}
-                self.tks_info[tk] = info_json
+            if tk in fetched:
+                self.tks_info[tk] = fetched[tk]
+                self.tks_ts[tk] = now
             else:
-                self.tks_info[tk] = info_json
+                lg.error(
+                    "Connection error ({0}), waiting for the next round".format(tk)
+                )
+                self.tks_failed.add(tk)
+        self.metrics.inc("fetch_failed_symbols_total", len(self.tks_failed))
+        self.record_ticks(fetched, now)
+        if len(fetched) > 0 and self.snapshot.path is not None:
+            self.snapshot.save(
+                {tk: q.to_info() for tk, q in self.tks_info.items() if q is not None},
+                self.tks_ts,
+            )
 
-    def get_stock_markget_price(self):
-        "Price now. Make sure the info dict is refreshed."
+    def record_ticks(self, symbols, t):
+        "Add the current prices of the symbols to the tick history, if any."
+        if self.history is None:
+            return
+        prices = self.get_stock_markget_price()
+        for tk in symbols:
+            if prices.get(tk):
+                self.history.append(tk, t, prices[tk])
+        self.history.flush()
 
-        def calculate_price_quote(bid, bid_size, ask, ask_size):
-            "Weighted average"
-            return (bid * bid_size + ask * ask_size) / (bid_size + ask_size)
+    def load_snapshot(self):
+        "Fill the quotes from the on-disk snapshot. Return True if any quote was restored."
+        if self.snapshot.path is None:
+            return False
+        restored = self.snapshot.load()
+        for tk in self.stock_list:
+            if tk in restored:
+                info, self.tks_ts[tk] = restored[tk]
+                self.tks_info[tk] = Quote.from_info(info)
+        lg.info("Restored {0} quotes from the snapshot.".format(len(restored)))
+        return any(tk in restored for tk in self.stock_list)
 
-        pd = {}  # Price dictionary
+    def stale_symbols(self):
+        """Symbols whose last refresh failed or whose quote is older than the
+        TTL. A quote from after the last close stays valid until the open.
+        The calendar is looked up once for the whole list."""
+        frozen_after = None  # fetch time after which quotes cannot change
+        if not self.calendar.is_open():
+            close = self.calendar.last_close()
+            frozen_after = None if close is None else close.timestamp()
+        now = time.time()
+        stale = set()
         for tk in self.stock_list:
-            if "bid" not in self.tks_info[tk]:
-                lg.error(f"Missing fields: {tk}")
-                #  print(self.tks_info)
-                pd[tk] = 0
+            ts = self.tks_ts[tk]
+            if tk in self.tks_failed:
+                stale.add(tk)
+            elif ts is not None and frozen_after is not None and ts >= frozen_after:
                 continue
-            quotes = calculate_price_quote(
-                self.tks_info[tk]["bid"],
-                self.tks_info[tk]["bidSize"],
-                self.tks_info[tk]["ask"],
-                self.tks_info[tk]["askSize"],
+            elif self.snapshot.is_stale(ts, now):
+                stale.add(tk)
+        return stale
+
+    def is_stale(self, tk):
+        return tk in self.stale_symbols()
+
+    def has_stale_quotes(self):
+        return len(self.stale_symbols()) > 0
+
+    def fetch_info_dicts(self, symbols):
+        """Fetch the quotes of the symbols with a bounded worker pool.
+        Return {symbol: Quote}. Symbols missing from the result failed or did
+        not finish before refresh_timeout."""
+        if len(symbols) == 0:
+            return {}
+        if self.broker is not None:
+            # Quotes older than the snapshot TTL count as failed, shown stale.
+            return self.broker.get_quotes(
+                symbols, max_age=self.snapshot.ttl, timeout=self.ticker_timeout
             )
-            pd[tk] = quotes
-        return pd
+        if self.quote_url is not None:
+            groups = [
+                symbols[i : i + self.batch_size]
+                for i in range(0, len(symbols), self.batch_size)
+            ]
+            job = self.fetch_quote_batch
+        else:
+            groups = [[tk] for tk in symbols]
+            job = self.fetch_ticker_info
 
-    def get_previous_close(self):
-        "Close price. Make sure the info dict is refreshed."
-        pcd = {}
+        before = self.session.counters()
+        t0 = time.monotonic()
+        results = {}
+        pool = cf.ThreadPoolExecutor(max_workers=min(self.max_workers, len(groups)))
+        futures = [pool.submit(job, grp) for grp in groups]
+        try:
+            for fut in cf.as_completed(futures, timeout=self.refresh_timeout):
+                try:
+                    results.update(fut.result())
+                except Exception as e:  # one bad symbol should not spoil the rest
+                    lg.debug("Fetch failed: {0}".format(e))
+                    self.metrics.inc("fetch_errors_total", kind=type(e).__name__)
+        except cf.TimeoutError:
+            self.metrics.inc("fetch_errors_total", kind="deadline")
+            lg.error(
+                "Refresh deadline ({0}s) passed, {1}/{2} symbols fetched".format(
+                    self.refresh_timeout, len(results), len(symbols)
+                )
+            )
+        finally:
+            # Do not wait for the stalled workers. Their results are dropped.
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        after = self.session.counters()
+        self.last_fetch_stats = {k: after[k] - before[k] for k in after}
+        self.last_fetch_stats["seconds"] = time.monotonic() - t0
+        self.metrics.observe("fetch", self.last_fetch_stats["seconds"])
+        self.metrics.inc("fetch_requests_total", self.last_fetch_stats["requests"])
+        self.metrics.inc("fetch_bytes_total", self.last_fetch_stats["bytes"])
+        self.count_daily_requests(self.last_fetch_stats["requests"])
+        lg.debug("Fetch stats: {0}".format(self.last_fetch_stats))
+        return results
+
+    def count_daily_requests(self, requests):
+        "Upstream requests per exchange day. The previous day's total is logged at the rollover."
+        today = self.calendar.trading_date()
+        if today not in self.daily_requests:
+            if len(self.daily_requests) > 0:
+                last_day = max(self.daily_requests)
+                lg.info(
+                    "Upstream requests on {0}: {1}".format(
+                        last_day, self.daily_requests[last_day]
+                    )
+                )
+            self.daily_requests = {
+                day: n
+                for day, n in self.daily_requests.items()
+                if (today - day).days < 7
+            }
+            self.daily_requests[today] = 0
+        self.daily_requests[today] += requests
+
+    def get_daily_requests(self):
+        "{date: upstream requests} for the last 7 days, oldest first."
+        return {
+            day.isoformat(): self.daily_requests[day]
+            for day in sorted(self.daily_requests)
+        }
+
+    def fetch_ticker_info(self, tk_group):
+        "Worker: one yfinance `.info` call per symbol."
+        yh = import_yfinance()
+        info_d = {}
+        for tk in tk_group:
+            # yfinance caches `.info` on the handle, so a fresh handle is needed
+            # to refetch. It is cheap: the connections, cookies and crumb live in
+            # the shared session.
+            self.tks[tk] = yh.Ticker(tk, session=self.session)
+            with self.metrics.timer("fetch_request"):  # request + yfinance parsing
+                info = self.tks[tk].info
+            info_d[tk] = Quote.from_info(info)  # the info dict is dropped here
+        return info_d
+
+    def fetch_crumb(self):
+        """Yahoo answers the quote endpoint only with a consent cookie and the
+        crumb that goes with it. Both live in the shared session."""
+        with self.crumb_lock:
+            if self.crumb is not None:
+                return self.crumb
+            self.session.headers["User-Agent"] = "Mozilla/5.0"
+            try:
+                self.session.get(YAHOO_COOKIE_URL)  # sets the cookie, status 404
+            except requests.RequestException as e:
+                lg.warning("Cookie fetch from fc.yahoo.com failed ({0})".format(e))
+            resp = self.session.get(YAHOO_CRUMB_URL)
+            resp.raise_for_status()
+            self.crumb = resp.text.strip()
+            return self.crumb
+
+    def fetch_quote_batch(self, tk_group):
+        "Worker: one multi-symbol request for the whole group."
+        params = {"symbols": ",".join(tk_group)}
+        if self.fields is not None:
+            params["fields"] = ",".join(self.fields)
+        yahoo = self.quote_url.startswith(YAHOO_QUOTE_URL)
+        if yahoo:
+            params["crumb"] = self.fetch_crumb()
+        with self.metrics.timer("fetch_request"):
+            resp = self.session.get(self.quote_url, params=params)
+        if yahoo and resp.status_code == 401:
+            self.crumb = None  # expired, the next round gets a new one
+        resp.raise_for_status()
+        with self.metrics.timer("parse"):
+            return parse_quote_response(resp.content, tk_group)
+
+    def price_table(self):
+        """[(symbol, price now, previous close)] of the watchlist in one pass.
+        Both are None for a symbol never fetched. A missing bid gives price 0,
+        a missing close 0.00."""
+        table = []
         for tk in self.stock_list:
-            if "previousClose" in self.tks_info[tk]:
-                pcd[tk] = self.tks_info[tk]["previousClose"]
-            else:
-                pcd[tk] = 0.00
-        return pcd
+            quote = self.tks_info[tk]
+            if quote is None:
+                table.append((tk, None, None))  # never fetched
+                continue
+            if quote.bid is None:
+                lg.error(f"Missing fields: {tk}")
+            close = quote.previous_close
+            table.append((tk, quote.market_price(), 0.00 if close is None else close))
+        return table
+
+    def get_stock_markget_price(self):
+        "Price now. Make sure the quotes are refreshed."
+        return {tk: price for tk, price, _ in self.price_table()}
 
-    def format_display_2in7(self):
-        "From dictionary to EPD format."
-        rg_dict = self.get_stock_markget_price()
-        cp_dict = self.get_previous_close()
+    def get_previous_close(self):
+        "Close price. Make sure the quotes are refreshed."
+        return {tk: close for tk, _, close in self.price_table()}
+
+    def format_display_2in7(self, spark_size=None):
+        """From dictionary to EPD format.
+        spark_size: (width, height) in pixels. With a tick history, every row
+        gets the symbol's sparkline of the last session as a third element."""
         text_list = []
+        window = None
+        if spark_size is not None and self.history is not None:
+            window = self.calendar.session_window()
 
-        for tk in self.stock_list:
-            text_buf = "{0:.2f}".format(rg_dict[tk])
-            price_diff = rg_dict[tk] - cp_dict[tk]
+        stale = self.stale_symbols()
+        for tk, price, close in self.price_table():
+            if price is None:
+                text_list.append((tk, "  Service N/A"))
+                continue
+            text_buf = "{0:.2f}".format(price)
+            price_diff = price - close
 
             if price_diff < 0:
                 text_buf += " ▼{0:.2f}".format(-price_diff)
             else:
                 text_buf += " ▲{0:.2f}".format(price_diff)
-            text_list.append((tk, text_buf))
+            row = (tk + STALE_MARK if tk in stale else tk, text_buf)
+            if window is not None:
+                since, until = (dt.timestamp() for dt in window)
+                row += (
+                    self.history.sparkline(
+                        tk, since, until, *spark_size, ref=close or None
+                    ),
+                )
+            text_list.append(row)
         return text_list
 
     def is_market_open(self):
-        "Determine whether the market is open"
-        td = datetime.datetime.today()
-        wd = td.weekday()
-        if wd >= 5:
-            return False
-        hour = td.hour
-        minu = td.minute
-        if not (8, 55) <= (hour, minu) <= (16, 55):
-            return False
-
-        return True
+        "Determine whether the market is open: regular session, exchange time, holidays and early closes."
+        return self.calendar.is_open()
 
     def is_working_time(self):
         "Determine whether to show the up-right sign"
@@ -34,22 +34,14 @@ def test_epd2in7_main(demo_choice=1):
     elif demo_choice == 4:
         btns = EpdHatButtonHandler()
         while True:
-            key_pressed = -1
-            for idx, st in enumerate(btns.status_table):
-                if st == 1:
-                    key_pressed = idx + 1
-                    break
-
-            if key_pressed != -1:
-                disp_drv.debug_button_press_display(key_pressed)
-                btns.clear_status()
-
-            time.sleep(0.5)
+            event = btns.get_event()  # blocks until a key is pressed
+            disp_drv.debug_button_press_display(event.key)
+            btns.mark_handled(event)
 
     elif demo_choice == 5:
         disp_drv.display_clock_current_time()
-        schedule.every(3).minutes.do(disp_drv.display_clock_current_time)
-        # Do not update that too frequently.
+        schedule.every(1).minutes.do(disp_drv.display_clock_current_time)
+        # Partial refresh of the changed digits only.
         while True:
             schedule.run_pending()
             time.sleep(1)
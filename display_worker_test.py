@@ -0,0 +1,32 @@
+import threading
+
+from DisplayWorker import DisplayWorker
+
+
+def test_replaced_full_frame_stays_full():
+    worker = DisplayWorker()
+    started, release = threading.Event(), threading.Event()
+    shown = []
+
+    def busy_frame():
+        started.set()
+        release.wait()
+
+    worker.submit(busy_frame)  # keeps the worker busy while frames queue up
+    assert started.wait(timeout=5)
+    worker.submit(lambda page, full=False: shown.append((page, full)), 1, full=True)
+    worker.submit(lambda page, full=False: shown.append((page, full)), 2)
+    release.set()
+    assert worker.wait_idle(timeout=5)
+    worker.stop()
+    assert shown == [(2, True)]
+    assert worker.get_stats()["dropped"] == 1
+
+
+def test_partial_frames_stay_partial():
+    worker = DisplayWorker()
+    shown = []
+    worker.submit(lambda page, full=False: shown.append((page, full)), 1)
+    assert worker.wait_idle(timeout=5)
+    worker.stop()
+    assert shown == [(1, False)]
@@ -0,0 +1,67 @@
+import logging
+import os.path as op
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+from Display2In7Driver import pack_1bit, pack_4gray
+
+logging.basicConfig(
+    format="\033[92m[%(levelname)s]\033[00m %(message)s", level=logging.INFO
+)
+
+
+def make_test_images(width, height):
+    "A stock-page-like 1-bit canvas and a 4-gray canvas, both landscape."
+    font_dir = op.join(op.dirname(op.realpath(__file__)), "fonts")
+    font24 = ImageFont.truetype(op.join(font_dir, "LiberationSans-Regular.ttf"), 24)
+    mono = Image.new("1", (height, width), 1)
+    drawer = ImageDraw.Draw(mono)
+    for row in range(6):
+        drawer.text((10, row * 28 + 4), "TSLA  668.90 ▲13.00", font=font24, fill=0)
+
+    gray = Image.new("L", (height, width), 0xFF)
+    drawer = ImageDraw.Draw(gray)
+    for row, fill in enumerate([0x00, 0x80, 0xC0, 0x00, 0x80, 0xC0]):
+        drawer.text((10, row * 28 + 4), "AAPL  128.96 ▲0.26", font=font24, fill=fill)
+    return mono, gray
+
+
+def best_of(func, image, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func(image)
+        sec = time.perf_counter() - t0
+        best = sec if best is None else min(best, sec)
+    return best, bytes(out)
+
+
+def pack_benchmark_main(repeat=5):
+    "Vendor per-pixel getbuffer vs the driver's packing, with a byte-identical check."
+    from waveshare_epd import epd2in7  # only on the Pi
+
+    epd = epd2in7.EPD()  # no init(): only the geometry is needed
+    mono, gray = make_test_images(epd.width, epd.height)
+    cases = [
+        ("1-bit", mono, epd.getbuffer, pack_1bit),
+        ("4-gray", gray, epd.getbuffer_4Gray, pack_4gray),
+    ]
+    for name, image, vendor_func, fast_func in cases:
+        vendor_sec, vendor_buf = best_of(vendor_func, image, repeat)
+        fast_sec, fast_buf = best_of(
+            lambda im: fast_func(im, epd.width, epd.height), image, repeat
+        )
+        logging.info(
+            "{0:6s} | vendor {1:8.2f} ms | driver {2:6.2f} ms | {3:6.1f}x | identical: {4}".format(
+                name,
+                vendor_sec * 1000,
+                fast_sec * 1000,
+                vendor_sec / fast_sec,
+                vendor_buf == fast_buf,
+            )
+        )
+
+
+if __name__ == "__main__":
+    pack_benchmark_main()
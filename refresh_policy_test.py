@@ -0,0 +1,24 @@
+from RefreshPolicy import FULL, PARTIAL, RefreshPolicy
+
+TICKERS = ["AAPL", "ARKW", "TSLA", "U", "TQQQ", "MSFT"]
+
+
+def stock_rows(prices, spark):
+    return [(tk, "{0:.2f}".format(prices[tk]), ((spark, spark),) * 4) for tk in TICKERS]
+
+
+def test_sparkline_only_rows_do_not_force_full():
+    policy = RefreshPolicy()
+    prices = {tk: 100.0 for tk in TICKERS}
+    assert policy.decide(stock_rows(prices, 1), prices, now=0) == FULL
+    # One symbol past its threshold, the other rows only got a new sparkline.
+    prices = dict(prices, TSLA=101.0)
+    assert policy.decide(stock_rows(prices, 2), prices, now=60) == PARTIAL
+
+
+def test_most_rows_moved_is_full():
+    policy = RefreshPolicy()
+    prices = {tk: 100.0 for tk in TICKERS}
+    policy.decide(stock_rows(prices, 1), prices, now=0)
+    prices = {tk: 101.0 for tk in TICKERS}
+    assert policy.decide(stock_rows(prices, 1), prices, now=60) == FULL
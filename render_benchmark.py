@@ -0,0 +1,112 @@
+import logging
+import os.path as op
+import time
+import tracemalloc
+
+from PIL import Image, ImageDraw, ImageFont
+
+from FontRegistry import FONT_FACES, FontRegistry
+from GlyphAtlas import GlyphAtlas
+
+logging.basicConfig(
+    format="\033[92m[%(levelname)s]\033[00m %(message)s", level=logging.INFO
+)
+
+font_dir = op.join(op.dirname(op.realpath(__file__)), "fonts")
+
+
+def timed_alloc(func, repeat=1):
+    "Return (seconds per call, peak bytes allocated) of func()."
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    sec = (time.perf_counter() - t0) / repeat
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return sec, peak
+
+
+def eager_fonts():
+    "What set_font() used to do at construction: nine faces loaded up front."
+    return [
+        ImageFont.truetype(op.join(font_dir, FONT_FACES[face]), size)
+        for face in ("sans", "mono", "mono_bold")
+        for size in (18, 24, 35)
+    ]
+
+
+def first_page_fonts():
+    "The stock page only needs two of them."
+    fonts = FontRegistry(font_dir)
+    return fonts.get("mono_bold", 24), fonts.get("sans", 24)
+
+
+def clock_render(font_getter):
+    canvas = Image.new("1", (264, 176), 1)
+    ImageDraw.Draw(canvas).text((5, 0), "12:34", font=font_getter(), fill=0)
+    return canvas
+
+
+def font_benchmark_main(repeat=20):
+    sec, peak = timed_alloc(eager_fonts)
+    logging.info(
+        "startup, eager 9 fonts   | {0:7.2f} ms | peak {1:8d} B".format(
+            sec * 1000, peak
+        )
+    )
+    sec, peak = timed_alloc(first_page_fonts)
+    logging.info(
+        "startup, lazy registry   | {0:7.2f} ms | peak {1:8d} B".format(
+            sec * 1000, peak
+        )
+    )
+
+    clk_path = op.join(font_dir, FONT_FACES["sans"])
+    sec, peak = timed_alloc(
+        lambda: clock_render(lambda: ImageFont.truetype(clk_path, 100)), repeat
+    )
+    logging.info(
+        "clock render, truetype() | {0:7.2f} ms | peak {1:8d} B".format(
+            sec * 1000, peak
+        )
+    )
+    fonts = FontRegistry(font_dir)
+    fonts.get("sans", 100)  # warm
+    sec, peak = timed_alloc(
+        lambda: clock_render(lambda: fonts.get("sans", 100)), repeat
+    )
+    logging.info(
+        "clock render, registry   | {0:7.2f} ms | peak {1:8d} B".format(
+            sec * 1000, peak
+        )
+    )
+
+    sec, _ = timed_alloc(lambda: fonts.measure("668.90 ▲13.00", "sans", 24), repeat)
+    logging.info("text measure, cached     | {0:7.4f} ms".format(sec * 1000))
+
+
+def clock_benchmark_main(repeat=50):
+    "A clock frame drawn with PIL and packed vs composed from the glyph atlas."
+    from Display2In7Driver import pack_1bit
+
+    fonts = FontRegistry(font_dir)
+    clk_font = fonts.get("sans", 100)
+    t0 = time.perf_counter()
+    atlas = GlyphAtlas(clk_font)
+    logging.info(
+        "glyph atlas build        | {0:7.2f} ms".format(
+            (time.perf_counter() - t0) * 1000
+        )
+    )
+    sec, _ = timed_alloc(
+        lambda: pack_1bit(clock_render(lambda: clk_font), 176, 264), repeat
+    )
+    logging.info("clock frame, draw + pack | {0:7.3f} ms".format(sec * 1000))
+    sec, _ = timed_alloc(lambda: atlas.compose("12:34"), repeat)
+    logging.info("clock frame, atlas blit  | {0:7.3f} ms".format(sec * 1000))
+
+
+if __name__ == "__main__":
+    font_benchmark_main()
+    clock_benchmark_main()
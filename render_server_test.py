@@ -0,0 +1,54 @@
+import time
+
+from Display2In7Driver import Display2In7Driver
+from EpdSimulator import SimulatedEPD
+from RenderServer import RemoteNodeDriver, RenderClient, RenderServer
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_frames_and_windows_reach_two_nodes():
+    server = RenderServer(port=0)
+    nodes = {}
+    for node_id in ("desk-1", "desk-2"):
+        sim = SimulatedEPD()
+        local = Display2In7Driver(node_id, epd=sim)
+        client = RenderClient(
+            "127.0.0.1",
+            server.port,
+            node_id,
+            lambda buf, full, drv=local: drv.show_buffer(buf, full),
+        )
+        client.start()
+        nodes[node_id] = (RemoteNodeDriver(server, node_id), client, sim)
+    try:
+        assert wait_for(lambda: len(server.connected_nodes()) == 2)
+        rows = {
+            "desk-1": [("AAPL", "1.00 ▲0.1"), ("MSFT", "2.00 ▼0.2")],
+            "desk-2": [("TSLA", "3.00 ▲0.3"), ("U", "4.00 ▼0.4")],
+        }
+        for node_id, (remote, client, sim) in nodes.items():
+            remote.display_stock_ft24_page(rows[node_id])
+        for node_id, (remote, client, sim) in nodes.items():
+            assert wait_for(lambda: sim.glass == remote.last_frame)
+            assert client.stats["frames"] == 1
+        # One price changes: only its windows go out.
+        rows["desk-1"][0] = ("AAPL", "1.05 ▲0.1")
+        remote, client, sim = nodes["desk-1"]
+        remote.display_stock_ft24_page(rows["desk-1"])
+        assert wait_for(lambda: client.stats["windows"] == 1)
+        assert wait_for(lambda: sim.glass == remote.last_frame)
+        for node_id, (remote, client, sim) in nodes.items():
+            assert sim.glass == remote.last_frame
+        assert nodes["desk-2"][1].stats["windows"] == 0
+    finally:
+        for remote, client, sim in nodes.values():
+            client.stop()
+        server.stop()
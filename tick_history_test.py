@@ -0,0 +1,30 @@
+import numpy as np
+
+from TickHistory import TickHistory
+
+
+def test_fast_ticks_advance_the_buffer():
+    # 100 ticks 5 s apart: one kept per 30 s bucket, the last one of each.
+    history = TickHistory(["A"], capacity=16, min_interval=30)
+    for i in range(100):
+        history.append("A", 1000.0 + i * 5, 100.0 + i)
+    t, p = history.series("A")
+    assert len(t) == 16
+    assert np.all(np.diff(t) == 30)
+    assert t[-1] == 1495.0 and p[-1] == 199.0
+    assert t[0] == 1045.0 and p[0] == 109.0
+
+
+def test_slow_ticks_are_all_kept():
+    history = TickHistory(["A"], capacity=16, min_interval=30)
+    for i in range(10):
+        history.append("A", 1000.0 + i * 60, 100.0 + i)
+    t, p = history.series("A")
+    assert list(t) == [1000.0 + i * 60 for i in range(10)]
+    assert list(p) == [100.0 + i for i in range(10)]
+
+
+def test_unknown_symbol_is_ignored():
+    history = TickHistory(["A"], capacity=4)
+    history.append("B", 1000.0, 1.0)
+    assert history.get_stats()["ticks"] == 0
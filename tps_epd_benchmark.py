@@ -0,0 +1,324 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from Display2In7Driver import Display2In7Driver, pack_1bit, pack_4gray
+from EpdSimulator import MockSpiLink, SimulatedEPD, VendorSpiEPD
+from pack_benchmark import make_test_images
+from SpiTransfer import SpiTransfer
+from yahoo_finance_benchmark import start_stub_server
+from YahooFinanceFetcher import YahooFinanceFetcher
+
+logging.basicConfig(
+    format="\033[92m[%(levelname)s]\033[00m %(message)s", level=logging.INFO
+)
+
+STOCK_ROWS = [
+    ("AAPL", "128.96 ▲0.26"),
+    ("ARKW", "151.05 ▲1.59"),
+    ("TSLA", "668.90 ▲13.00"),
+    ("U", "101.33 ▼2.10"),
+    ("TQQQ", "88.15 ▲0.95"),
+    ("MSFT", "222.75 ▼0.42"),
+]
+
+# Run in fresh interpreters, so that nothing is imported yet. Each prints
+# "seconds peak-RSS-KiB [yfinance import done]".
+IMPORT_SCRIPT = """
+import resource, time
+t0 = time.perf_counter()
+import {0}
+print(time.perf_counter() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+FIRST_FRAME_SCRIPT = """
+import os, resource, sys, time
+t0 = time.perf_counter()
+import Display2In7Driver
+show_buffer = Display2In7Driver.Display2In7Driver.show_buffer
+
+def first_frame(self, buf, full=False, windows=None):
+    show_buffer(self, buf, full, windows)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    done = hasattr(sys.modules.get("yfinance"), "Ticker")  # not just started
+    print(time.perf_counter() - t0, rss, done, flush=True)
+    os._exit(0)
+
+Display2In7Driver.Display2In7Driver.show_buffer = first_frame
+import tps_epd_node_main
+tps_epd_node_main.epd_node_main()
+"""
+
+
+def measure(func, repeat):
+    """Run func() repeat times. Return min/median seconds and the peak Python
+    heap of one extra traced run."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "peak_bytes": peak,
+        "repeat": repeat,
+    }
+
+
+def make_sim_driver():
+    "A driver on the simulated panel, caches off so every call does the work."
+    return Display2In7Driver("BENCH", epd=SimulatedEPD(), frame_cache_bytes=0)
+
+
+def fetch_benchmarks(latency, failure_rate, repeat):
+    results = {}
+    server = start_stub_server(latency)
+    flaky = start_stub_server(latency, failure_rate)
+    for n in (6, 50):
+        symbols = ["S{0:03d}".format(i) for i in range(n)]
+        yhff = YahooFinanceFetcher(symbols[:1], quote_url=server.quote_url)
+        results["fetch_{0}".format(n)] = measure(
+            lambda: yhff.fetch_info_dicts(symbols), repeat
+        )
+    symbols = ["S{0:03d}".format(i) for i in range(6)]
+    yhff = YahooFinanceFetcher(symbols, quote_url=flaky.quote_url, batch_size=1)
+    results["fetch_6_flaky"] = measure(yhff.refresh_stock_info_dict, repeat)
+    server.shutdown()
+    flaky.shutdown()
+    return results
+
+
+def render_benchmarks(repeat):
+    drv = make_sim_driver()
+    drv.display_clock_current_time()  # build the glyph atlas outside the timing
+    return {
+        "render_stock_page": measure(
+            lambda: drv.render_stock_ft24_page(STOCK_ROWS), repeat
+        ),
+        "render_clock": measure(lambda: drv.clock_atlas.compose("12:34"), repeat),
+        "render_reminder": measure(drv.render_posture_reminder_sign, repeat),
+    }
+
+
+def pack_benchmarks(repeat):
+    mono, gray = make_test_images(176, 264)
+    return {
+        "pack_1bit": measure(lambda: pack_1bit(mono, 176, 264), repeat),
+        "pack_4gray": measure(lambda: pack_4gray(gray, 176, 264), repeat),
+    }
+
+
+def transfer_benchmarks(repeat):
+    "Driver to simulated panel. Two alternating frames so that nothing is skipped."
+    drv = make_sim_driver()
+    frames = [
+        drv.pack_frame(drv.render_stock_ft24_page(STOCK_ROWS)),
+        drv.pack_frame(drv.render_stock_ft24_page(STOCK_ROWS[:5] + [("MSFT", "0")])),
+    ]
+    state = {"i": 0}
+
+    def push(full):
+        state["i"] += 1
+        drv.show_buffer(frames[state["i"] % 2], full=full)
+
+    return {
+        "transfer_full": measure(lambda: push(True), repeat),
+        "transfer_partial": measure(lambda: push(False), repeat),
+    }
+
+
+def spi_benchmarks(repeat):
+    """The same full and partial updates through the vendor's byte-wise EPD and
+    through SpiTransfer, each on a mock SPI link. Raises when the bytes on
+    the bus differ. Both times include the simulated controller, which
+    decodes every byte."""
+    links = {"vendor": MockSpiLink(), "bulk": MockSpiLink()}
+    drivers = {
+        "vendor": Display2In7Driver(
+            "VENDOR",
+            epd=VendorSpiEPD(links["vendor"]),
+            frame_cache_bytes=0,
+            transfer=False,
+        ),
+        "bulk": Display2In7Driver(
+            "BULK",
+            epd=VendorSpiEPD(links["bulk"]),
+            frame_cache_bytes=0,
+            transfer=SpiTransfer(links["bulk"]),
+        ),
+    }
+    frames = [
+        drivers["bulk"].pack_frame(drivers["bulk"].render_stock_ft24_page(rows))
+        for rows in (STOCK_ROWS, STOCK_ROWS[:5] + [("MSFT", "0")])
+    ]
+    results = {}
+    for path, drv in drivers.items():
+        state = {"i": 0}
+
+        def push(full):
+            state["i"] += 1
+            drv.show_buffer(frames[state["i"] % 2], full=full)
+
+        links[path].reset_counts()
+        push(True)
+        logging.info(
+            "{0:6s} SPI path: {1} SPI writes, {2} pin writes for one full frame".format(
+                path, links[path].writes, links[path].pin_writes
+            )
+        )
+        results["spi_full_" + path] = measure(lambda: push(True), repeat)
+        results["spi_partial_" + path] = measure(lambda: push(False), repeat)
+    vendor, bulk = links["vendor"], links["bulk"]
+    if vendor.stream() != bulk.stream() or vendor.epd.glass != bulk.epd.glass:
+        raise RuntimeError("Bulk SPI byte stream differs from the vendor path")
+    logging.info(
+        "Bulk SPI byte stream identical to the vendor path ({0} bytes)".format(
+            len(bulk.data)
+        )
+    )
+    return results
+
+
+def pipeline_benchmarks(latency, repeat):
+    "Fetch, format, render, pack and push one stock page."
+    server = start_stub_server(latency)
+    drv = make_sim_driver()
+    yhff = YahooFinanceFetcher([tk for tk, _ in STOCK_ROWS], quote_url=server.quote_url)
+
+    def pipeline():
+        yhff.refresh_stock_info_dict()
+        drv.display_stock_ft24_page(yhff.format_display_2in7())
+
+    results = {"pipeline_stock": measure(pipeline, repeat)}
+    server.shutdown()
+    return results
+
+
+def measure_process(script, repeat):
+    """Run a child script repeat times. Return min/median of the seconds it
+    reports, its peak RSS in bytes, and the rest of its last output line."""
+    here = os.path.dirname(os.path.realpath(__file__))
+    env = dict(os.environ, TPS_EPD_BACKEND="sim", PYTHONPATH=here)
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=here,
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=120,
+            check=True,
+        ).stdout.split()
+        times.append(float(out[0]))
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "peak_bytes": int(out[1]) * 1024,
+        "repeat": repeat,
+    }, out[2:]
+
+
+def startup_benchmarks(repeat):
+    """Import times of the heavy modules, and the time from an empty
+    interpreter to the node's first frame on the simulated panel."""
+    results = {}
+    for module in ("Display2In7Driver", "YahooFinanceFetcher", "yfinance"):
+        results["import_" + module], _ = measure_process(
+            IMPORT_SCRIPT.format(module), repeat
+        )
+    results["first_frame"], rest = measure_process(FIRST_FRAME_SCRIPT, repeat)
+    results["first_frame"]["yfinance_loaded"] = rest == ["True"]
+    return results
+
+
+def compare(results, baseline, tolerance):
+    "Return the regressions: metrics worse than the baseline by more than tolerance."
+    regressions = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("median_s", "peak_bytes"):
+            if base[metric] > 0 and cur[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    "{0}.{1}: {2:.6g} > {3:.6g}".format(
+                        name, metric, cur[metric], base[metric]
+                    )
+                )
+    return regressions
+
+
+def benchmark_main(args):
+    results = {}
+    stages = args.stages.split(",")
+    if "fetch" in stages:
+        results.update(fetch_benchmarks(args.latency, args.failure_rate, args.repeat))
+    if "render" in stages:
+        results.update(render_benchmarks(args.repeat))
+    if "pack" in stages:
+        results.update(pack_benchmarks(args.repeat))
+    if "transfer" in stages:
+        results.update(transfer_benchmarks(args.repeat))
+    if "spi" in stages:
+        results.update(spi_benchmarks(args.repeat))
+    if "pipeline" in stages:
+        results.update(pipeline_benchmarks(args.latency, args.repeat))
+    if "startup" in stages:
+        results.update(startup_benchmarks(max(args.repeat // 3, 1)))
+
+    for name, r in results.items():
+        logging.info(
+            "{0:20s} | median {1:9.3f} ms | min {2:9.3f} ms | peak {3:9d} B".format(
+                name, r["median_s"] * 1000, r["min_s"] * 1000, r["peak_bytes"]
+            )
+        )
+    report = {
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "latency": args.latency,
+            "failure_rate": args.failure_rate,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    logging.info("Results written to {0}".format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            logging.error("Regression: {0}".format(line))
+        if len(regressions) > 0:
+            return 1
+        logging.info("No regression against {0}".format(args.compare))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TPS-EPD stage benchmarks")
+    parser.add_argument(
+        "--stages", default="fetch,render,pack,transfer,spi,pipeline,startup"
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub delay (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.3)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="baseline results file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    sys.exit(benchmark_main(parser.parse_args()))
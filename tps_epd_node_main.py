@@ -1,11 +1,24 @@
-import datetime
+import concurrent.futures as cf
 import logging
-import time
+import os
 import urllib
 
 #import schedule
-from Display2In7Driver import Display2In7Driver, EpdHatButtonHandler
-from YahooFinanceFetcher import YahooFinanceFetcher
+from Display2In7Driver import (
+    SPARK_HEIGHT,
+    SPARK_WIDTH,
+    Display2In7Driver,
+    EpdHatButtonHandler,
+)
+from DisplayWorker import DisplayWorker
+from EpdSimulator import FakeButtonSource, SimulatedEPD
+from NodeMetrics import NULL_METRICS, NodeMetrics, start_metrics_server
+from NodeScheduler import NodeScheduler, seconds_to_next_minute
+from QuoteStream import QuoteStream
+from RefreshPolicy import FULL, SKIP, RefreshPolicy
+from RenderServer import RenderClient
+from TradingCalendar import CLOSED
+from YahooFinanceFetcher import YahooFinanceFetcher, preload_yfinance
 
 logging.basicConfig(
     format="\033[92m[%(levelname)s]\033[00m %(message)s", level=logging.INFO
@@ -14,122 +27,390 @@ logging.basicConfig(
 # State machine (macro)
 NULL_STATE = 0
 STOCK_STREAMING = 1
-POSTURE_REMINDER = 2
 CLOCK = 3
 
 stk_list = ["AAPL", "ARKW", "TSLA", "U", "TQQQ", "MSFT"]
+CLOCK_REFRESH_MINUTES = 1  # cheap now: glyph atlas + partial refresh
+# The fetch cadence follows the trading calendar, see TradingCalendar.refresh_delay.
+STOCK_RETRY_SECONDS = 300  # stale quotes are retried this often, even when closed
+STREAM_RENDER_SECONDS = 5  # streamed changes are drawn at most this often
+POSTURE_REMINDER_SECONDS = 300
+POSTURE_SIGN_SECONDS = 5  # how long the reminder stays before switching back
+PAGE_ROTATE_SECONDS = 20  # watchlists longer than one page flip through
+# Refresh policy: price moves smaller than the threshold wait, see RefreshPolicy.
+STOCK_THRESHOLDS = {}  # symbol -> (dollars, percent), e.g. {"TQQQ": (None, 0.5)}
+STOCK_DEFAULT_THRESHOLD = (None, 0.1)  # 0.1 % of the shown price
+STOCK_MAX_STALENESS_SECONDS = 900  # smaller moves are shown after this
+STOCK_REFRESHES_PER_HOUR = 30  # panel refreshes for quotes, key presses excepted
+# "sim": run headless with the simulated panel and no buttons, see EpdSimulator.
+backend = os.environ.get("TPS_EPD_BACKEND", "waveshare")
+snapshot_path = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "quote_snapshot.json"
+)
+# Price ticks for the sparklines, memory-mapped so a restart keeps the day.
+history_path = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "tick_history.npy"
+)
+# Metrics are off unless one of these is set: a port for the /metrics endpoint,
+# and/or a file rewritten every METRICS_FILE_SECONDS.
+metrics_port = os.environ.get("TPS_EPD_METRICS_PORT")
+metrics_file = os.environ.get("TPS_EPD_METRICS_FILE")
+METRICS_FILE_SECONDS = 60
+# "host:port" of a tps_epd_render_server.py: run as a thin node that only shows
+# the frames it gets, see thin_node_main().
+render_server = os.environ.get("TPS_EPD_RENDER_SERVER")
+# Unix socket of a tps_epd_quote_broker.py: quotes come from it instead of Yahoo.
+quote_broker = os.environ.get("TPS_EPD_QUOTE_BROKER")
+# Multi-symbol quote endpoint, e.g. YahooFinanceFetcher.YAHOO_QUOTE_URL: plain
+# JSON, yfinance and pandas are never imported. Default: yfinance, imported in
+# the background after the first frame.
+quote_url = os.environ.get("TPS_EPD_QUOTE_URL")
+node_id = os.environ.get("TPS_EPD_NODE_ID", "desk-1")
+# URL of a quote stream, see QuoteStream: Yahoo's push streamer,
+# wss://streamer.finance.yahoo.com/?version=2 (QuoteStream.YAHOO_STREAM_URL),
+# or a local newline-delimited JSON stand-in over HTTP, e.g. the /stream of
+# tps_epd_quote_broker.py --stream-port. Polling only runs while the stream is down.
+quote_stream = os.environ.get("TPS_EPD_QUOTE_STREAM")
+# Time zone of the clock page, e.g. "US/Pacific". Default: the node's local time.
+clock_tz = os.environ.get("TPS_EPD_CLOCK_TZ")
+# "0": upload frames byte by byte through the vendor EPD instead of SpiTransfer.
+bulk_spi = os.environ.get("TPS_EPD_BULK_SPI", "1") != "0"
 
 
 def epd_node_main():
-    "The information from the submodules is merged here and redistributed to the corresponding destination modules. Timestamp-based state machine"
+    "The information from the submodules is merged here and redistributed to the corresponding destination modules. Deadline-driven state machine: the process sleeps until the next job or button press."
 
     # Handler/Driver initialization
-    disp_drv = Display2In7Driver("HW")
-    yhff = YahooFinanceFetcher(stk_list)
-    btns = EpdHatButtonHandler()
+    if metrics_port is not None or metrics_file is not None:
+        metrics = NodeMetrics()
+    else:
+        metrics = NULL_METRICS
+    if backend == "sim":
+        disp_drv = Display2In7Driver(
+            "SIM", epd=SimulatedEPD(), metrics=metrics, clock_tz=clock_tz
+        )
+        button_factory = FakeButtonSource()
+    else:
+        disp_drv = Display2In7Driver(
+            "HW",
+            metrics=metrics,
+            clock_tz=clock_tz,
+            transfer=None if bulk_spi else False,
+        )
+        button_factory = None
+    # every draw goes through here, never blocks
+    display = DisplayWorker(metrics=metrics)
+    yhff = YahooFinanceFetcher(
+        stk_list,
+        quote_url=quote_url,
+        snapshot_path=snapshot_path,
+        metrics=metrics,
+        broker_path=quote_broker,
+    )
+    sched = NodeScheduler()
+    btns = EpdHatButtonHandler(on_event=sched.post_event, button_factory=button_factory)
+    # Packs the stock pages ahead, off the display thread.
+    prerender = cf.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prerender")
+    # Quote fetches, off the scheduler thread: key presses never wait for one.
+    fetcher = cf.ThreadPoolExecutor(max_workers=1, thread_name_prefix="fetch")
+    policy = RefreshPolicy(
+        thresholds=STOCK_THRESHOLDS,
+        default_threshold=STOCK_DEFAULT_THRESHOLD,
+        max_staleness=STOCK_MAX_STALENESS_SECONDS,
+        refreshes_per_hour=STOCK_REFRESHES_PER_HOUR,
+        metrics=metrics,
+    )
+
+    state = {
+        "run": STOCK_STREAMING,  # state machine
+        "stock_list": None,  # what the stock pages show
+        "page": 0,  # stock page on screen
+        "overlay": False,  # posture sign on screen
+        "refresh_count": 0,
+        "prev_refresh_quotient": -1,
+        "fetching": False,  # a fetch is running on the fetcher thread
+        "force_pending": False,  # a forced refresh came in during the fetch
+    }
+
+    def show_stock_page(t_input=None, full=False):
+        display.submit(
+            disp_drv.display_stock_ft24_page,
+            state["stock_list"],
+            state["page"],
+            full=full,
+            t_input=t_input,
+        )
+
+    def set_stock_list(stock_disp_list):
+        "New rows: pack the pages in the background, only those whose rows changed."
+        state["stock_list"] = stock_disp_list
+        state["page"] %= len(disp_drv.stock_pages(stock_disp_list))
+        prerender.submit(disp_drv.prerender_stock_pages, stock_disp_list)
+
+    def update_stock_list(stock_disp_list, force=False):
+        "New rows: on the panel if the refresh policy finds them worth a refresh."
+        decision = policy.decide(
+            stock_disp_list, yhff.get_stock_markget_price(), force=force
+        )
+        if decision == SKIP:
+            return
+        set_stock_list(stock_disp_list)
+        if not state["overlay"]:  # else shown when the sign goes away
+            show_stock_page(full=decision == FULL)
+        count_refresh()
+
+    has_snapshot = yhff.load_snapshot()
+    if not has_snapshot:
+        display.submit(disp_drv.display_stock_welcome_screen, yhff.stock_list)
+    # numpy and the memory-mapped ticks, after the welcome frame is queued.
+    from TickHistory import TickHistory
+
+    history = yhff.history = TickHistory(stk_list, path=history_path)
+    if has_snapshot:
+        # Last-known prices first. Stale rows are marked, the first job refreshes them.
+        set_stock_list(yhff.format_display_2in7(spark_size=(SPARK_WIDTH, SPARK_HEIGHT)))
+        show_stock_page()
+    if yhff.needs_yfinance():
+        # The first frame is queued: load the data stack while the panel refreshes.
+        preload_yfinance()
+
+    def collect_node_metrics():
+        key_stats = btns.get_latency_stats()
+        return [
+            ("scheduler_wakeups_per_hour", {}, sched.wakeups_per_hour()),
+            ("key_events_total", {}, key_stats["count"]),
+            ("key_latency_avg_seconds", {}, key_stats.get("avg")),
+            ("key_bounces_total", {}, key_stats["bounces"]),
+            ("upstream_requests_today", {}, upstream_requests_today()),
+            ("tick_history_bytes", {}, history.get_stats()["bytes"]),
+        ]
+
+    metrics.add_collector(collect_node_metrics)
+    if metrics_port is not None:
+        start_metrics_server(metrics, int(metrics_port))
+
+    def upstream_requests_today():
+        return yhff.daily_requests.get(yhff.calendar.trading_date(), 0)
+
+    def metrics_file_job():
+        metrics.write_file(metrics_file)
+
+    def count_refresh():
+        state["refresh_count"] += 1
+        refresh_count = state["refresh_count"]
+        if (
+            refresh_count % 10 == 0
+            and refresh_count // 10 != state["prev_refresh_quotient"]
+        ):
+            display_stats = display.get_stats()
+            key_stats = btns.get_latency_stats()
+            logging.info(
+                "Screen refresh count: {0}, wakeups/hour: {1:.1f}, "
+                "dropped frames: {2}, avg latency: {3:.2f} s, "
+                "key events: {4}, avg press-to-handle: {5:.3f} s, "
+                "upstream requests today: {6}, refresh decisions: {7}".format(
+                    refresh_count,
+                    sched.wakeups_per_hour(),
+                    display_stats["dropped"],
+                    display_stats["avg_latency"] or 0.0,
+                    key_stats["count"],
+                    key_stats.get("avg", 0.0),
+                    upstream_requests_today(),
+                    policy.get_stats(),
+                )
+            )
+            state["prev_refresh_quotient"] = refresh_count // 10
 
-    refresh_count = 0
-    previous_stock_list = None
-    last_ts = {"stock": 0, "posture": time.time()}  # last timestamp
-    prev_refresh_quotient = -1
-    prev_key_state = STOCK_STREAMING  # fall back after upright reminder.
+    def stock_job(force=False):
+        """Start a fetch if anything can have changed, else book the next one by
+        the calendar. The rows come back through stock_rows_job."""
+        if state["fetching"]:
+            # The running fetch books the next one when it is done.
+            state["force_pending"] = state["force_pending"] or force
+            return
+        previous_stock_list = state["stock_list"]
+        streaming = stream is not None and stream.is_live()
+        if state["run"] == STOCK_STREAMING and (
+            previous_stock_list is None
+            or force
+            or yhff.has_stale_quotes()  # the stream only updates known quotes
+            or (not streaming and yhff.calendar.session() != CLOSED)
+        ):
+            # No need to update repeatedly during market close.
+            state["fetching"] = True
+            fetcher.submit(fetch_stock_rows, force)
+            return
+        book_stock_job()
+
+    def fetch_stock_rows(force):
+        "Fetcher thread: fetch, then hand the rows to the scheduler thread."
+        stock_disp_list = None
+        try:
+            with metrics.timer("stock_job"):
+                stock_disp_list = stock_streaming(yhff)
+        except Exception:
+            logging.exception("Stock fetch failed")
+        finally:
+            sched.call_later(
+                0, "stock_rows", lambda: stock_rows_job(stock_disp_list, force)
+            )
+
+    def stock_rows_job(stock_disp_list, force):
+        force = force or state["force_pending"]
+        state["fetching"] = state["force_pending"] = False
+        if stock_disp_list is not None:
+            if state["run"] == STOCK_STREAMING:
+                update_stock_list(stock_disp_list, force=force)
+            else:
+                set_stock_list(stock_disp_list)  # shown on the way back
+        book_stock_job()
+
+    def book_stock_job():
+        "The next fetch, by the calendar, sooner while quotes are stale."
+        delay = yhff.calendar.refresh_delay()
+        if yhff.has_stale_quotes():
+            delay = min(delay, STOCK_RETRY_SECONDS)
+        logging.debug("Next stock refresh in {0:.0f} s".format(delay))
+        sched.call_later(delay, "stock", stock_job)
 
-    run_state = STOCK_STREAMING  # state machine
-    clock_next_refresh_minute = 0
+    def on_stream_update(symbols):
+        "Stream thread: draw the changes, at most every STREAM_RENDER_SECONDS."
+        if not sched.is_pending("stream_render"):
+            sched.call_later(STREAM_RENDER_SECONDS, "stream_render", stream_render_job)
 
-    while True:
-        # May need some other way to halt the program.
+    def stream_render_job():
+        if state["run"] != STOCK_STREAMING or state["stock_list"] is None:
+            return
+        update_stock_list(
+            yhff.format_display_2in7(spark_size=(SPARK_WIDTH, SPARK_HEIGHT))
+        )
 
-        # Scan for pressed key
-        key_pressed = -1
-        for idx, st in enumerate(btns.status_table):
-            if st == 1:
-                key_pressed = idx + 1
-                break
+    stream = None
+    if quote_stream is not None:
+        stream = QuoteStream(yhff, quote_stream, on_update=on_stream_update).start()
+
+    def posture_job():
+        # TODO: put the is_working_time() function to other module.
+        if state["run"] != STOCK_STREAMING or not yhff.is_working_time():
+            return
+        state["overlay"] = True
+        display.submit(disp_drv.display_posture_reminder_sign)
+        sched.call_later(POSTURE_SIGN_SECONDS, "posture_end", posture_end_job)
+        count_refresh()
+
+    def posture_end_job():
+        state["overlay"] = False
+        if state["run"] == STOCK_STREAMING and state["stock_list"] is not None:
+            show_stock_page()
+
+    def page_job():
+        if (
+            state["run"] != STOCK_STREAMING
+            or state["overlay"]
+            or state["stock_list"] is None
+        ):
+            return
+        pages = len(disp_drv.stock_pages(state["stock_list"]))
+        if pages > 1:
+            state["page"] = (state["page"] + 1) % pages
+            show_stock_page()
 
+    def clock_job():
+        if state["run"] != CLOCK:
+            return
+        display.submit(
+            disp_drv.display_clock_current_time,
+            t_input=state.pop("clock_t_input", None),
+        )
+        count_refresh()
+        sched.call_later(
+            seconds_to_next_minute(CLOCK_REFRESH_MINUTES), "clock", clock_job
+        )
+
+    def on_key(event):
+        key_pressed, t_press = event.key, event.t_press
+        if event.kind == "long":
+            if key_pressed == 1 and state["run"] == STOCK_STREAMING:
+                # Hold key 1: fetch now instead of waiting for the next round.
+                sched.call_later(0, "stock", lambda: stock_job(force=True))
+            btns.mark_handled(event)
+            return
+        # "press" and "double" are both presses.
+        on_stock_page = state["run"] == STOCK_STREAMING and not state["overlay"]
+        state["overlay"] = False  # a key press dismisses the posture sign
+        sched.cancel("posture_end")
         if key_pressed == 1:
-            run_state = STOCK_STREAMING
-            prev_key_state = STOCK_STREAMING
+            state["run"] = STOCK_STREAMING
             # Display previous list but not fetching new data.
-            if previous_stock_list is not None:
-                disp_drv.display_stock_ft24_page(previous_stock_list)  # switch back
+            if state["stock_list"] is not None:
+                if on_stock_page:
+                    # Already there: a press flips to the next page.
+                    pages = len(disp_drv.stock_pages(state["stock_list"]))
+                    state["page"] = (state["page"] + 1) % pages
+                    sched.call_later(
+                        PAGE_ROTATE_SECONDS,
+                        "page",
+                        page_job,
+                        interval=PAGE_ROTATE_SECONDS,
+                    )  # restart the rotation from this page
+                show_stock_page(t_input=t_press)  # switch back
         elif key_pressed == 2:
-            run_state = CLOCK
-            prev_key_state = CLOCK
-            clock_next_refresh_minute = datetime.datetime.today().minute
+            state["run"] = CLOCK
+            state["clock_t_input"] = t_press
+            sched.call_later(0, "clock", clock_job)
         elif key_pressed in {3, 4}:
-            run_state = NULL_STATE
-            disp_drv.debug_button_press_display(key_pressed)
-        else:
-            # No key pressed
-            # run_state = NULL_STATE
-            pass  # do not change state.
-
-        btns.clear_status()
-
-        if run_state == NULL_STATE:
-            time.sleep(0.5)
-            continue
-
-        screen_updated = 0
-        if run_state == STOCK_STREAMING and time.time() - last_ts["stock"] > 300:
-            if previous_stock_list is None or yhff.is_market_open():
-                # No need to update repeatedly during market close.
-                if previous_stock_list is None:
-                    # Only show this during the first fetch
-                    disp_drv.display_stock_welcome_screen(yhff.stock_list)
+            state["run"] = NULL_STATE
+            display.submit(
+                disp_drv.debug_button_press_display, key_pressed, t_input=t_press
+            )
+        btns.mark_handled(event)
 
-                stock_disp_list = stock_streaming(yhff)
-                if stock_disp_list != previous_stock_list:
-                    disp_drv.display_stock_ft24_page(stock_disp_list)
-                    previous_stock_list = stock_disp_list
-                    last_ts["stock"] = time.time()  # update timestamp
-                    screen_updated = 1
-
-                else:
-                    logging.debug(
-                        "No change from the last stock list, do not update screen."
-                    )
-            run_state = POSTURE_REMINDER
-        elif (
-            run_state == POSTURE_REMINDER
-            and time.time() - last_ts["posture"] > 300
-            and yhff.is_working_time()
-        ):
-            # TODO: put the is_working_time() function to other module.
-            posture_reminder_routine(disp_drv)
-            last_ts["posture"] = time.time()
-            if previous_stock_list is not None:
-                disp_drv.display_stock_ft24_page(previous_stock_list)  # switch back
-            screen_updated = 1
-            run_state = prev_key_state
-        elif run_state == CLOCK:
-            is_updated = clock_refresh_routine(disp_drv, clock_next_refresh_minute)
-            if is_updated:
-                clock_next_refresh_minute = (clock_next_refresh_minute + 3) % 60
-                screen_updated = 1
-
-        else:
-            pass
-
-        time.sleep(0.5)  # wake up periodically to check
-        refresh_count += screen_updated
-        if refresh_count % 10 == 0 and refresh_count // 10 != prev_refresh_quotient:
-            logging.info("Screen refresh count: {0}".format(refresh_count))
-            prev_refresh_quotient = refresh_count // 10
+    sched.call_later(0, "stock", stock_job)
+    sched.call_later(
+        PAGE_ROTATE_SECONDS, "page", page_job, interval=PAGE_ROTATE_SECONDS
+    )
+    sched.call_later(
+        POSTURE_REMINDER_SECONDS,
+        "posture",
+        posture_job,
+        interval=POSTURE_REMINDER_SECONDS,
+    )
+    if metrics_file is not None:
+        sched.call_later(
+            METRICS_FILE_SECONDS,
+            "metrics",
+            metrics_file_job,
+            interval=METRICS_FILE_SECONDS,
+        )
+    sched.run_forever(on_key)  # May need some other way to halt the program.
     exit()
 
 
-def posture_reminder_routine(epd_driver):
-    epd_driver.display_posture_reminder_sign()
-    time.sleep(5)
+def thin_node_main():
+    "Frames come rendered from the render server, key presses go back to it."
+    if backend == "sim":
+        disp_drv = Display2In7Driver(node_id, epd=SimulatedEPD())
+        button_factory = FakeButtonSource()
+    else:
+        disp_drv = Display2In7Driver(node_id, transfer=None if bulk_spi else False)
+        button_factory = None
+    display = DisplayWorker()
+    host, port = render_server.rsplit(":", 1)
+    client = RenderClient(
+        host,
+        int(port),
+        node_id,
+        lambda buf, full: display.submit(disp_drv.show_buffer, buf, full=full),
+    )
+    EpdHatButtonHandler(on_event=client.send_key, button_factory=button_factory)
+    client.run_forever()
 
 
 def stock_streaming(yhf_fetcher):
     "A sub-routine for displaying the stock price info."
     try:
         yhf_fetcher.refresh_stock_info_dict()
-        return yhf_fetcher.format_display_2in7()
+        return yhf_fetcher.format_display_2in7(spark_size=(SPARK_WIDTH, SPARK_HEIGHT))
     except (urllib.error.HTTPError, IndexError):
         err_stock_list = []
         for stk in stk_list:
@@ -137,14 +418,8 @@ def stock_streaming(yhf_fetcher):
         return err_stock_list
 
 
-def clock_refresh_routine(epd_driver, next_refresh_minute):
-    current_min = datetime.datetime.today().minute
-    if current_min == next_refresh_minute:
-        epd_driver.display_clock_current_time()
-        return True
-    else:
-        return False
-
-
 if __name__ == "__main__":
-    epd_node_main()
+    if render_server is not None:
+        thin_node_main()
+    else:
+        epd_node_main()
@@ -0,0 +1,38 @@
+import argparse
+import logging
+
+from QuoteBroker import DEFAULT_PATH, QuoteBroker
+from YahooFinanceFetcher import YahooFinanceFetcher
+
+logging.basicConfig(
+    format="\033[92m[%(levelname)s]\033[00m %(message)s", level=logging.INFO
+)
+
+
+def quote_broker_main(args):
+    "Run the machine-wide quote broker. Nodes use it with TPS_EPD_QUOTE_BROKER."
+    # The fetcher's own list only seeds the handlers, the broker fetches
+    # whatever the clients subscribe to.
+    yhff = YahooFinanceFetcher(["SPY"], quote_url=args.quote_url)
+    broker = QuoteBroker(
+        yhff,
+        path=args.path,
+        refresh_seconds=args.refresh,
+        requests_per_hour=args.budget,
+        stream_port=args.stream_port,
+    )
+    broker.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TPS-EPD quote broker")
+    parser.add_argument("--path", default=DEFAULT_PATH, help="Unix socket")
+    parser.add_argument("--refresh", type=float, default=60, help="seconds")
+    parser.add_argument("--budget", type=int, default=720, help="requests/hour")
+    parser.add_argument("--quote-url", help="multi-symbol quote endpoint")
+    parser.add_argument(
+        "--stream-port",
+        type=int,
+        help="also serve the quotes as a QuoteStream source on this HTTP port",
+    )
+    quote_broker_main(parser.parse_args())
@@ -0,0 +1,117 @@
+import argparse
+import logging
+
+from DisplayWorker import DisplayWorker
+from Display2In7Driver import Display2In7Driver
+from EpdSimulator import SimulatedEPD
+from NodeScheduler import NodeScheduler, seconds_to_next_minute
+from RenderServer import RemoteNodeDriver, RenderClient, RenderServer
+from TradingCalendar import TradingCalendar
+from YahooFinanceFetcher import YahooFinanceFetcher
+
+logging.basicConfig(
+    format="\033[92m[%(levelname)s]\033[00m %(message)s", level=logging.INFO
+)
+
+# node id -> watchlist. Nodes with the same list share one fetcher.
+node_lists = {
+    "desk-1": ["AAPL", "ARKW", "TSLA", "U", "TQQQ", "MSFT"],
+    "desk-2": ["AAPL", "ARKW", "TSLA", "U", "TQQQ", "MSFT"],
+    "lobby": ["SPY", "QQQ", "DIA", "IWM", "GLD", "TLT"],
+}
+STOCK_RETRY_SECONDS = 300  # when a fetch left stale quotes
+
+
+def render_server_main(port, demo_nodes=0):
+    """Fetch and render for every node here, push the packed frames out.
+    Keys 1 (stocks), 2 (clock), 3 and 4 work like on a standalone node."""
+    sched = NodeScheduler()
+    server = RenderServer(
+        host="0.0.0.0",
+        port=port,
+        on_key=lambda node_id, key, kind: sched.post_event((node_id, key, kind)),
+    )
+    calendar = TradingCalendar()
+    fetchers = {}  # tuple(watchlist) -> YahooFinanceFetcher
+    drivers = {}  # node id -> RemoteNodeDriver
+    pages = {}  # node id -> "stock" / "clock" / "debug"
+    for node_id, stock_list in node_lists.items():
+        if tuple(stock_list) not in fetchers:
+            fetchers[tuple(stock_list)] = YahooFinanceFetcher(
+                stock_list, calendar=calendar
+            )
+        drivers[node_id] = RemoteNodeDriver(server, node_id)
+        pages[node_id] = "stock"
+        drivers[node_id].display_stock_welcome_screen(stock_list)
+
+    def stock_job():
+        "Refresh every watchlist, the next round is set by the trading calendar."
+        stock_pages = {}
+        for watchlist, yhff in fetchers.items():
+            yhff.refresh_stock_info_dict()
+            stock_pages[watchlist] = yhff.format_display_2in7()
+        for node_id, drv in drivers.items():
+            if pages[node_id] == "stock":
+                drv.display_stock_ft24_page(stock_pages[tuple(node_lists[node_id])])
+        logging.info("Render server stats: {0}".format(server.get_stats()))
+        delay = calendar.refresh_delay()
+        if any(yhff.has_stale_quotes() for yhff in fetchers.values()):
+            delay = min(delay, STOCK_RETRY_SECONDS)
+        sched.call_later(delay, "stock", stock_job)
+
+    def clock_job():
+        for node_id, drv in drivers.items():
+            if pages[node_id] == "clock":
+                drv.display_clock_current_time()
+        sched.call_later(seconds_to_next_minute(), "clock", clock_job)
+
+    def on_key(event):
+        node_id, key, kind = event
+        drv = drivers.get(node_id)
+        if drv is None:
+            logging.warning("Key from unknown node {0}".format(node_id))
+            return
+        if key == 1:
+            pages[node_id] = "stock"
+            yhff = fetchers[tuple(node_lists[node_id])]
+            if kind == "long":
+                sched.call_later(0, "stock", stock_job)
+            else:
+                drv.display_stock_ft24_page(yhff.format_display_2in7())
+        elif key == 2:
+            pages[node_id] = "clock"
+            drv.display_clock_current_time()
+        else:
+            pages[node_id] = "debug"
+            drv.debug_button_press_display(key)
+
+    clients = []
+    for i in range(demo_nodes):
+        # Thin nodes on simulated panels in this process, to try it on one machine.
+        node_id = list(node_lists)[i % len(node_lists)]
+        disp_drv = Display2In7Driver(node_id, epd=SimulatedEPD())
+        display = DisplayWorker(name="epd-" + node_id)
+        client = RenderClient(
+            "127.0.0.1",
+            server.port,
+            node_id,
+            lambda buf, full, drv=disp_drv, worker=display: worker.submit(
+                drv.show_buffer, buf, full=full
+            ),
+        )
+        client.start()
+        clients.append(client)
+
+    sched.call_later(0, "stock", stock_job)
+    sched.call_later(seconds_to_next_minute(), "clock", clock_job)
+    sched.run_forever(on_key)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TPS-EPD central render server")
+    parser.add_argument("--port", type=int, default=7340)
+    parser.add_argument(
+        "--demo-nodes", type=int, default=0, help="thin nodes to run in-process"
+    )
+    args = parser.parse_args()
+    render_server_main(args.port, args.demo_nodes)
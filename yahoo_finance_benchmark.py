@@ -0,0 +1,279 @@
+import argparse
+import gc
+import json
+import logging
+import random
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Quote import Quote
+from YahooFinanceFetcher import QUOTE_FIELDS, YahooFinanceFetcher
+
+logging.basicConfig(
+    format="\033[92m[%(levelname)s]\033[00m %(message)s", level=logging.INFO
+)
+
+
+def stub_quote(tk, i, full=False):
+    "Quote of the i-th symbol. full: padded to the size of a full info blob."
+    quote = {
+        "symbol": tk,
+        "bid": 100.0 + i,
+        "ask": 100.2 + i,
+        "bidSize": 1,
+        "askSize": 1,
+        "previousClose": 99.0 + i,
+        "regularMarketPrice": 100.1 + i,
+    }
+    if full:
+        quote.update({"field{0:03d}".format(k): k * 1.5 for k in range(150)})
+    return quote
+
+
+class StubQuoteHandler(BaseHTTPRequestHandler):
+    """Answer /v7/finance/quote?symbols=A,B,C after a fixed delay, like a slow upstream.
+    Without a fields= parameter, every quote is padded to the size of a full info blob.
+    A failure_rate fraction of the requests gets a 500 instead, spread evenly
+    (not random) so that timings compare from run to run.
+    /stream?symbols=A,B,C is the push version, see do_stream."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        symbols = query.get("symbols", [""])[0].split(",")
+        if url.path == "/stream":
+            self.do_stream(symbols)
+            return
+        fields = query.get("fields", [None])[0]
+        time.sleep(self.server.latency)
+        if self.server.next_fails():
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        result = [stub_quote(tk, i, fields is None) for i, tk in enumerate(symbols)]
+        body = json.dumps({"quoteResponse": {"result": result, "error": None}})
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_stream(self, symbols):
+        """Newline-delimited JSON quote updates, one chunk each, a random walk
+        of one symbol every stream_interval. An empty line every second when
+        idle. The connection is dropped after drop_after seconds, if set."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        prices = {tk: 100.0 + i for i, tk in enumerate(symbols)}
+        t_end = time.monotonic() + (self.server.drop_after or float("inf"))
+        t_next = time.monotonic()
+        try:
+            while time.monotonic() < t_end:
+                wait = t_next - time.monotonic()
+                if wait > 1.0:
+                    self.write_chunk(b"\n")  # heartbeat
+                    time.sleep(1.0)
+                    continue
+                time.sleep(max(wait, 0))
+                tk = random.choice(symbols)
+                prices[tk] = round(prices[tk] + random.choice((-0.05, 0.05)), 2)
+                line = {
+                    "symbol": tk,
+                    "regularMarketPrice": prices[tk],
+                    "bid": prices[tk] - 0.01,
+                    "ask": prices[tk] + 0.01,
+                    "t": time.time(),
+                }
+                self.write_chunk(json.dumps(line).encode("utf-8") + b"\n")
+                t_next += self.server.stream_interval
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            pass  # client went away
+        self.close_connection = True
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass  # keep the benchmark output readable
+
+
+class StubQuoteServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency, failure_rate=0.0, stream_interval=0.5, drop_after=None):
+        super().__init__(("127.0.0.1", 0), StubQuoteHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.stream_interval = stream_interval
+        self.drop_after = drop_after
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def next_fails(self):
+        "Whether the next quote request fails: every 1/failure_rate-th one."
+        with self.lock:
+            n = self.requests
+            self.requests += 1
+        return int((n + 1) * self.failure_rate) > int(n * self.failure_rate)
+
+    @property
+    def quote_url(self):
+        return "http://127.0.0.1:{0}/v7/finance/quote".format(self.server_port)
+
+    @property
+    def stream_url(self):
+        return "http://127.0.0.1:{0}/stream".format(self.server_port)
+
+
+def start_stub_server(latency, failure_rate=0.0, stream_interval=0.5, drop_after=None):
+    server = StubQuoteServer(latency, failure_rate, stream_interval, drop_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def time_fetch(quote_url, symbols, max_workers, batch_size):
+    "Return (seconds, fetched count) of one refresh of the given symbols."
+    yhff = YahooFinanceFetcher(
+        symbols[:1],
+        quote_url=quote_url,
+        max_workers=max_workers,
+        batch_size=batch_size,
+        refresh_timeout=600,
+    )
+    t0 = time.perf_counter()
+    fetched = yhff.fetch_info_dicts(symbols)
+    return time.perf_counter() - t0, len(fetched)
+
+
+def fetch_benchmark_main(sizes=(6, 50, 500), latency=0.02, workers=16, batch=50):
+    server = start_stub_server(latency)
+    modes = [
+        ("sequential", 1, 1),  # the old one-by-one behavior
+        ("pooled", workers, 1),
+        ("batched", workers, batch),
+    ]
+    logging.info("Stub latency: {0:.0f} ms per request".format(latency * 1000))
+    for n in sizes:
+        symbols = ["S{0:03d}".format(i) for i in range(n)]
+        base = None
+        for name, max_workers, batch_size in modes:
+            sec, got = time_fetch(server.quote_url, symbols, max_workers, batch_size)
+            base = base or sec
+            logging.info(
+                "{0:4d} symbols | {1:10s} | {2:7.3f} s | {3:6.1f}x | {4} fetched".format(
+                    n, name, sec, base / sec, got
+                )
+            )
+    server.shutdown()
+
+
+def session_benchmark_main(n=50, latency=0.02, workers=8, refreshes=3):
+    "Connections and bytes per refresh, one symbol per request, full info vs displayed fields."
+    server = start_stub_server(latency)
+    symbols = ["S{0:03d}".format(i) for i in range(n)]
+    for label, fields in (("full info", None), ("fields", QUOTE_FIELDS)):
+        yhff = YahooFinanceFetcher(
+            symbols[:1],
+            quote_url=server.quote_url,
+            max_workers=workers,
+            batch_size=1,
+            fields=fields,
+        )
+        for rnd in range(refreshes):
+            yhff.fetch_info_dicts(symbols)
+            st = yhff.last_fetch_stats
+            logging.info(
+                "{0:9s} | refresh {1} | {2} requests | {3} new connections | {4} bytes".format(
+                    label, rnd, st["requests"], st["connections"], st["bytes"]
+                )
+            )
+    server.shutdown()
+
+
+def stream_benchmark_main(n=6, seconds=10.0, interval=0.2, drop_after=4.0):
+    """Push vs poll: updates and bytes received over the stream, with a forced
+    reconnect, against what one polling refresh costs."""
+    from QuoteStream import QuoteStream
+
+    server = start_stub_server(0.0, stream_interval=interval, drop_after=drop_after)
+    symbols = ["S{0:03d}".format(i) for i in range(n)]
+    yhff = YahooFinanceFetcher(symbols, quote_url=server.quote_url)
+    yhff.refresh_stock_info_dict()
+    poll_bytes = yhff.last_fetch_stats["bytes"]
+    stream = QuoteStream(yhff, server.stream_url, max_backoff=1.0).start()
+    time.sleep(seconds)
+    st = stream.get_stats()
+    stream.stop()
+    logging.info(
+        "stream: {0} updates in {1:.0f} s, {2} connects, {3:.0f} bytes/update | "
+        "poll: {4} bytes/refresh, every update would be a refresh".format(
+            st["updates"],
+            seconds,
+            st["connects"],
+            st["bytes"] / max(st["updates"], 1),
+            poll_bytes,
+        )
+    )
+    server.shutdown()
+
+
+def quote_memory_main(n=500):
+    "Heap kept per symbol: the full info dict, the trimmed dict, a Quote record."
+    blobs = [json.dumps(stub_quote("S{0:03d}".format(i), i, True)) for i in range(n)]
+    kinds = (
+        ("full info", lambda info: info),
+        ("trimmed dict", lambda info: {k: info[k] for k in QUOTE_FIELDS if k in info}),
+        ("Quote", Quote.from_info),
+    )
+    sizes = {}
+    for label, keep in kinds:
+        gc.collect()
+        tracemalloc.start()
+        kept = [keep(json.loads(blob)) for blob in blobs]
+        gc.collect()
+        sizes[label] = tracemalloc.get_traced_memory()[0] / n
+        tracemalloc.stop()
+        del kept
+    for label, size in sizes.items():
+        logging.info(
+            "{0:12s} | {1:7.0f} bytes/symbol | {2:7.0f} saved by Quote".format(
+                label, size, size - sizes["Quote"]
+            )
+        )
+
+    # format_display_2in7 for the whole list, one pass over the quotes
+    yhff = YahooFinanceFetcher(["S{0:03d}".format(i) for i in range(n)])
+    for i, tk in enumerate(yhff.stock_list):
+        yhff.tks_info[tk] = Quote.from_info(stub_quote(tk, i))
+        yhff.tks_ts[tk] = time.time()
+    t0 = time.perf_counter()
+    yhff.format_display_2in7()
+    logging.info(
+        "format_display_2in7 | {0} symbols | {1:.3f} ms".format(
+            n, (time.perf_counter() - t0) * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quote fetch benchmark")
+    parser.add_argument("--latency", type=float, default=0.02, help="stub delay (s)")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=50)
+    args = parser.parse_args()
+    fetch_benchmark_main(latency=args.latency, workers=args.workers, batch=args.batch)
+    session_benchmark_main(latency=args.latency)
+    stream_benchmark_main()
+    quote_memory_main()